@@ -7,11 +7,9 @@ local machine.
 """
 
 import argparse
-import os
 import subprocess
-import time
 
-import torch
+from improved_diffusion.job_scheduler import JobQueue, LocalScheduler, make_job
 
 
 def local_launcher(commands):
@@ -32,34 +30,41 @@ def dummy_launcher(commands):
 def multi_gpu_launcher(commands):
     """Launch commands on the local machine, using all GPUs in parallel."""
     print('WARNING: using experimental multi_gpu_launcher.')
-    try:
-        # Get list of GPUs from env, split by ',' and remove empty string ''
-        # To handle the case when there is one extra comma: `CUDA_VISIBLE_DEVICES=0,1,2,3, python3 ...`
-        available_gpus = [
-            x for x in os.environ['CUDA_VISIBLE_DEVICES'].split(',') if x != ''
-        ]
-    except Exception:
-        # If the env variable is not set, we use all GPUs
-        available_gpus = [str(x) for x in range(torch.cuda.device_count())]
-    n_gpus = len(available_gpus)
-    procs_by_gpu = [None] * n_gpus
-
-    while len(commands) > 0:
-        for idx, gpu_idx in enumerate(available_gpus):
-            proc = procs_by_gpu[idx]
-            if (proc is None) or (proc.poll() is not None):
-                # Nothing is running on this GPU; launch a command.
-                cmd = commands.pop(0)
-                new_proc = subprocess.Popen(
-                    f'CUDA_VISIBLE_DEVICES={gpu_idx} {cmd}', shell=True)
-                procs_by_gpu[idx] = new_proc
-                break
-        time.sleep(1)
-
-    # Wait for the last few tasks to finish before returning
-    for p in procs_by_gpu:
-        if p is not None:
-            p.wait()
+    job_queue = JobQueue()
+    job_queue.add([make_job(cmd) for cmd in commands])
+    LocalScheduler(job_queue).run()
+
+
+def scheduler_launcher(commands,
+                       queue_file=None,
+                       env_list=None,
+                       job_gpus=1,
+                       job_gpu_mem_gb=0.0,
+                       job_cpus=1,
+                       job_mem_gb=0.0,
+                       max_retries=0,
+                       **scheduler_kwargs):
+    """Launch commands with the resource-aware LocalScheduler.
+
+    Jobs are added to the queue in queue_file (if given) and the scheduler
+    runs everything in the queue that is not finished yet, so re-running the
+    same launch resumes it. env_list optionally gives extra environment
+    variables for each command.
+    """
+    env_list = env_list or [None] * len(commands)
+    job_queue = JobQueue(queue_file)
+    n_added = job_queue.add([
+        make_job(cmd,
+                 gpus=job_gpus,
+                 gpu_mem_gb=job_gpu_mem_gb,
+                 cpus=job_cpus,
+                 mem_gb=job_mem_gb,
+                 env=env,
+                 max_retries=max_retries)
+        for cmd, env in zip(commands, env_list)
+    ])
+    print(f'Added {n_added} new jobs to the queue.')
+    return LocalScheduler(job_queue, **scheduler_kwargs).run()
 
 
 def ArgumentParser():
@@ -67,7 +72,7 @@ def ArgumentParser():
     parser.add_argument('--launcher',
                         type=str,
                         default='multi_gpu',
-                        choices=['local', 'dummy', 'multi_gpu'])
+                        choices=['local', 'dummy', 'multi_gpu', 'scheduler'])
     parser.add_argument('--command',
                         type=str,
                         required=True,
@@ -79,6 +84,53 @@ def ArgumentParser():
                         nargs='*',
                         help='<Required> Set flag',
                         required=True)
+    parser.add_argument(
+        '--as_array',
+        action='store_true',
+        help='If given, passes each id to the command as SLURM_ARRAY_TASK_ID '
+        'instead of appending it to the command, to run SLURM array scripts '
+        'locally.')
+    # Options of the scheduler launcher
+    parser.add_argument(
+        '--queue_file',
+        type=str,
+        default=None,
+        help='Path to a JSON file keeping the job queue. Re-running with the '
+        'same file resumes unfinished jobs.')
+    parser.add_argument('--job_gpus',
+                        type=int,
+                        default=1,
+                        help='Number of GPUs per job.')
+    parser.add_argument(
+        '--job_gpu_mem_gb',
+        type=float,
+        default=0.0,
+        help='GPU memory per job. Jobs are packed onto shared GPUs if it is '
+        'positive; 0 gives every job whole GPUs.')
+    parser.add_argument('--job_cpus',
+                        type=int,
+                        default=1,
+                        help='Number of CPU cores per job.')
+    parser.add_argument('--job_mem_gb',
+                        type=float,
+                        default=0.0,
+                        help='Host memory per job.')
+    parser.add_argument('--max_retries', type=int, default=0)
+    parser.add_argument('--cpus',
+                        type=int,
+                        default=None,
+                        help='Number of CPU cores to use. Default: all.')
+    parser.add_argument('--mem_gb',
+                        type=float,
+                        default=None,
+                        help='Host memory to use. Default: all.')
+    parser.add_argument('--cpu_only',
+                        action='store_true',
+                        help='Run all jobs without GPUs.')
+    parser.add_argument('--log_dir',
+                        type=str,
+                        default=None,
+                        help='If given, writes the output of each job there.')
 
     return parser
 
@@ -86,9 +138,30 @@ def ArgumentParser():
 if __name__ == '__main__':
     parser = ArgumentParser()
     args = parser.parse_args()
-    # Test the multi_gpu_launcher
-    if args.list is not None:
-        commands = [f'{args.command} {i}' for i in args.list]
+    ids = args.list if args.list is not None else range(args.num_id)
+    if args.as_array:
+        commands = [args.command for _ in ids]
+        env_list = [{'SLURM_ARRAY_TASK_ID': i} for i in ids]
+    else:
+        commands = [f'{args.command} {i}' for i in ids]
+        env_list = None
+    if args.launcher == 'scheduler':
+        scheduler_launcher(commands,
+                           queue_file=args.queue_file,
+                           env_list=env_list,
+                           job_gpus=args.job_gpus,
+                           job_gpu_mem_gb=args.job_gpu_mem_gb,
+                           job_cpus=args.job_cpus,
+                           job_mem_gb=args.job_mem_gb,
+                           max_retries=args.max_retries,
+                           cpus=args.cpus,
+                           mem_gb=args.mem_gb,
+                           cpu_only=args.cpu_only,
+                           log_dir=args.log_dir)
     else:
-        commands = [f'{args.command} {i}' for i in range(args.num_id)]
-    multi_gpu_launcher(commands)
+        assert not args.as_array, '--as_array needs --launcher scheduler'
+        {
+            'local': local_launcher,
+            'dummy': dummy_launcher,
+            'multi_gpu': multi_gpu_launcher,
+        }[args.launcher](commands)
@@ -0,0 +1,173 @@
+"""Compiled model calls for sampling.
+
+During inference, every call of the model within a stage (and usually within
+a whole run) has the same shapes: B x max_frames x C x H x W inputs with the
+same set of conditioning arguments. InferenceModel wraps a model and, for each
+such call signature, builds a compiled version of the forward pass once and
+reuses it for all later calls with that signature:
+
+- 'trace': a TorchScript trace of the model, which runs the whole forward pass
+  without going through the Python modules.
+- 'cudagraph': the trace, captured in a CUDA graph, so that a model call is a
+  single graph launch. On CPU this is the same as 'trace'.
+- 'compile': torch.compile (PyTorch >= 2.0).
+
+Anything that cannot be compiled falls back to the eager model: calls that
+need gradients or attention weights, calls with arguments that are neither
+tensors nor hashable constants, and call signatures for which compilation
+fails or gives different results than the eager model.
+"""
+
+import torch as th
+import torch.nn as nn
+
+COMPILE_MODES = ['none', 'trace', 'cudagraph', 'compile']
+
+
+class _BoundModel(nn.Module):
+    """The model with its non-tensor arguments fixed, called with its tensor
+    arguments positionally and returning only the model output (which is what
+    tracing needs)."""
+    def __init__(self, model, tensor_names, constants):
+        super().__init__()
+        self.model = model
+        self.tensor_names = tensor_names
+        self.constants = constants
+
+    def forward(self, x, timesteps, *tensors):
+        kwargs = dict(zip(self.tensor_names, tensors))
+        kwargs.update(self.constants)
+        out, _ = self.model(x, timesteps=timesteps, **kwargs)
+        return out
+
+
+def _capture_cuda_graph(fn, example_inputs, n_warmup=3):
+    """Captures fn(*example_inputs) in a CUDA graph. Returns a function with
+    the same signature that replays the graph."""
+    static_inputs = [a.clone() for a in example_inputs]
+    # Warm up on a side stream (as required before capture), which also lets
+    # the fuser of the traced function specialise.
+    stream = th.cuda.Stream()
+    stream.wait_stream(th.cuda.current_stream())
+    with th.cuda.stream(stream):
+        for _ in range(n_warmup):
+            fn(*static_inputs)
+    th.cuda.current_stream().wait_stream(stream)
+    graph = th.cuda.CUDAGraph()
+    with th.cuda.graph(graph):
+        static_output = fn(*static_inputs)
+
+    def replay(*inputs):
+        for static_input, a in zip(static_inputs, inputs):
+            static_input.copy_(a)
+        graph.replay()
+        # The output buffer is overwritten by the next replay.
+        return static_output.clone()
+
+    return replay
+
+
+class InferenceModel(nn.Module):
+    """Wraps a model for sampling, compiling its forward pass once per call
+    signature (shapes, dtypes and devices of the tensor arguments, and values
+    of the other arguments).
+
+    Args:
+        model: the model, called as model(x, timesteps=..., **kwargs) and
+            returning an (output, attention weights) tuple.
+        mode: one of COMPILE_MODES.
+        check: if True, the first call of each compiled signature is also
+            run eagerly, and the signature falls back to the eager model if
+            the outputs differ by more than atol.
+        atol: the tolerance of the check.
+    """
+    def __init__(self, model, mode='trace', check=True, atol=1e-4):
+        super().__init__()
+        assert mode in COMPILE_MODES, mode
+        self.model = model
+        self.mode = mode
+        self.check = check
+        self.atol = atol
+        # Call signature -> compiled function, or None for the eager model.
+        self._compiled = {}
+
+    def _signature(self, x, timesteps, kwargs):
+        """Returns a hashable description of the call, the names of the tensor
+        keyword arguments and the other keyword arguments, or None if the call
+        cannot be compiled."""
+        tensor_names = []
+        constants = {}
+        signature = []
+        for name, value in sorted(kwargs.items()):
+            if th.is_tensor(value):
+                tensor_names.append(name)
+                signature.append(
+                    (name, tuple(value.shape), value.dtype, value.device))
+            else:
+                try:
+                    hash(value)
+                except TypeError:
+                    return None
+                constants[name] = value
+                signature.append((name, value))
+        for a in (x, timesteps):
+            signature.append((tuple(a.shape), a.dtype, a.device))
+        return tuple(signature), tuple(tensor_names), constants
+
+    def _compile(self, bound, inputs):
+        if self.mode == 'compile':
+            return th.compile(bound, dynamic=False)
+        traced = th.jit.trace(bound, tuple(inputs), check_trace=False)
+        if self.mode == 'cudagraph' and inputs[0].is_cuda:
+            return _capture_cuda_graph(traced, inputs)
+        return traced
+
+    def _build(self, tensor_names, constants, inputs):
+        """Compiles the call signature and runs it on inputs (torch.compile
+        only compiles on the first call). Returns the compiled function, or
+        None if the eager model should be used instead, and the output."""
+        bound = _BoundModel(self.model, tensor_names, constants)
+        try:
+            fn = self._compile(bound, inputs)
+            out = fn(*inputs)
+        except Exception as e:  # pylint: disable=broad-except
+            print(f'WARNING: could not {self.mode} the model ({e!r}); using '
+                  'the eager model.')
+            return None, bound(*inputs)
+        if self.check:
+            expected = bound(*inputs)
+            error = (out - expected).abs().max().item()
+            if error > self.atol:
+                print(f'WARNING: {self.mode} model differs from the eager '
+                      f'model by {error:.2e}; using the eager model.')
+                return None, expected
+        return fn, out
+
+    def forward(self, x, timesteps, return_attn_weights=False, **kwargs):
+        if (self.mode == 'none' or return_attn_weights or self.model.training
+                or th.is_grad_enabled()):
+            return self.model(x,
+                              timesteps=timesteps,
+                              return_attn_weights=return_attn_weights,
+                              **kwargs)
+        described = self._signature(x, timesteps, kwargs)
+        if described is None:
+            return self.model(x, timesteps=timesteps, **kwargs)
+        signature, tensor_names, constants = described
+        inputs = [x, timesteps] + [kwargs[name] for name in tensor_names]
+        if signature not in self._compiled:
+            fn, out = self._build(tensor_names, constants, inputs)
+            self._compiled[signature] = fn
+            return out, None
+        fn = self._compiled[signature]
+        if fn is None:
+            return self.model(x, timesteps=timesteps, **kwargs)
+        return fn(*inputs), None
+
+
+def compile_for_inference(model, mode):
+    """Returns the model wrapped in an InferenceModel, or the model itself if
+    mode is 'none'."""
+    if mode == 'none':
+        return model
+    return InferenceModel(model, mode=mode)
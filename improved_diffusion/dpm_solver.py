@@ -0,0 +1,236 @@
+"""Multistep DPM-Solver++ sampling (Lu et al., "DPM-Solver++: Fast Solver for
+Guided Sampling of Diffusion Probabilistic Models", 2022).
+
+DPM-Solver++ integrates the probability flow ODE of the diffusion with the
+model's x_0 predictions, reusing the predictions of the previous steps for a
+higher order update, so each step takes one model evaluation. It runs on the
+timesteps of the diffusion it is given: to sample in N steps, pass a
+diffusion respaced to N steps (e.g. diffusion.respaced(N)). The first order
+solver is deterministic DDIM.
+
+For the video models, the observed frames (where model_kwargs['obs_mask'] is
+1) are clamped to model_kwargs['x0'], noised along the same deterministic
+trajectory as the latent frames, so the model sees them as it does in
+ancestral sampling, and the samples contain them exactly.
+"""
+
+import math
+
+import numpy as np
+import torch as th
+
+from .gaussian_diffusion import GuidanceType
+
+SAMPLERS = ['ddpm', 'dpm_solver++']
+
+
+def _multistep_update(x, preds, lambdas, alpha_next, sigma_ratio, order):
+    """Take a DPM-Solver++ step of the given order.
+
+    :param x: the sample at the current timestep.
+    :param preds: the x_0 predictions, the current one last.
+    :param lambdas: a list of the log signal-to-noise ratios
+                    (log(alpha / sigma)) of the timesteps of preds, followed
+                    by the next timestep's.
+    :param alpha_next: the signal scale at the next timestep.
+    :param sigma_ratio: the noise scale at the next timestep over the current
+                        one.
+    :param order: 1, 2 or 3. Needs at least that many predictions.
+    :return: the sample at the next timestep.
+    """
+    h = lambdas[-1] - lambdas[-2]
+    phi_1 = math.expm1(-h)
+    x = sigma_ratio * x - (alpha_next * phi_1) * preds[-1]
+    if order == 1:
+        return x
+    # Divided differences of the predictions, in units of the step size.
+    r0 = (lambdas[-2] - lambdas[-3]) / h
+    d1_0 = (preds[-1] - preds[-2]) / r0
+    if order == 2:
+        return x - (0.5 * alpha_next * phi_1) * d1_0
+    r1 = (lambdas[-3] - lambdas[-4]) / h
+    d1_1 = (preds[-2] - preds[-3]) / r1
+    d1 = d1_0 + (r0 / (r0 + r1)) * (d1_0 - d1_1)
+    d2 = (d1_0 - d1_1) / (r0 + r1)
+    phi_2 = phi_1 / h + 1.0
+    phi_3 = phi_2 / h - 0.5
+    return x + (alpha_next * phi_2) * d1 - (alpha_next * phi_3) * d2
+
+
+def dpm_solver_sample(
+    diffusion,
+    model,
+    x,
+    i,
+    preds=(),
+    clip_denoised=True,
+    denoised_fn=None,
+    model_kwargs=None,
+    order=2,
+    use_gradient_method=False,
+):
+    """Take a DPM-Solver++ step from timestep i of the diffusion to i - 1.
+
+    Same usage as GaussianDiffusion.p_sample(), with the diffusion as first
+    argument, except for:
+
+    :param i: the current timestep, as an int, since the solver's
+              coefficients are the same for the whole batch (and are
+              computed in float64 on the host).
+    :param preds: the predictions of x_0 at the previous timesteps (the most
+                  recent last), of which the last order - 1 are used. Lower
+                  orders are used where there are not enough of them, and
+                  for the last steps, where they are more stable with few
+                  steps.
+    :param order: the order of the solver: 1 (DDIM), 2 or 3.
+    :return: a dict with the keys 'sample' (the sample at timestep i - 1, or
+             at timestep 0 the prediction of x_0) and 'pred_xstart'.
+    """
+    assert order in (1, 2, 3), 'DPM-Solver++ is implemented up to order 3.'
+    if (use_gradient_method
+            and diffusion.guidance_type == GuidanceType.RECONSTRUCTION):
+        # Reconstruction guidance corrects the mean of the ancestral
+        # sampling step, which the solver does not use.
+        raise ValueError(
+            'DPM-Solver++ only supports batched guidance (GuidanceType.BATCHED).'
+        )
+    t = th.full((len(x), ), i, device=x.device)
+    with th.no_grad():
+        pred = diffusion.p_mean_variance(
+            model,
+            x,
+            t,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            use_gradient_method=use_gradient_method,
+        )['pred_xstart']
+    if i == 0:
+        # Denoise from the last timestep, as DDIM does.
+        return {'sample': pred, 'pred_xstart': pred}
+    preds = [*preds, pred][-order:]
+    step_order = min(order, len(preds), i)
+    # The predictions are at timesteps i + step_order - 1, ..., i.
+    alphas_cumprod = diffusion.alphas_cumprod[i - 1:i + step_order]
+    alphas = np.sqrt(alphas_cumprod)
+    sigmas = np.sqrt(1.0 - alphas_cumprod)
+    lambdas = np.log(alphas) - np.log(sigmas)
+    sample = _multistep_update(
+        x,
+        preds[-step_order:],
+        lambdas[::-1].tolist(),
+        float(alphas[0]),
+        float(sigmas[0] / sigmas[1]),
+        step_order,
+    )
+    return {'sample': sample, 'pred_xstart': pred}
+
+
+def dpm_solver_sample_loop(
+    diffusion,
+    model,
+    shape,
+    noise=None,
+    clip_denoised=True,
+    denoised_fn=None,
+    model_kwargs=None,
+    device=None,
+    progress=False,
+    order=2,
+    use_gradient_method=False,
+):
+    """Generate samples from the model using multistep DPM-Solver++.
+
+    Same usage as GaussianDiffusion.p_sample_loop(), with the diffusion as
+    first argument.
+
+    :param order: the order of the solver: 1 (DDIM), 2 or 3.
+    :return: a non-differentiable batch of samples.
+    """
+    final = None
+    for sample in dpm_solver_sample_loop_progressive(
+            diffusion,
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            order=order,
+            use_gradient_method=use_gradient_method,
+    ):
+        final = sample
+    return final['sample']
+
+
+def dpm_solver_sample_loop_progressive(
+    diffusion,
+    model,
+    shape,
+    noise=None,
+    clip_denoised=True,
+    denoised_fn=None,
+    model_kwargs=None,
+    device=None,
+    progress=False,
+    order=2,
+    use_gradient_method=False,
+):
+    """Use multistep DPM-Solver++ to sample from the model and yield the
+    intermediate samples after each timestep of the diffusion.
+
+    Same usage as dpm_solver_sample_loop(). Returns a generator over dicts
+    with the keys 'sample' (the sample at the next timestep, and at the last
+    step the final sample) and 'pred_xstart' (the prediction of x_0).
+    """
+    if model_kwargs is None:
+        model_kwargs = {}
+    if device is None:
+        device = next(model.parameters()).device
+    assert isinstance(shape, (tuple, list))
+    if noise is None:
+        noise = th.randn(*shape, device=device)
+    obs_mask = model_kwargs.get('obs_mask')
+    alphas = np.sqrt(diffusion.alphas_cumprod)
+    sigmas = np.sqrt(1.0 - diffusion.alphas_cumprod)
+    indices = list(range(diffusion.num_timesteps))[::-1]
+
+    if progress:
+        # Lazy import so that we don't depend on tqdm.
+        from tqdm.auto import tqdm
+
+        indices = tqdm(indices)
+
+    x = noise
+    preds = []
+    for i in indices:
+        if obs_mask is not None:
+            x_obs = (float(alphas[i]) * model_kwargs['x0'] +
+                     float(sigmas[i]) * noise)
+            x = x * (1 - obs_mask) + x_obs * obs_mask
+        t = th.tensor([i] * shape[0], device=device)
+        if 'observed_frames' in model_kwargs:
+            diffusion._set_observed_frames_kwargs(
+                model_kwargs,
+                t,
+                noise=noise,
+                use_gradient_method=use_gradient_method)
+        out = dpm_solver_sample(
+            diffusion,
+            model,
+            x,
+            i,
+            preds=preds,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            order=order,
+            use_gradient_method=use_gradient_method,
+        )
+        preds = (preds + [out['pred_xstart']])[-order:]
+        x = out['sample']
+        if i == 0 and obs_mask is not None:
+            x = x * (1 - obs_mask) + model_kwargs['x0'] * obs_mask
+        yield {'sample': x, 'pred_xstart': out['pred_xstart']}
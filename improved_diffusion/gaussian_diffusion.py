@@ -6,9 +6,12 @@ Docstrings have been added, as well as DDIM sampling and a new collection of
 beta schedules.
 """
 
+import contextlib
 import enum
+import functools
 import math
 from http.client import METHOD_NOT_ALLOWED
+from statistics import NormalDist
 
 import numpy as np
 import torch as th
@@ -93,6 +96,22 @@ class ModelVarType(enum.Enum):
     LEARNED_RANGE = enum.auto()
 
 
+class GuidanceType(enum.Enum):
+    """How the observed frames guide sampling when use_gradient_method is set.
+
+    Both variants compare the model's prediction when it conditions on the
+    observed frames with its joint prediction, where the observed frames are
+    treated as latent.
+    """
+
+    # move the joint prediction along the gradient of its mismatch with the
+    # observed frames (needs a backward pass through the model)
+    RECONSTRUCTION = enum.auto()
+    # extrapolate from the joint to the conditional prediction, with both
+    # computed in a single forward pass over a doubled batch
+    BATCHED = enum.auto()
+
+
 class LossType(enum.Enum):
     MSE = enum.auto()  # use raw MSE loss (and KL when learning variances)
     RESCALED_MSE = (
@@ -105,6 +124,18 @@ class LossType(enum.Enum):
         return self == LossType.KL or self == LossType.RESCALED_KL
 
 
+@functools.lru_cache(maxsize=8)
+def _device_tables_of_schedule(betas_bytes):
+    """The device copies of the coefficient tables of a noise schedule (see
+    GaussianDiffusion._extract), keyed by the bytes of the schedule's betas.
+
+    Only the most recently used schedules are kept, so that a long-running
+    process does not keep the tables of every schedule it has seen. The
+    diffusions using a schedule keep its tables alive.
+    """
+    return {}
+
+
 class GaussianDiffusion:
     """Utilities for training and sampling diffusion models.
 
@@ -171,6 +202,65 @@ class GaussianDiffusion:
                                      np.sqrt(alphas) /
                                      (1.0 - self.alphas_cumprod))
 
+        # Tables derived from the above, so that no step of the sampling loop
+        # has to compute them.
+        self.one_minus_alphas_cumprod = 1.0 - self.alphas_cumprod
+        self.log_betas = np.log(betas)
+        # for fixedlarge, we set the initial (log-)variance like so to get a
+        # better decoder log likelihood.
+        self.fixed_large_variance = np.append(self.posterior_variance[1],
+                                              betas[1:])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+        self.recip_posterior_mean_coef1 = 1.0 / self.posterior_mean_coef1
+        self.posterior_mean_coef2_over_coef1 = (self.posterior_mean_coef2 /
+                                                self.posterior_mean_coef1)
+        # float32 copies of the tables on each device they are used on, keyed
+        # by (name, device), so that each table is copied over only once. The
+        # tables only depend on the betas, so all the diffusions with the same
+        # betas share their copies.
+        self._device_tables = _device_tables_of_schedule(betas.tobytes())
+
+        self.configure_guidance()
+
+    def configure_guidance(self,
+                           guidance_type=GuidanceType.RECONSTRUCTION,
+                           weight=None,
+                           checkpoint=False):
+        """Set how sampling with use_gradient_method=True is guided.
+
+        :param guidance_type: a GuidanceType.
+        :param weight: the guidance weight. Defaults to 10 for RECONSTRUCTION
+                       and 1 for BATCHED.
+        :param checkpoint: if True, use gradient checkpointing in the model
+                           for the backward pass of RECONSTRUCTION guidance.
+        """
+        if weight is None:
+            weight = {
+                GuidanceType.RECONSTRUCTION: 10.0,
+                GuidanceType.BATCHED: 1.0,
+            }[guidance_type]
+        self.guidance_type = guidance_type
+        self.guidance_weight = weight
+        self.guidance_checkpoint = checkpoint
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        """Extract values from the coefficient table self.<name> for a batch
+        of indices, using a copy of the table kept on the indices' device.
+
+        :param name: the name of a 1-D numpy array attribute of self.
+        :param timesteps: a tensor of indices into the array to extract.
+        :param broadcast_shape: a larger shape of K dimensions with the batch
+                                dimension equal to the length of timesteps.
+        :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
+        """
+        key = (name, timesteps.device)
+        table = self._device_tables.get(key)
+        if table is None:
+            table = th.from_numpy(getattr(self, name))
+            table = table.to(device=timesteps.device, dtype=th.float32)
+            self._device_tables[key] = table
+        return _extract_into_tensor(table, timesteps, broadcast_shape)
+
     def q_mean_variance(self, x_start, t):
         """Get the distribution q(x_t | x_0).
 
@@ -178,16 +268,14 @@ class GaussianDiffusion:
         :param t: the number of diffusion steps (minus 1). Here, 0 means one step.
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
-        mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) *
-            x_start)
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t,
-                                        x_start.shape)
-        log_variance = _extract_into_tensor(self.log_one_minus_alphas_cumprod,
-                                            t, x_start.shape)
+        mean = (self._extract('sqrt_alphas_cumprod', t, x_start.shape) *
+                x_start)
+        variance = self._extract('one_minus_alphas_cumprod', t, x_start.shape)
+        log_variance = self._extract('log_one_minus_alphas_cumprod', t,
+                                     x_start.shape)
         return mean, variance, log_variance
 
-    def q_sample(self, x_start, t, noise=None):
+    def q_sample(self, x_start, t, noise=None, generator=None):
         """Diffuse the data for a given number of diffusion steps.
 
         In other words, sample from q(x_t | x_0).
@@ -195,15 +283,17 @@ class GaussianDiffusion:
         :param x_start: the initial data batch.
         :param t: the number of diffusion steps (minus 1). Here, 0 means one step.
         :param noise: if specified, the split-out normal noise.
+        :param generator: if specified, the th.Generator to draw the noise
+                          from instead of the global one.
         :return: A noisy version of x_start.
         """
         if noise is None:
-            noise = th.randn_like(x_start)
+            noise = _randn_like(x_start, generator)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) *
-            x_start + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod,
-                                           t, x_start.shape) * noise)
+            self._extract('sqrt_alphas_cumprod', t, x_start.shape) * x_start +
+            self._extract('sqrt_one_minus_alphas_cumprod', t, x_start.shape) *
+            noise)
 
     def q_posterior_mean_variance(self, x_start, x_t, t):
         """Compute the mean and variance of the diffusion posterior:
@@ -213,15 +303,12 @@ class GaussianDiffusion:
         q(x_{t-1} | x_t, x_0)
         """
         assert x_start.shape == x_t.shape
-        posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) *
-            x_start +
-            _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) *
-            x_t)
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t,
-                                                  x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape)
+        posterior_mean = _linear_combination(
+            self._extract('posterior_mean_coef1', t, x_t.shape), x_start,
+            self._extract('posterior_mean_coef2', t, x_t.shape), x_t)
+        posterior_variance = self._extract('posterior_variance', t, x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            'posterior_log_variance_clipped', t, x_t.shape)
         assert (posterior_mean.shape[0] == posterior_variance.shape[0] ==
                 posterior_log_variance_clipped.shape[0] == x_start.shape[0])
         return posterior_mean, posterior_variance, posterior_log_variance_clipped
@@ -236,6 +323,7 @@ class GaussianDiffusion:
         model_kwargs=None,
         return_attn_weights=False,
         use_gradient_method=False,
+        generator=None,
     ):
         """Apply the model to get p(x_{t-1} | x_t), as well as a prediction of
         the initial x, x_0.
@@ -259,23 +347,30 @@ class GaussianDiffusion:
         if model_kwargs is None:
             model_kwargs = {}
 
-        new_model_kwargs = {k: v for k, v in model_kwargs.items()}
-
-        if use_gradient_method:
-            x.requires_grad_(True)
-            obs_mask = model_kwargs['obs_mask']
-            new_model_kwargs['obs_mask'] = th.zeros_like(obs_mask)
-            new_model_kwargs[
-                'latent_mask'] = obs_mask + model_kwargs['latent_mask']
+        reconstruction_guided = (use_gradient_method and self.guidance_type
+                                 == GuidanceType.RECONSTRUCTION)
+        if reconstruction_guided:
+            x = x.detach().requires_grad_(True)
+            grad_context = th.enable_grad()
+        else:
+            grad_context = th.no_grad()
+        if reconstruction_guided and self.guidance_checkpoint:
+            checkpoint_context = _gradient_checkpointing(model)
+        else:
+            checkpoint_context = contextlib.nullcontext()
 
-        with th.enable_grad() if use_gradient_method else th.no_grad():
+        with grad_context, checkpoint_context:
             B, C = x.shape[:2]
             assert t.shape == (B, )
-            model_output, attn_weights = model(
-                x,
-                self._scale_timesteps(t),
-                return_attn_weights=return_attn_weights,
-                **new_model_kwargs)
+            if use_gradient_method:
+                model_output, attn_weights = self._guided_model_output(
+                    model, x, t, model_kwargs)
+            else:
+                model_output, attn_weights = model(
+                    x,
+                    self._scale_timesteps(t),
+                    return_attn_weights=return_attn_weights,
+                    **model_kwargs)
 
             if self.model_var_type in [
                     ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE
@@ -288,33 +383,27 @@ class GaussianDiffusion:
                     model_log_variance = model_var_values
                     model_variance = th.exp(model_log_variance)
                 else:
-                    min_log = _extract_into_tensor(
-                        self.posterior_log_variance_clipped, t, x.shape)
-                    max_log = _extract_into_tensor(np.log(self.betas), t,
-                                                   x.shape)
+                    min_log = self._extract('posterior_log_variance_clipped',
+                                            t, x.shape)
+                    max_log = self._extract('log_betas', t, x.shape)
                     # The model_var_values is [-1, 1] for [min_var, max_var].
                     frac = (model_var_values + 1) / 2
                     model_log_variance = frac * max_log + (1 - frac) * min_log
                     model_variance = th.exp(model_log_variance)
             else:
                 model_variance, model_log_variance = {
-                    # for fixedlarge, we set the initial (log-)variance like so
-                    # to get a better decoder log likelihood.
                     ModelVarType.FIXED_LARGE: (
-                        np.append(self.posterior_variance[1], self.betas[1:]),
-                        np.log(
-                            np.append(self.posterior_variance[1],
-                                      self.betas[1:])),
+                        'fixed_large_variance',
+                        'fixed_large_log_variance',
                     ),
                     ModelVarType.FIXED_SMALL: (
-                        self.posterior_variance,
-                        self.posterior_log_variance_clipped,
+                        'posterior_variance',
+                        'posterior_log_variance_clipped',
                     ),
                 }[self.model_var_type]
-                model_variance = _extract_into_tensor(model_variance, t,
-                                                      x.shape)
-                model_log_variance = _extract_into_tensor(
-                    model_log_variance, t, x.shape)
+                model_variance = self._extract(model_variance, t, x.shape)
+                model_log_variance = self._extract(model_log_variance, t,
+                                                   x.shape)
 
             def process_xstart(x):
                 if denoised_fn is not None:
@@ -347,21 +436,27 @@ class GaussianDiffusion:
             assert (model_mean.shape == model_log_variance.shape ==
                     pred_xstart.shape == x.shape)
 
-            if use_gradient_method:
-                noise = th.randn_like(x)
+            if reconstruction_guided:
+                noise = _randn_like(x, generator)
                 nonzero_mask = (
                     (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
                 )  # no noise when t == 0
-                sample_t_minus_1 = model_mean + nonzero_mask * th.exp(
-                    0.5 * model_log_variance) * noise
+                sample_t_minus_1 = _sample_from_mean_log_variance(
+                    model_mean, model_log_variance, noise, nonzero_mask)
                 pixelwise_diff_to_obs = (
-                    sample_t_minus_1 - model_kwargs['x_t_minus_1']) * obs_mask
+                    sample_t_minus_1 -
+                    model_kwargs['x_t_minus_1']) * model_kwargs['obs_mask']
                 obs_mismatch = (pixelwise_diff_to_obs**2).sum()
-                obs_mismatch.backward()
-                g = x.grad
-                weighting_factor = 10
-                vdm_alpha_t = _extract_into_tensor(self.alphas, t, x.shape)
-                model_mean = model_mean - weighting_factor * vdm_alpha_t * g / 2
+                # Only the gradient wrt x is needed, not the parameters'.
+                g, = th.autograd.grad(obs_mismatch, x)
+                vdm_alpha_t = self._extract('alphas', t, x.shape)
+                model_mean = (model_mean -
+                              self.guidance_weight * vdm_alpha_t * g / 2)
+                # Release the graph of the model's forward pass.
+                model_mean = model_mean.detach()
+                model_variance = model_variance.detach()
+                model_log_variance = model_log_variance.detach()
+                pred_xstart = pred_xstart.detach()
 
         return {
             'mean': model_mean,
@@ -371,29 +466,53 @@ class GaussianDiffusion:
             'attn': attn_weights,
         }
 
+    def _guided_model_output(self, model, x, t, model_kwargs):
+        """Apply the model for guided sampling (see GuidanceType).
+
+        :return: a tuple (model output, attention weights). Attention weights
+                 are not returned for guided sampling, so the latter is None.
+        """
+        obs_mask = model_kwargs['obs_mask']
+        joint_kwargs = dict(model_kwargs,
+                            obs_mask=th.zeros_like(obs_mask),
+                            latent_mask=obs_mask + model_kwargs['latent_mask'])
+        if self.guidance_type == GuidanceType.RECONSTRUCTION:
+            return model(x, self._scale_timesteps(t), **joint_kwargs)[0], None
+        # Conditional and joint predictions from one forward pass over the
+        # two batches concatenated.
+        B = x.shape[0]
+        batched_kwargs = {
+            k: (th.cat([v, joint_kwargs[k]])
+                if th.is_tensor(v) and v.dim() > 0 and v.shape[0] == B else v)
+            for k, v in model_kwargs.items()
+        }
+        model_output, _ = model(th.cat([x, x]),
+                                self._scale_timesteps(th.cat([t, t])),
+                                **batched_kwargs)
+        cond_output, joint_output = model_output.chunk(2)
+        return (cond_output + self.guidance_weight *
+                (cond_output - joint_output)), None
+
     def _predict_xstart_from_eps(self, x_t, t, eps):
         # x_t(x_0, eps) = sqrt_alphas_cumprod * x_0 + sqrt(1 - alphas_cumprod) * eps
         # => x_0 = x_t - sqrt(1 - alphas_cumprod) * eps / sqrt_alphas_cumprod
         # => x_0 = sqrt_recip_alphas_cumprod * (x_t - sqrt(1 - alphas_cumprod) * eps)
         assert x_t.shape == eps.shape
-        return (_extract_into_tensor(self.sqrt_recip_alphas_cumprod, t,
-                                     x_t.shape) * x_t -
-                _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t,
-                                     x_t.shape) * eps)
+        return _scaled_difference(
+            self._extract('sqrt_recip_alphas_cumprod', t, x_t.shape), x_t,
+            self._extract('sqrt_recipm1_alphas_cumprod', t, x_t.shape), eps)
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
         assert x_t.shape == xprev.shape
-        return (  # (xprev - coef2*x_t) / coef1
-            _extract_into_tensor(1.0 / self.posterior_mean_coef1, t, x_t.shape)
-            * xprev - _extract_into_tensor(
-                self.posterior_mean_coef2 / self.posterior_mean_coef1, t,
-                x_t.shape) * x_t)
+        return _scaled_difference(  # (xprev - coef2*x_t) / coef1
+            self._extract('recip_posterior_mean_coef1', t, x_t.shape), xprev,
+            self._extract('posterior_mean_coef2_over_coef1', t, x_t.shape),
+            x_t)
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
-        return (_extract_into_tensor(self.sqrt_recip_alphas_cumprod, t,
-                                     x_t.shape) * x_t -
-                pred_xstart) / _extract_into_tensor(
-                    self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        return (self._extract('sqrt_recip_alphas_cumprod', t, x_t.shape) * x_t
+                - pred_xstart) / self._extract('sqrt_recipm1_alphas_cumprod',
+                                               t, x_t.shape)
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
@@ -410,6 +529,7 @@ class GaussianDiffusion:
         model_kwargs=None,
         return_attn_weights=False,
         use_gradient_method=False,
+        generator=None,
     ):
         """Sample x_{t-1} from the model at the given timestep.
 
@@ -421,6 +541,8 @@ class GaussianDiffusion:
             x_start prediction before it is used to sample.
         :param model_kwargs: if not None, a dict of extra keyword arguments to
             pass to the model. This can be used for conditioning.
+        :param generator: if specified, the th.Generator to draw the noise
+                          from instead of the global one.
         :return: a dict containing the following keys:
                  - 'sample': a random sample from the model.
                  - 'pred_xstart': a prediction of x_0.
@@ -434,13 +556,15 @@ class GaussianDiffusion:
             model_kwargs=model_kwargs,
             return_attn_weights=return_attn_weights,
             use_gradient_method=use_gradient_method,
+            generator=generator,
         )
-        noise = th.randn_like(x)
+        noise = _randn_like(x, generator)
         nonzero_mask = ((t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
                         )  # no noise when t == 0
-        sample = out['mean'] + nonzero_mask * th.exp(
-            0.5 * out['log_variance']
-        ) * noise  # sample is exact sample from x_{t-1}, out is mean/variance of p(x_{t-1}|x_t).
+        # sample is exact sample from x_{t-1}, out is mean/variance of p(x_{t-1}|x_t).
+        sample = _sample_from_mean_log_variance(out['mean'],
+                                                out['log_variance'], noise,
+                                                nonzero_mask)
         return {
             'sample': sample,
             'pred_xstart': out['pred_xstart'],
@@ -460,6 +584,7 @@ class GaussianDiffusion:
         progress=False,
         return_attn_weights=False,
         use_gradient_method=False,
+        generator=None,
     ):
         """Generate samples from the model.
 
@@ -475,6 +600,9 @@ class GaussianDiffusion:
         :param device: if specified, the device to create the samples on.
                        If not specified, use a model parameter's device.
         :param progress: if True, show a tqdm progress bar.
+        :param generator: if specified, the th.Generator to draw all the
+                          noise from instead of the global one, e.g. to
+                          sample on another thread than training.
         :return: a non-differentiable batch of samples.
         """
         final = None
@@ -492,6 +620,7 @@ class GaussianDiffusion:
                     progress=progress,
                     return_attn_weights=return_attn_weights,
                     use_gradient_method=use_gradient_method,
+                    generator=generator,
                 )):
             if return_attn_weights:
                 t = self.num_timesteps - neg_t - 1
@@ -538,6 +667,7 @@ class GaussianDiffusion:
         progress=False,
         return_attn_weights=False,
         use_gradient_method=False,
+        generator=None,
     ):
         """Generate samples from the model and yield intermediate samples from
         each timestep of diffusion.
@@ -551,7 +681,7 @@ class GaussianDiffusion:
         if noise is not None:
             img = noise
         else:
-            img = th.randn(*shape, device=device)
+            img = th.randn(*shape, device=device, generator=generator)
         indices = list(range(self.num_timesteps))[::-1]
 
         if progress:
@@ -562,24 +692,12 @@ class GaussianDiffusion:
 
         for i in indices:
             t = th.tensor([i] * shape[0], device=device)
-            model_kwargs['x_t_minus_1'] = self.q_sample(
-                model_kwargs['x0'], (t - 1),
-                noise=th.randn_like(model_kwargs['x0'])
-                if noise is None else noise)
-            model_kwargs['random_t'] = th.floor(
-                t * th.rand(t.shape).cuda()).long()
-            model_kwargs['x_random'] = self.q_sample(
-                model_kwargs['x0'],
-                model_kwargs['random_t'].to('cuda'),
-                noise=th.randn_like(model_kwargs['x0'])
-                if noise is None else noise)
-            if 'hybrid' in model_kwargs['observed_frames']:
-                threshold = int(model_kwargs['observed_frames'].split('_')[-1])
-                model_kwargs['hybrid'] = self.q_sample(
-                    model_kwargs['x0'],
-                    th.tensor([threshold] * shape[0], device=device),
-                    noise=th.randn_like(model_kwargs['x0'])
-                    if noise is None else noise)
+            self._set_observed_frames_kwargs(
+                model_kwargs,
+                t,
+                noise=noise,
+                use_gradient_method=use_gradient_method,
+                generator=generator)
             with th.no_grad():
                 out = self.p_sample(
                     model,
@@ -590,10 +708,97 @@ class GaussianDiffusion:
                     model_kwargs=model_kwargs,
                     return_attn_weights=return_attn_weights,
                     use_gradient_method=use_gradient_method,
+                    generator=generator,
                 )
                 yield out
                 img = out['sample']
 
+    def _observed_frames_inputs(self,
+                                x_start,
+                                t,
+                                observed_frames,
+                                obs_mask=None,
+                                noise=None,
+                                need_x_t_minus_1=False,
+                                generator=None):
+        """Compute the noisy versions of the observed frames that the model is
+        conditioned on at timestep t.
+
+        Only the inputs read for the given observed_frames are computed, and
+        only for the observed frames, since the model ignores the others.
+
+        :param x_start: the [N x T x C x ...] tensor of videos.
+        :param t: a 1-D Tensor of timesteps.
+        :param observed_frames: the model's observed_frames argument.
+        :param obs_mask: if specified, the [N x T x 1 x ...] mask of the
+                         observed frames. The inputs are zero elsewhere.
+        :param noise: if specified, the noise to use instead of fresh noise.
+        :param need_x_t_minus_1: if True, also compute 'x_t_minus_1' (which
+                                 reconstruction guidance compares against).
+        :param generator: if specified, the th.Generator to draw fresh noise
+                          from.
+        :return: a dict of model kwargs.
+        """
+        if obs_mask is None:
+            index = None
+        else:
+            index = obs_mask.reshape(obs_mask.shape[:2]).nonzero(as_tuple=True)
+
+        def q_sample_observed(timesteps):
+            if index is None:
+                return self.q_sample(x_start,
+                                     timesteps,
+                                     noise=noise,
+                                     generator=generator)
+            frames = x_start[index]
+            out = th.zeros_like(x_start)
+            out[index] = self.q_sample(
+                frames,
+                timesteps[index[0]],
+                noise=None if noise is None else noise[index],
+                generator=generator)
+            return out
+
+        kwargs = {}
+        if (need_x_t_minus_1 or observed_frames == 'x_t_minus_1'
+                or 'hybrid' in observed_frames):
+            kwargs['x_t_minus_1'] = q_sample_observed(t - 1)
+        if observed_frames == 'x_random':
+            kwargs['random_t'] = th.floor(
+                t *
+                th.rand(t.shape, device=t.device, generator=generator)).long()
+            kwargs['x_random'] = q_sample_observed(kwargs['random_t'])
+        if 'hybrid' in observed_frames:
+            threshold = int(observed_frames.split('_')[-1])
+            kwargs['hybrid'] = q_sample_observed(th.full_like(t, threshold))
+        return kwargs
+
+    def _set_observed_frames_kwargs(self,
+                                    model_kwargs,
+                                    t,
+                                    noise=None,
+                                    use_gradient_method=False,
+                                    generator=None):
+        """Add the noisy versions of the observed frames that the model is
+        conditioned on at timestep t to model_kwargs (in place).
+
+        :param model_kwargs: the model kwargs, containing 'x0' and
+                             'observed_frames'.
+        :param t: a 1-D Tensor of timesteps.
+        :param noise: if specified, the noise to use instead of fresh noise.
+        :param use_gradient_method: if True, always add 'x_t_minus_1'.
+        :param generator: if specified, the th.Generator to draw fresh noise
+                          from.
+        """
+        model_kwargs.update(
+            self._observed_frames_inputs(model_kwargs['x0'],
+                                         t,
+                                         model_kwargs['observed_frames'],
+                                         obs_mask=model_kwargs.get('obs_mask'),
+                                         noise=noise,
+                                         need_x_t_minus_1=use_gradient_method,
+                                         generator=generator))
+
     def ddim_sample(
         self,
         model,
@@ -603,6 +808,7 @@ class GaussianDiffusion:
         denoised_fn=None,
         model_kwargs=None,
         eta=0.0,
+        generator=None,
     ):
         """Sample x_{t-1} from the model using DDIM.
 
@@ -619,13 +825,12 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out['pred_xstart'])
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t,
-                                              x.shape)
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
+        alpha_bar_prev = self._extract('alphas_cumprod_prev', t, x.shape)
         sigma = (eta * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar)) *
                  th.sqrt(1 - alpha_bar / alpha_bar_prev))
         # Equation 12.
-        noise = th.randn_like(x)
+        noise = _randn_like(x, generator)
         mean_pred = (out['pred_xstart'] * th.sqrt(alpha_bar_prev) +
                      th.sqrt(1 - alpha_bar_prev - sigma**2) * eps)
         nonzero_mask = ((t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
@@ -655,11 +860,10 @@ class GaussianDiffusion:
         )
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
-        eps = (_extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape)
-               * x - out['pred_xstart']) / _extract_into_tensor(
-                   self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t,
-                                              x.shape)
+        eps = (self._extract('sqrt_recip_alphas_cumprod', t, x.shape) * x -
+               out['pred_xstart']) / self._extract(
+                   'sqrt_recipm1_alphas_cumprod', t, x.shape)
+        alpha_bar_next = self._extract('alphas_cumprod_next', t, x.shape)
 
         # Equation 12. reversed
         mean_pred = (out['pred_xstart'] * th.sqrt(alpha_bar_next) +
@@ -679,6 +883,7 @@ class GaussianDiffusion:
         device=None,
         progress=False,
         eta=0.0,
+        generator=None,
     ):
         """Generate samples from the model using DDIM.
 
@@ -695,6 +900,7 @@ class GaussianDiffusion:
                 device=device,
                 progress=progress,
                 eta=eta,
+                generator=generator,
         ):
             final = sample
         return final['sample']
@@ -711,6 +917,7 @@ class GaussianDiffusion:
         device=None,
         progress=False,
         eta=0.0,
+        generator=None,
     ):
         """Use DDIM to sample from the model and yield intermediate samples
         from each timestep of DDIM.
@@ -723,7 +930,7 @@ class GaussianDiffusion:
         if noise is not None:
             img = noise
         else:
-            img = th.randn(*shape, device=device)
+            img = th.randn(*shape, device=device, generator=generator)
         indices = list(range(self.num_timesteps))[::-1]
 
         if progress:
@@ -734,6 +941,11 @@ class GaussianDiffusion:
 
         for i in indices:
             t = th.tensor([i] * shape[0], device=device)
+            if model_kwargs is not None and 'observed_frames' in model_kwargs:
+                self._set_observed_frames_kwargs(model_kwargs,
+                                                 t,
+                                                 noise=noise,
+                                                 generator=generator)
             with th.no_grad():
                 out = self.ddim_sample(
                     model,
@@ -743,6 +955,7 @@ class GaussianDiffusion:
                     denoised_fn=denoised_fn,
                     model_kwargs=model_kwargs,
                     eta=eta,
+                    generator=generator,
                 )
                 yield out
                 img = out['sample']
@@ -795,7 +1008,8 @@ class GaussianDiffusion:
                         latent_mask=None,
                         eval_mask=None,
                         obs_mask=None,
-                        noise=None):
+                        noise=None,
+                        target=None):
         """Compute training losses for a single timestep.
 
         :param model: the model to evaluate loss on.
@@ -804,6 +1018,9 @@ class GaussianDiffusion:
         :param model_kwargs: if not None, a dict of extra keyword arguments to
             pass to the model. This can be used for conditioning.
         :param noise: if specified, the specific Gaussian noise to try to remove.
+        :param target: if specified, the model output to regress to in the MSE
+            losses, instead of the one given by x_start and the noise (see
+            distillation_losses()).
         :return: a dict with the key "loss" containing a tensor of shape [N].
                  Some mean or variance settings may also have other keys.
         """
@@ -811,24 +1028,15 @@ class GaussianDiffusion:
             model_kwargs = {}
         if noise is None:
             noise = th.randn_like(x_start)
-        model_kwargs['x_t_minus_1'] = self.q_sample(x_start, (t - 1),
-                                                    noise=noise)
-        model_kwargs['random_t'] = th.floor(t * th.rand(t.shape).cuda()).long()
-        model_kwargs['x_random'] = self.q_sample(x_start,
-                                                 model_kwargs['random_t'],
-                                                 noise=noise)
-        if 'hybrid' in model_kwargs['observed_frames']:
-            threshold = int(model_kwargs['observed_frames'].split('_')[-1])
-            model_kwargs['hybrid'] = self.q_sample(x_start,
-                                                   th.tensor([threshold] *
-                                                             t.shape[0],
-                                                             device='cuda'),
-                                                   noise=noise)
-        else:
-            model_kwargs['hybrid'] = model_kwargs['x_t_minus_1']  # placeholder
+        if 'observed_frames' in model_kwargs:
+            model_kwargs.update(
+                self._observed_frames_inputs(x_start,
+                                             t,
+                                             model_kwargs['observed_frames'],
+                                             obs_mask=model_kwargs.get(
+                                                 'obs_mask', obs_mask),
+                                             noise=noise))
         x_t = self.q_sample(x_start, t, noise=noise)
-        x_t_in = x_t.detach().requires_grad_(True)
-        x_t_in.retain_grad()
 
         terms = {}
         if self.loss_type == LossType.KL or self.loss_type == LossType.RESCALED_KL:
@@ -843,10 +1051,9 @@ class GaussianDiffusion:
             if self.loss_type == LossType.RESCALED_KL:
                 terms['loss'] *= self.num_timesteps
         elif self.loss_type == LossType.MSE or self.loss_type == LossType.RESCALED_MSE:
-            model_output, _ = model(x_t_in,
+            model_output, _ = model(x_t,
                                     timesteps=self._scale_timesteps(t),
                                     **model_kwargs)
-            # model_output, _ = model(x_t, timesteps=self._scale_timesteps(t), **model_kwargs)
 
             if self.model_var_type in [
                     ModelVarType.LEARNED,
@@ -873,26 +1080,18 @@ class GaussianDiffusion:
                     # Without a factor of 1/1000, the VB term hurts the MSE term.
                     terms['vb'] *= self.num_timesteps / 1000.0
 
-            target = {
-                ModelMeanType.PREVIOUS_X:
-                self.q_posterior_mean_variance(x_start=x_start, x_t=x_t,
-                                               t=t)[0],
-                ModelMeanType.START_X:
-                x_start,
-                ModelMeanType.EPSILON:
-                noise,
-            }[self.model_mean_type]
+            if target is None:
+                target = {
+                    ModelMeanType.PREVIOUS_X:
+                    self.q_posterior_mean_variance(x_start=x_start,
+                                                   x_t=x_t,
+                                                   t=t)[0],
+                    ModelMeanType.START_X:
+                    x_start,
+                    ModelMeanType.EPSILON:
+                    noise,
+                }[self.model_mean_type]
             assert model_output.shape == target.shape == x_start.shape
-            # terms['obs-mse'] = mean_flat((target - model_output)**2,
-            #                              mask=obs_mask)
-            # grad = th.stack([
-            #     th.autograd.grad(
-            #         terms['obs-mse'][idx], x_t_in, retain_graph=True)[0][idx] *
-            #     obs_mask for idx in range(x_t_in.shape[0])
-            # ])
-            # self.omega = 50
-            # model_output = model_output - self.omega / 2 * _extract_into_tensor(
-            #   self.alphas, t, grad.shape) * grad
             terms['mse'] = mean_flat((target - model_output)**2,
                                      mask=latent_mask)
             terms['eval-mse'] = mean_flat((target - model_output)**2,
@@ -906,6 +1105,95 @@ class GaussianDiffusion:
 
         return terms
 
+    def distillation_losses(self,
+                            model,
+                            x_start,
+                            t,
+                            model_kwargs=None,
+                            latent_mask=None,
+                            eval_mask=None,
+                            obs_mask=None,
+                            noise=None,
+                            *,
+                            teacher,
+                            teacher_diffusion):
+        """Compute the progressive distillation losses (Salimans & Ho,
+        "Progressive Distillation for Fast Sampling of Diffusion Models",
+        2022) for a single timestep.
+
+        The model (the student) learns to take in one DDIM step what the
+        teacher takes two DDIM steps of teacher_diffusion for. Timestep t of
+        this diffusion must be timestep 2 * t + 1 of teacher_diffusion, and
+        timestep t - 1 (or the data, for t = 0) its timestep 2 * t - 1, as
+        for the "distillK" respacings (see respace.space_timesteps()).
+
+        The student regresses to the output that makes its DDIM step from x_t
+        land where the teacher's two steps do, with the MSE loss on the x_0
+        predictions weighted by max(SNR, 1) (the paper's "truncated SNR"
+        weighting), expressed in the units of the model's output.
+
+        Same usage as training_losses(), with:
+        :param teacher: the teacher model, which is not trained.
+        :param teacher_diffusion: the diffusion the teacher samples with.
+        :return: a dict of losses as for training_losses(), where "mse" is
+                 weighted and "eval-mse" is not.
+        """
+        assert self.loss_type in (LossType.MSE, LossType.RESCALED_MSE)
+        assert self.model_mean_type in (ModelMeanType.EPSILON,
+                                        ModelMeanType.START_X)
+        if model_kwargs is None:
+            model_kwargs = {}
+        if noise is None:
+            noise = th.randn_like(x_start)
+        x_t = self.q_sample(x_start, t, noise=noise)
+
+        # Two deterministic DDIM steps of the teacher from x_t.
+        x = x_t
+        for teacher_t in [2 * t + 1, 2 * t]:
+            teacher_kwargs = dict(model_kwargs)
+            if 'observed_frames' in teacher_kwargs:
+                teacher_diffusion._set_observed_frames_kwargs(teacher_kwargs,
+                                                              teacher_t,
+                                                              noise=noise)
+            with th.no_grad():
+                x = teacher_diffusion.ddim_sample(
+                    teacher, x, teacher_t,
+                    model_kwargs=teacher_kwargs)['sample']
+
+        # The x_0 for which the student's DDIM step from x_t gives x:
+        # x = alpha_prev * x_0 + sigma_prev / sigma * (x_t - alpha * x_0).
+        alpha_bar = self._extract('alphas_cumprod', t, x_t.shape)
+        alpha_bar_prev = self._extract('alphas_cumprod_prev', t, x_t.shape)
+        sigma_ratio = th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
+        target_xstart = (
+            (x - sigma_ratio * x_t) /
+            (th.sqrt(alpha_bar_prev) - sigma_ratio * th.sqrt(alpha_bar)))
+        alpha_bar = self._extract('alphas_cumprod', t, t.shape)
+        snr = alpha_bar / (1 - alpha_bar)
+        if self.model_mean_type == ModelMeanType.EPSILON:
+            target = self._predict_eps_from_xstart(x_t, t, target_xstart)
+            # The error on x_0 is the error on epsilon over sqrt(SNR).
+            weight = th.clamp(snr, min=1.0) / snr
+        else:
+            target = target_xstart
+            weight = th.clamp(snr, min=1.0)
+
+        terms = self.training_losses(model,
+                                     x_start,
+                                     t,
+                                     model_kwargs=model_kwargs,
+                                     latent_mask=latent_mask,
+                                     eval_mask=eval_mask,
+                                     obs_mask=obs_mask,
+                                     noise=noise,
+                                     target=target)
+        terms['mse'] = weight * terms['mse']
+        if 'vb' in terms:
+            terms['loss'] = terms['mse'] + terms['vb']
+        else:
+            terms['loss'] = terms['mse']
+        return terms
+
     def _prior_bpd(self, x_start, latent_mask=None):
         """Get the prior KL term for the variational lower-bound, measured in
         bits-per-dim.
@@ -931,15 +1219,31 @@ class GaussianDiffusion:
                                  clip_denoised=True,
                                  model_kwargs=None,
                                  latent_mask=None,
-                                 t_seq=None):
+                                 t_seq=None,
+                                 noise=None,
+                                 timesteps_per_call=1,
+                                 memory_budget_gb=None):
         """Compute the entire variational lower-bound, measured in bits-per-
         dim, as well as other related quantities.
 
+        Several timesteps can be evaluated in each model call, by tiling the
+        batch along the batch dimension, with a different timestep in each
+        tile.
+
         :param model: the model to evaluate loss on.
         :param x_start: the [N x C x ...] tensor of inputs.
         :param clip_denoised: if True, clip denoised samples.
         :param model_kwargs: if not None, a dict of extra keyword arguments to
             pass to the model. This can be used for conditioning.
+        :param noise: if specified, a [len(t_seq) x N x C x ...] tensor of the
+                      noise to use at each timestep, instead of fresh noise.
+        :param timesteps_per_call: the number of timesteps to evaluate in each
+                                   model call.
+        :param memory_budget_gb: if specified (and x_start is on a CUDA
+                                 device), choose the number of timesteps per
+                                 call so that a call takes at most this much
+                                 device memory, measured on the first call
+                                 (which uses timesteps_per_call timesteps).
 
         :return: a dict containing the following keys:
                  - total_bpd: the total variational lower-bound, per batch element.
@@ -952,44 +1256,83 @@ class GaussianDiffusion:
         batch_size = x_start.shape[0]
         if t_seq is None:
             t_seq = list(range(self.num_timesteps))[::-1]
+        if model_kwargs is None:
+            model_kwargs = {}
 
-        vb = []
-        xstart_mse = []
-        mse = []
         # A hacky way to handle computing bpd with a random subset of the timesteps,
         # where each row of t_seq is timesteps to one batch item.
-        is_2d_t_seq = False
         if isinstance(t_seq, np.ndarray) and t_seq.ndim == 2:
-            is_2d_t_seq = True
-            t_seq = t_seq.transpose()
-        for t in t_seq:
-            if is_2d_t_seq:
-                t_batch = th.tensor(t, device=device)
+            all_t = th.as_tensor(t_seq.transpose(), device=device)
+        else:
+            all_t = th.as_tensor(np.asarray(t_seq), device=device)
+            all_t = all_t[:, None].expand(-1, batch_size)
+        n_timesteps = all_t.shape[0]
+        vb = th.empty(batch_size, n_timesteps, device=device)
+        xstart_mse = th.empty_like(vb)
+        mse = th.empty_like(vb)
+
+        measure_memory = memory_budget_gb is not None and device.type == 'cuda'
+        i = 0
+        while i < n_timesteps:
+            n = min(timesteps_per_call, n_timesteps - i)
+            if measure_memory:
+                th.cuda.synchronize(device)
+                th.cuda.reset_peak_memory_stats(device)
+                memory_before = th.cuda.memory_allocated(device)
+
+            def tile(x):
+                return x.repeat(n, *([1] * (x.dim() - 1)))
+
+            t_batch = all_t[i:i + n].reshape(-1)
+            x_start_tiled = tile(x_start)
+            if noise is None:
+                step_noise = th.randn_like(x_start_tiled)
             else:
-                t_batch = th.tensor([t] * batch_size, device=device)
-            noise = th.randn_like(x_start)
-            x_t = self.q_sample(x_start=x_start, t=t_batch, noise=noise)
-            # Calculate VLB term at the current timestep
+                step_noise = noise[i:i + n].to(device).reshape(
+                    x_start_tiled.shape)
+            x_t = self.q_sample(x_start=x_start_tiled,
+                                t=t_batch,
+                                noise=step_noise)
+            tiled_kwargs = {
+                k: (tile(v) if th.is_tensor(v) and v.dim() > 0
+                    and v.shape[0] == batch_size else v)
+                for k, v in model_kwargs.items()
+            }
+            if 'observed_frames' in tiled_kwargs:
+                self._set_observed_frames_kwargs(tiled_kwargs,
+                                                 t_batch,
+                                                 noise=step_noise)
+            tiled_latent_mask = (None
+                                 if latent_mask is None else tile(latent_mask))
+            # Calculate VLB terms at the current timesteps
             with th.no_grad():
                 out = self._vb_terms_bpd(
                     model,
-                    x_start=x_start,
+                    x_start=x_start_tiled,
                     x_t=x_t,
                     t=t_batch,
                     clip_denoised=clip_denoised,
-                    model_kwargs=model_kwargs,
-                    latent_mask=latent_mask,
+                    model_kwargs=tiled_kwargs,
+                    latent_mask=tiled_latent_mask,
                 )
-            vb.append(out['output'])
-            xstart_mse.append(
-                mean_flat((out['pred_xstart'] - x_start)**2, mask=latent_mask))
             eps = self._predict_eps_from_xstart(x_t, t_batch,
                                                 out['pred_xstart'])
-            mse.append(mean_flat((eps - noise)**2, mask=latent_mask))
-
-        vb = th.stack(vb, dim=1)
-        xstart_mse = th.stack(xstart_mse, dim=1)
-        mse = th.stack(mse, dim=1)
+            # Results are [n x N] (timestep-major, as tiled).
+            vb[:, i:i + n] = out['output'].view(n, batch_size).t()
+            xstart_mse[:, i:i + n] = mean_flat(
+                (out['pred_xstart'] - x_start_tiled)**2,
+                mask=tiled_latent_mask).view(n, batch_size).t()
+            mse[:, i:i + n] = mean_flat(
+                (eps - step_noise)**2,
+                mask=tiled_latent_mask).view(n, batch_size).t()
+            i += n
+
+            if measure_memory:
+                peak_gb = (th.cuda.max_memory_allocated(device) -
+                           memory_before) / 2**30
+                timesteps_per_call = max(
+                    1, int(memory_budget_gb * n / max(peak_gb, 1e-9)))
+                measure_memory = False
 
         prior_bpd = self._prior_bpd(x_start, latent_mask=latent_mask)
         total_bpd = vb.sum(dim=1) + prior_bpd
@@ -1001,6 +1344,132 @@ class GaussianDiffusion:
             'mse': mse,
         }
 
+    def calc_bpd_importance_sampled(self,
+                                    model,
+                                    x_start,
+                                    schedule_sampler,
+                                    clip_denoised=True,
+                                    model_kwargs=None,
+                                    latent_mask=None,
+                                    tolerance=None,
+                                    confidence=0.95,
+                                    samples_per_round=10,
+                                    max_samples=1000,
+                                    **loop_kwargs):
+        """Estimate the variational lower-bound, measured in bits-per-dim, from
+        a sample of the timesteps.
+
+        The prior and decoder (t = 0) terms are computed exactly. The sum of
+        the other terms is estimated by importance sampling the timesteps from
+        the distribution given by schedule_sampler.weights(), which is
+        unbiased for any proposal and has the least variance when the weights
+        are proportional to the root mean square of each term (as in
+        resample.LossSecondMomentResampler). The terms computed are passed to
+        schedule_sampler.update_with_all_losses() (if it has it), so that a
+        loss-aware proposal adapts to the model as the evaluation goes on.
+
+        Timesteps are sampled in rounds, until the confidence interval of the
+        estimate of each batch element is within tolerance of the estimate,
+        or max_samples timesteps have been evaluated.
+
+        :param model: the model to evaluate loss on.
+        :param x_start: the [N x C x ...] tensor of inputs.
+        :param schedule_sampler: the proposal, a resample.ScheduleSampler.
+        :param clip_denoised: if True, clip denoised samples.
+        :param model_kwargs: if not None, a dict of extra keyword arguments to
+            pass to the model. This can be used for conditioning.
+        :param tolerance: the half-width of the confidence intervals to stop
+                          at. If None, always evaluate max_samples timesteps.
+        :param confidence: the confidence level of the intervals.
+        :param samples_per_round: the number of timesteps evaluated for each
+                                  batch element in each round (at least 2).
+        :param max_samples: the maximum number of timesteps to evaluate for
+                            each batch element.
+        :param loop_kwargs: passed on to calc_bpd_loop_subsampled() (e.g.
+                            timesteps_per_call).
+
+        :return: a dict containing the following keys, each of shape [N]:
+                 - total_bpd: the estimate of the variational lower-bound.
+                 - total_bpd_stderr: its standard error.
+                 - total_bpd_ci: the half-width of its confidence interval.
+                 - prior_bpd: the prior term in the lower-bound.
+                 - decoder_bpd: the decoder (t = 0) term in the lower-bound.
+                 - num_timesteps: the number of timesteps sampled.
+        """
+        assert samples_per_round >= 2
+        if model_kwargs is None:
+            model_kwargs = {}
+        device = x_start.device
+        batch_size = x_start.shape[0]
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+        def select(v, index):
+            if (th.is_tensor(v) and v.dim() > 0 and v.shape[0] == batch_size):
+                return v[index]
+            return v
+
+        exact = self.calc_bpd_loop_subsampled(model,
+                                              x_start,
+                                              clip_denoised=clip_denoised,
+                                              model_kwargs=model_kwargs,
+                                              latent_mask=latent_mask,
+                                              t_seq=[0],
+                                              **loop_kwargs)
+        decoder_bpd = exact['vb'][:, 0]
+        update = getattr(schedule_sampler, 'update_with_all_losses', None)
+        if update is not None:
+            update(th.zeros(batch_size, dtype=th.long, device=device),
+                   decoder_bpd)
+
+        # Running sums of the importance-weighted terms and their squares.
+        sums = th.zeros(batch_size, dtype=th.float64, device=device)
+        sums_sq = th.zeros_like(sums)
+        counts = th.zeros(batch_size, dtype=th.long, device=device)
+        active = th.arange(batch_size, device=device)
+        while len(active) > 0:
+            weights = schedule_sampler.weights()[1:]
+            p = weights / np.sum(weights)
+            ts = np.random.choice(
+                len(p), size=(len(active), samples_per_round), p=p) + 1
+            vb = self.calc_bpd_loop_subsampled(
+                model,
+                x_start[active],
+                clip_denoised=clip_denoised,
+                model_kwargs={
+                    k: select(v, active)
+                    for k, v in model_kwargs.items()
+                },
+                latent_mask=select(latent_mask, active),
+                t_seq=ts,
+                **loop_kwargs)['vb']
+            if update is not None:
+                update(th.as_tensor(ts, device=device).view(-1), vb.view(-1))
+            y = vb.double() / th.as_tensor(p[ts - 1], device=device)
+            sums[active] += y.sum(dim=1)
+            sums_sq[active] += (y**2).sum(dim=1)
+            counts[active] += samples_per_round
+
+            n = counts[active].double()
+            mean = sums[active] / n
+            var = ((sums_sq[active] - n * mean**2) / (n - 1)).clamp(min=0)
+            done = counts[active] >= max_samples
+            if tolerance is not None:
+                done |= z * (var / n).sqrt() <= tolerance
+            active = active[~done]
+
+        n = counts.double()
+        mean = sums / n
+        stderr = ((sums_sq - n * mean**2) /
+                  (n - 1)).clamp(min=0).sqrt() / n.sqrt()
+        return {
+            'total_bpd': (exact['prior_bpd'] + decoder_bpd + mean).float(),
+            'total_bpd_stderr': stderr.float(),
+            'total_bpd_ci': (z * stderr).float(),
+            'prior_bpd': exact['prior_bpd'],
+            'decoder_bpd': decoder_bpd,
+            'num_timesteps': counts,
+        }
+
     def calc_bpd_loop(self,
                       model,
                       x_start,
@@ -1016,16 +1485,65 @@ class GaussianDiffusion:
             t_seq=list(range(self.num_timesteps))[::-1])
 
 
+@contextlib.contextmanager
+def _gradient_checkpointing(model):
+    """Turn on gradient checkpointing in all blocks of the model that support
+    it, for the duration of the context."""
+    while not isinstance(model, th.nn.Module):
+        model = model.model  # unwrap respace._WrappedModel
+    modules = [
+        m for m in model.modules()
+        if getattr(m, 'use_checkpoint', True) is False
+    ]
+    for m in modules:
+        m.use_checkpoint = True
+    try:
+        yield
+    finally:
+        for m in modules:
+            m.use_checkpoint = False
+
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """Extract values from a 1-D numpy array for a batch of indices.
 
-    :param arr: the 1-D numpy array.
+    :param arr: the 1-D numpy array, or a 1-D tensor on timesteps' device.
     :param timesteps: a tensor of indices into the array to extract.
     :param broadcast_shape: a larger shape of K dimensions with the batch
                             dimension equal to the length of timesteps.
     :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
     """
-    res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
+    if not th.is_tensor(arr):
+        arr = th.from_numpy(arr).to(device=timesteps.device)
+    res = arr[timesteps].float()
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
     return res.expand(broadcast_shape)
+
+
+def _randn_like(x, generator=None):
+    """th.randn_like(x), drawn from the given th.Generator if there is
+    one."""
+    if generator is None:
+        return th.randn_like(x)
+    return th.randn(x.shape,
+                    dtype=x.dtype,
+                    device=x.device,
+                    generator=generator)
+
+
+# The elementwise updates of each sampling step. addcmul does the last
+# multiply-add in place of a multiplication and an addition, so each update
+# takes one kernel fewer.
+
+
+def _sample_from_mean_log_variance(mean, log_variance, noise, nonzero_mask):
+    return th.addcmul(mean, nonzero_mask * th.exp(0.5 * log_variance), noise)
+
+
+def _linear_combination(a, x, b, y):
+    return th.addcmul(a * x, b, y)
+
+
+def _scaled_difference(a, x, b, y):
+    return th.addcmul(a * x, b, y, value=-1)
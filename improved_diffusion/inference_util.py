@@ -1,9 +1,15 @@
+import hashlib
+import json
+import os
 import time
+from pathlib import Path
 
 import lpips as lpips_metric
 import numpy as np
 import torch
 
+from . import dpm_solver
+
 
 def not_spatial_average(in_tens, keepdim=True):
     B, C, H, W = in_tens.shape
@@ -31,6 +37,100 @@ class LpipsEmbedder(lpips_metric.LPIPS):
         return torch.cat(res, dim=1)
 
 
+class VideoCanvas:
+    """The videos being sampled, as a BxTxCxHxW tensor kept on the sampling
+    device for the whole inference. Each inference stage reads its frames
+    with an index_select and writes the generated ones back with an
+    index_copy_, so the videos only go to host memory once, at the end.
+
+    Videos too large for the device are kept in (pinned) host memory
+    instead, and only the frames of each stage are moved to the device.
+
+    Args:
+        shape (tuple): Shape of the videos (BxTxCxHxW).
+        device (torch.device): The sampling device.
+        dtype (torch.dtype): Data type of the videos.
+        max_device_gb (float): Largest size (in GB) of videos to keep on the
+            device. Defaults to half of the free memory of a CUDA device,
+            and to no limit on other devices.
+    """
+    def __init__(self, shape, device, dtype=torch.float32, max_device_gb=None):
+        self.device = torch.device(device)
+        n_bytes = np.prod(shape) * torch.empty(0, dtype=dtype).element_size()
+        if max_device_gb is not None:
+            max_device_bytes = max_device_gb * 2**30
+        elif self.device.type == 'cuda':
+            max_device_bytes = torch.cuda.mem_get_info(self.device)[0] / 2
+        else:
+            max_device_bytes = np.inf
+        self.on_device = n_bytes <= max_device_bytes
+        if self.on_device:
+            self.videos = torch.zeros(shape, dtype=dtype, device=self.device)
+        else:
+            self.videos = torch.zeros(shape,
+                                      dtype=dtype,
+                                      pin_memory=self.device.type == 'cuda')
+        self._batch_index = torch.arange(shape[0],
+                                         device=self.videos.device)[:, None]
+
+    def _indices(self, frame_indices):
+        """Frame indices as a long tensor next to the videos. Of shape K if
+        the indices are shared by all the videos, or BxK if given per video."""
+        return torch.as_tensor(frame_indices,
+                               dtype=torch.long,
+                               device=self.videos.device)
+
+    def read(self, frame_indices):
+        """Returns the given frames of the videos, on the sampling device."""
+        idx = self._indices(frame_indices)
+        if idx.dim() == 1:
+            frames = self.videos.index_select(1, idx)
+        else:
+            frames = self.videos[self._batch_index, idx]
+        return frames.to(self.device, non_blocking=True)
+
+    def write(self, frame_indices, frames):
+        """Writes frames (BxKxCxHxW) to the given frame indices."""
+        idx = self._indices(frame_indices)
+        frames = frames.to(self.videos.device, dtype=self.videos.dtype)
+        if idx.dim() == 1:
+            self.videos.index_copy_(1, idx, frames)
+        else:
+            self.videos[self._batch_index, idx] = frames
+
+    def read_stage(self, obs_frame_indices, latent_frame_indices):
+        """Returns the network input of an inference stage (the observed
+        frames followed by the latent ones) and its BxK frame indices, both
+        on the sampling device."""
+        frame_indices = torch.cat([
+            self._indices(obs_frame_indices),
+            self._indices(latent_frame_indices)
+        ],
+                                  dim=-1)
+        x0 = self.read(frame_indices)
+        frame_indices = frame_indices.to(self.device, non_blocking=True)
+        if frame_indices.dim() == 1:
+            frame_indices = frame_indices.repeat((len(x0), 1))
+        return x0, frame_indices
+
+    def numpy(self):
+        return self.videos.cpu().numpy()
+
+
+_lpips_embedders = {}
+
+
+def get_lpips_embedder(device):
+    """Returns an LpipsEmbedder on the given device, creating it on first
+    use."""
+    device = torch.device(device)
+    if device not in _lpips_embedders:
+        net = LpipsEmbedder(net='alex', spatial=False).to(device).eval()
+        net.requires_grad_(False)
+        _lpips_embedders[device] = net
+    return _lpips_embedders[device]
+
+
 class InferenceStrategyBase:
     """Inference strategies."""
     def __init__(
@@ -129,6 +229,12 @@ class InferenceStrategyBase:
     def next_indices(self):
         raise NotImplementedError
 
+    @property
+    def stage_level(self):
+        """The level of the last stage returned, for strategies that work in
+        levels of increasingly fine detail (1 is the coarsest)."""
+        return 1
+
     @property
     def typename(self):
         return type(self).__name__
@@ -140,48 +246,69 @@ class AdaptiveInferenceStrategyBase(InferenceStrategyBase):
         self.distance = distance
 
     def embed(self, indices):
-        if self.distance == 'l2':
-            embs = [self.videos[:, i] for i in indices]
-        elif self.distance == 'lpips':
-            net = LpipsEmbedder(net='alex',
-                                spatial=False).to(self.videos.device)
-            embs = [net(self.videos[:, i]) for i in indices]
-        else:
-            raise NotImplementedError
-        return torch.stack(embs, dim=1)
+        """Returns the embeddings (BxFxD) of the given frames of the videos.
 
-    def set_videos(self, videos):
+        Frames are embedded once, when they are first asked for, and their
+        embeddings are cached for the following stages. This relies on the
+        frames not changing once generated; set_videos with a different
+        tensor clears the cache.
+        """
+        missing = [i for i in dict.fromkeys(indices) if i not in self._embs]
+        if len(missing) > 0:
+            frames = self.videos[:, missing].to(self.device)
+            B, F = frames.shape[:2]
+            frames = frames.flatten(0, 1)
+            if self.distance == 'l2':
+                embs = frames
+            elif self.distance == 'lpips':
+                embs = get_lpips_embedder(self.device)(frames)
+            else:
+                raise NotImplementedError
+            embs = embs.reshape(B, F, -1)
+            for f, i in enumerate(missing):
+                self._embs[i] = embs[:, f]
+        return torch.stack([self._embs[i] for i in indices], dim=1)
+
+    def set_videos(self, videos, device=None):
+        """Sets the videos to choose the observed frames from. If device is
+        given, the frames are embedded on it, so the videos themselves can
+        stay in host memory."""
+        if videos is not getattr(self, 'videos', None):
+            self._embs = {}
         self.videos = videos
+        self.device = videos.device if device is None else device
 
+    @torch.no_grad()
     def select_obs_indices(self,
                            possible_next_indices,
                            n,
                            always_selected=(0, )):
-        B = len(self.videos)
+        """Greedy farthest-point selection of n frames among
+        possible_next_indices, for all the videos at once. Starts from the
+        frames at the positions always_selected (in possible_next_indices),
+        then repeatedly adds the frame farthest from the selected ones."""
         embs = self.embed(possible_next_indices)
-        batch_selected_indices = []
-        for b in range(B):
-            min_distances_from_selected = [
-                np.inf for _ in possible_next_indices
-            ]
-            selected_indices = [possible_next_indices[always_selected[0]]]
-            selected_embs = [embs[b, always_selected[0]]
-                             ]  # always begin with next possible index
-            for i in range(1, n):
-                # update min_distances_from_selected
-                for f, dist in enumerate(min_distances_from_selected):
-                    dist_to_newest = (((selected_embs[-1] -
-                                        embs[b][f])**2).sum().cpu().item())
-                    min_distances_from_selected[f] = min(dist, dist_to_newest)
-                if i < len(always_selected):
-                    best_index = always_selected[i]
-                else:
-                    # select one with maximum min_distance_from_selected
-                    best_index = np.argmax(min_distances_from_selected)
-                selected_indices.append(possible_next_indices[best_index])
-                selected_embs.append(embs[b, best_index])
-            batch_selected_indices.append(selected_indices)
-        return batch_selected_indices
+        B = len(embs)
+        batch_idx = torch.arange(B, device=embs.device)
+        selected = torch.empty((B, n), dtype=torch.long, device=embs.device)
+        selected[:, 0] = always_selected[0]
+        newest = embs[:, always_selected[0]]
+        min_distances_from_selected = torch.full(embs.shape[:2],
+                                                 np.inf,
+                                                 device=embs.device)
+        for i in range(1, n):
+            # update min_distances_from_selected
+            dist_to_newest = ((newest[:, None] - embs)**2).sum(dim=-1)
+            min_distances_from_selected = torch.minimum(
+                min_distances_from_selected, dist_to_newest)
+            if i < len(always_selected):
+                selected[:, i] = always_selected[i]
+            else:
+                # select one with maximum min_distance_from_selected
+                selected[:, i] = min_distances_from_selected.argmax(dim=1)
+            newest = embs[batch_idx, selected[:, i]]
+        possible_next_indices = np.array(possible_next_indices)
+        return possible_next_indices[selected.cpu().numpy()].tolist()
 
     def __next__(self):
         if self._num_obs == 0 and self._current_step == 0:
@@ -417,6 +544,10 @@ class HierarchyNLevel(InferenceStrategyBase):
 
         return obs_frame_indices, latent_frame_indices
 
+    @property
+    def stage_level(self):
+        return self.current_level
+
     @property
     def typename(self):
         return f'{super().typename}-{self.N}'
@@ -797,3 +928,401 @@ inference_strategies = {
     'google': Google,
     'like-google': LikeGoogle,
 }
+
+
+def is_adaptive(mode):
+    """Whether the inference strategy chooses its frames based on the videos
+    being sampled."""
+    return issubclass(inference_strategies[mode],
+                      AdaptiveInferenceStrategyBase)
+
+
+class InferencePlan:
+    """The precomputed schedule of a deterministic inference strategy.
+
+    Iterating over a plan yields the same (observed, latent) frame indices
+    as the strategy, but from arrays instead of recomputing them:
+    obs_indices and latent_indices are (number of stages) x (largest number
+    of frames in a stage) arrays padded with -1, and n_obs and n_latent
+    give the number of frames of each stage.
+
+    Args:
+        obs_indices (np.ndarray): Padded observed frame indices.
+        n_obs (np.ndarray): Number of observed frames of each stage.
+        latent_indices (np.ndarray): Padded latent frame indices.
+        n_latent (np.ndarray): Number of latent frames of each stage.
+        initial_done (np.ndarray): Frames that are available before the
+            first stage (the observed frames, and the goal frames of
+            goal-directed strategies).
+        tags (np.ndarray): A string for each stage. For the Google strategy,
+            the name of the model used in the stage ('fs4' or 'fs1').
+        max_frames (int): Maximum number of frames in a stage.
+        levels (np.ndarray): The stage_level of the strategy at each stage.
+    """
+    def __init__(self,
+                 obs_indices,
+                 n_obs,
+                 latent_indices,
+                 n_latent,
+                 initial_done,
+                 tags,
+                 max_frames,
+                 levels=None):
+        self.obs_indices = obs_indices
+        self.n_obs = n_obs
+        self.latent_indices = latent_indices
+        self.n_latent = n_latent
+        self.initial_done = initial_done
+        self.tags = tags
+        self.max_frames = int(max_frames)
+        self.levels = (np.ones(len(n_obs), dtype=np.int64)
+                       if levels is None else levels)
+
+    @staticmethod
+    def _pad(index_lists):
+        lengths = np.array([len(indices) for indices in index_lists],
+                           dtype=np.int64)
+        padded = np.full((len(index_lists), max(lengths, default=0)),
+                         -1,
+                         dtype=np.int64)
+        for i, indices in enumerate(index_lists):
+            padded[i, :len(indices)] = indices
+        return padded, lengths
+
+    @classmethod
+    def compile(cls, strategy):
+        """Runs a (non-adaptive) inference strategy to the end and records
+        its stages."""
+        initial_done = np.array(sorted(strategy._done_frames), dtype=np.int64)
+        obs, latent, tags, levels = [], [], [], []
+        for obs_frame_indices, latent_frame_indices in iter(strategy):
+            obs.append([int(i) for i in obs_frame_indices])
+            latent.append([int(i) for i in latent_frame_indices])
+            tags.append(str(getattr(strategy, '_active_iterator', '')))
+            levels.append(strategy.stage_level)
+        obs_indices, n_obs = cls._pad(obs)
+        latent_indices, n_latent = cls._pad(latent)
+        return cls(obs_indices, n_obs, latent_indices, n_latent, initial_done,
+                   np.array(tags), strategy._max_frames,
+                   np.array(levels, dtype=np.int64))
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so that processes loading the plan
+        # concurrently never see a partial file.
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp.npz')
+        np.savez(tmp_path,
+                 obs_indices=self.obs_indices,
+                 n_obs=self.n_obs,
+                 latent_indices=self.latent_indices,
+                 n_latent=self.n_latent,
+                 initial_done=self.initial_done,
+                 tags=self.tags,
+                 max_frames=self.max_frames,
+                 levels=self.levels)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(**{k: f[k] for k in f.files})
+
+    def __len__(self):
+        return len(self.n_obs)
+
+    def __getitem__(self, stage):
+        """Returns the (observed, latent) frame indices of a stage, as
+        lists."""
+        return (self.obs_indices[stage, :self.n_obs[stage]].tolist(),
+                self.latent_indices[stage, :self.n_latent[stage]].tolist())
+
+    def __iter__(self):
+        return _PlanIterator(self)
+
+    def done_frames(self, stage):
+        """Returns the set of frames that are available after the given
+        stage."""
+        return set(self.initial_done.tolist()).union(*(self[i][1]
+                                                       for i in range(stage +
+                                                                      1)))
+
+    def to_tensors(self, device):
+        """Returns the padded index arrays and their masks as tensors on the
+        given device."""
+        obs_indices = torch.as_tensor(self.obs_indices, device=device)
+        latent_indices = torch.as_tensor(self.latent_indices, device=device)
+        return dict(obs_indices=obs_indices,
+                    obs_mask=obs_indices >= 0,
+                    latent_indices=latent_indices,
+                    latent_mask=latent_indices >= 0)
+
+
+class _PlanIterator:
+    """Iterates over the stages of an InferencePlan, exposing the level of
+    the current stage like an inference strategy does."""
+    def __init__(self, plan):
+        self.plan = plan
+        self.stage = -1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stage + 1 >= len(self.plan):
+            raise StopIteration
+        self.stage += 1
+        return self.plan[self.stage]
+
+    @property
+    def stage_level(self):
+        return int(self.plan.levels[self.stage])
+
+
+_inference_plans = {}
+
+
+def get_inference_plan(mode,
+                       video_length,
+                       num_obs,
+                       max_frames=None,
+                       step_size=None,
+                       optimal_schedule_path=None,
+                       cache_dir=None):
+    """Returns the InferencePlan of a non-adaptive inference strategy.
+
+    Plans are compiled once and cached on disk (in cache_dir, or in the
+    INFERENCE_PLAN_CACHE environment variable, defaulting to
+    .inference_plans), keyed by the strategy, its parameters and the
+    contents of the optimal schedule file, if any.
+    """
+    if is_adaptive(mode):
+        raise ValueError(
+            f'Adaptive inference strategy {mode} cannot be precompiled.')
+    strategy_kwargs = dict(video_length=video_length, num_obs=num_obs)
+    if max_frames is not None:
+        strategy_kwargs['max_frames'] = max_frames
+    if step_size is not None:
+        strategy_kwargs['step_size'] = step_size
+    # The version changes whenever the contents of the plans do.
+    key = dict(mode=mode, version=2, **strategy_kwargs)
+    if optimal_schedule_path is not None:
+        strategy_kwargs['optimal_schedule_path'] = optimal_schedule_path
+        with open(optimal_schedule_path, 'rb') as f:
+            key['optimal_schedule'] = hashlib.sha1(f.read()).hexdigest()
+    key = hashlib.sha1(json.dumps(key,
+                                  sort_keys=True).encode()).hexdigest()[:16]
+    if key in _inference_plans:
+        return _inference_plans[key]
+    if cache_dir is None:
+        cache_dir = os.environ.get('INFERENCE_PLAN_CACHE', '.inference_plans')
+    path = Path(cache_dir) / f'{mode}_{key}.npz'
+    if path.exists():
+        plan = InferencePlan.load(path)
+    else:
+        plan = InferencePlan.compile(
+            inference_strategies[mode](**strategy_kwargs))
+        plan.save(path)
+    _inference_plans[key] = plan
+    return plan
+
+
+def get_inference_strategy(mode, **kwargs):
+    """Returns an iterator over the (observed, latent) frame indices of the
+    stages of an inference strategy: a cached InferencePlan for
+    deterministic strategies, or a fresh strategy object for adaptive ones
+    (which need the videos, through set_videos).
+
+    kwargs are the arguments of the inference strategy.
+    """
+    if is_adaptive(mode):
+        return iter(inference_strategies[mode](**kwargs))
+    return iter(get_inference_plan(mode, **kwargs))
+
+
+class StageStepSchedule:
+    """The number of denoising steps of each inference stage.
+
+    The schedule is given as a string:
+    - '' (the default): every stage uses all the steps of the diffusion.
+    - 'level:S1,S2,...': stages at level k of the inference strategy (see
+      InferenceStrategyBase.stage_level) use Sk steps.
+    - 'distance:S1,S2,...': stages whose latent frames are on average d
+      frames away from the nearest observed frame use Sd steps. Stages with no
+      observed frames use the last value.
+    Levels or distances past the end of the list use its last value.
+
+    Args:
+        spec (str): The schedule.
+    """
+    def __init__(self, spec=''):
+        self.spec = spec
+        if spec == '':
+            self.kind, self.steps = None, []
+        else:
+            self.kind, steps = spec.split(':')
+            if self.kind not in ['level', 'distance']:
+                raise ValueError(f'Unknown stage step schedule {spec}.')
+            self.steps = [int(n) for n in steps.split(',')]
+
+    def __bool__(self):
+        return self.kind is not None
+
+    def __call__(self, obs_frame_indices, latent_frame_indices, level):
+        """Returns the number of steps of a stage, or None for all the steps
+        of the diffusion.
+
+        Args:
+            obs_frame_indices (list): Observed frame indices of the stage (a
+                list per video for adaptive strategies).
+            latent_frame_indices (list): Latent frame indices of the stage.
+            level (int): stage_level of the strategy at the stage.
+        """
+        if self.kind is None:
+            return None
+        if self.kind == 'level':
+            key = level
+        else:
+            obs = np.atleast_2d(np.array(obs_frame_indices, dtype=np.float64))
+            latent = np.atleast_2d(
+                np.array(latent_frame_indices, dtype=np.float64))
+            if obs.shape[1] == 0:
+                return self.steps[-1]
+            distances = np.abs(latent[:, :, None] - obs[:, None, :]).min(-1)
+            key = int(round(distances.mean()))
+        return self.steps[min(max(key, 1), len(self.steps)) - 1]
+
+    def total_steps(self, plan, default_steps):
+        """Returns the number of model evaluations needed to sample one
+        video with an InferencePlan."""
+        total = 0
+        for stage, (obs, latent) in enumerate(plan):
+            steps = self(obs, latent, int(plan.levels[stage]))
+            total += default_steps if steps is None else steps
+        return total
+
+
+def respace_stage(diffusion, n_steps, sampler='ddpm'):
+    """Returns the diffusion to sample a stage with: respaced to n_steps
+    steps (spaced quadratically for DPM-Solver++, which suits the ODE
+    solver), or the diffusion itself if n_steps is None (see
+    StageStepSchedule)."""
+    if n_steps is None:
+        return diffusion
+    if sampler == 'dpm_solver++':
+        n_steps = f'quad{n_steps}'
+    return diffusion.respaced(n_steps)
+
+
+def sample_step(model,
+                diffusion,
+                x,
+                timestep,
+                model_kwargs,
+                *,
+                sampler='ddpm',
+                preds=(),
+                solver_order=2,
+                use_gradient_method=False):
+    """Takes one denoising step of an inference stage, from the given
+    timestep, and returns a dict with the keys 'sample' and 'pred_xstart'.
+
+    Args:
+        model: The model to sample from.
+        diffusion: The diffusion to sample with.
+        x (torch.FloatTensor): The network input of the stage at the
+            timestep.
+        timestep (int): The diffusion timestep.
+        model_kwargs (dict): The model kwargs of the stage.
+        sampler (str): One of dpm_solver.SAMPLERS: 'ddpm' for an ancestral
+            sampling step, or 'dpm_solver++' for a step of the multistep
+            DPM-Solver++ ODE solver.
+        preds (list): With DPM-Solver++, the predictions of x_0 at the
+            previous timesteps (the most recent last).
+        solver_order (int): The order of DPM-Solver++.
+        use_gradient_method (bool): Whether to guide the step with the
+            observed frames (see GaussianDiffusion.configure_guidance).
+    """
+    if sampler == 'dpm_solver++':
+        return dpm_solver.dpm_solver_sample(
+            diffusion,
+            model,
+            x,
+            timestep,
+            preds=preds,
+            clip_denoised=True,
+            model_kwargs=model_kwargs,
+            order=solver_order,
+            use_gradient_method=use_gradient_method,
+        )
+    return diffusion.p_sample(
+        model,
+        x,
+        t=torch.full((len(x), ), timestep, device=x.device),
+        clip_denoised=True,
+        model_kwargs=model_kwargs,
+        return_attn_weights=False,
+        use_gradient_method=use_gradient_method,
+    )
+
+
+def sample_stage(model,
+                 diffusion,
+                 x0,
+                 model_kwargs,
+                 *,
+                 sampler='ddpm',
+                 solver_order=2,
+                 noise=None,
+                 use_gradient_method=False):
+    """Denoises the latent frames of an inference stage, yielding the output
+    of sample_step (a dict with the keys 'sample' and 'pred_xstart') after
+    each timestep of the diffusion.
+
+    The model kwargs of the observed frames given by
+    model_kwargs['observed_frames'], if any, are updated at each timestep.
+
+    Args:
+        model: The model to sample from.
+        diffusion: The diffusion to sample with (see respace_stage).
+        x0 (torch.FloatTensor): The network input of the stage (see
+            VideoCanvas.read_stage).
+        model_kwargs (dict): The model kwargs of the stage.
+        sampler (str): One of dpm_solver.SAMPLERS (see sample_step).
+        solver_order (int): The order of DPM-Solver++.
+        noise (torch.FloatTensor): The network input at the first timestep.
+            Defaults to x0 for ancestral sampling, and to Gaussian noise for
+            DPM-Solver++ (which needs it to be).
+        use_gradient_method (bool): Whether to guide the sampling with the
+            observed frames (see GaussianDiffusion.configure_guidance).
+    """
+    if sampler == 'dpm_solver++':
+        # The solver also clamps the observed frames to their noisy versions
+        # on the same trajectory.
+        yield from dpm_solver.dpm_solver_sample_loop_progressive(
+            diffusion,
+            model,
+            x0.shape,
+            noise=noise,
+            clip_denoised=True,
+            model_kwargs=model_kwargs,
+            device=x0.device,
+            order=solver_order,
+            use_gradient_method=use_gradient_method,
+        )
+        return
+    x = x0.clone() if noise is None else noise
+    for timestep in range(diffusion.num_timesteps)[::-1]:
+        if 'observed_frames' in model_kwargs:
+            diffusion._set_observed_frames_kwargs(
+                model_kwargs,
+                torch.full((len(x), ), timestep, device=x.device),
+                use_gradient_method=use_gradient_method)
+        out = sample_step(model,
+                          diffusion,
+                          x,
+                          timestep,
+                          model_kwargs,
+                          use_gradient_method=use_gradient_method)
+        yield out
+        x = out['sample']
@@ -0,0 +1,356 @@
+"""A resource-aware job scheduler for running many sampling/evaluation jobs on
+a single machine, without SLURM.
+
+Jobs are kept in a JSON queue file. An interrupted scheduler can be started
+again on the same queue file and picks up the jobs that did not finish; jobs
+that were running at the time are started again, so they should be safe to
+re-run (the sampling and evaluation scripts skip outputs that already exist).
+
+Each job asks for a number of GPUs, GPU memory, CPUs and host memory. A job
+with gpu_mem_gb > 0 can share a GPU with other jobs as long as their requests
+fit in the memory of the device; a job with gpu_mem_gb == 0 gets its GPUs to
+itself.
+"""
+
+import json
+import os
+import queue
+import subprocess
+import threading
+from pathlib import Path
+
+from filelock import FileLock
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def make_job(command,
+             gpus=1,
+             gpu_mem_gb=0.0,
+             cpus=1,
+             mem_gb=0.0,
+             env=None,
+             max_retries=0):
+    """Creates a job description to be added to a JobQueue.
+
+    Args:
+        command: the shell command to run.
+        gpus: number of GPUs the job needs.
+        gpu_mem_gb: GPU memory the job needs on each of its GPUs. If 0, the
+            job gets its GPUs exclusively.
+        cpus: number of CPU cores the job needs. Also used as the job's
+            OMP_NUM_THREADS, unless env sets it.
+        mem_gb: host memory the job needs.
+        env: extra environment variables for the job.
+        max_retries: how many times to re-run the job if it fails.
+    """
+    return {
+        'command': command,
+        'env': {k: str(v)
+                for k, v in (env or {}).items()},
+        'gpus': gpus,
+        'gpu_mem_gb': gpu_mem_gb,
+        'cpus': cpus,
+        'mem_gb': mem_gb,
+        'max_retries': max_retries,
+        'status': PENDING,
+        'attempts': 0,
+        'returncode': None,
+    }
+
+
+def _job_key(job):
+    return job['command'], tuple(sorted(job['env'].items()))
+
+
+class JobQueue:
+    """A list of jobs, persisted to a JSON file if a path is given.
+
+    The file is protected by a lock file, so jobs can be added from other
+    processes while a scheduler is running on the queue.
+    """
+    def __init__(self, path=None):
+        self.path = None if path is None else Path(path)
+        self._lock = (threading.Lock()
+                      if path is None else FileLock(f'{self.path}.lock'))
+        self._state = {'jobs': []}
+
+    def _read(self):
+        if self.path is not None and self.path.exists():
+            with open(self.path) as f:
+                self._state = json.load(f)
+        return self._state
+
+    def _write(self, state):
+        self._state = state
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f'.{self.path.name}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def add(self, jobs):
+        """Adds jobs to the queue, skipping the ones that are already in it
+        (same command and environment). Returns the number of jobs added.
+
+        Re-adding a finished or failed job does not run it again.
+        """
+        with self._lock:
+            state = self._read()
+            existing = {_job_key(job) for job in state['jobs']}
+            n_added = 0
+            for job in jobs:
+                if _job_key(job) in existing:
+                    continue
+                existing.add(_job_key(job))
+                state['jobs'].append(dict(job, id=len(state['jobs'])))
+                n_added += 1
+            self._write(state)
+        return n_added
+
+    def jobs(self):
+        with self._lock:
+            return [dict(job) for job in self._read()['jobs']]
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            state = self._read()
+            state['jobs'][job_id].update(fields)
+            self._write(state)
+
+    def requeue_running(self):
+        """Marks jobs left running by a previous scheduler as pending."""
+        with self._lock:
+            state = self._read()
+            for job in state['jobs']:
+                if job['status'] == RUNNING:
+                    job['status'] = PENDING
+                    job['attempts'] = max(job['attempts'] - 1, 0)
+            self._write(state)
+
+
+def visible_gpus():
+    """Returns the ids of the GPUs this process may use, as strings."""
+    if 'CUDA_VISIBLE_DEVICES' in os.environ:
+        # Remove empty strings, to handle trailing commas as in
+        # `CUDA_VISIBLE_DEVICES=0,1,2,3, python3 ...`
+        return [
+            x for x in os.environ['CUDA_VISIBLE_DEVICES'].split(',') if x != ''
+        ]
+    import torch
+    return [str(x) for x in range(torch.cuda.device_count())]
+
+
+def _gpu_mem_gb(n_gpus):
+    import torch
+    return [
+        torch.cuda.get_device_properties(i).total_memory / 2**30
+        for i in range(n_gpus)
+    ]
+
+
+def _host_mem_gb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30
+
+
+class LocalScheduler:
+    """Runs the jobs of a JobQueue on the local machine, starting as many as
+    fit in the available resources.
+
+    Args:
+        job_queue: the JobQueue to run.
+        gpus: list of GPU ids to use. Defaults to the visible GPUs.
+        gpu_mem_gb: memory of each GPU, used for packing jobs. Defaults to
+            the memory reported by the device.
+        cpus: number of CPU cores to use. Defaults to all of them.
+        mem_gb: host memory to use. Defaults to all of it.
+        cpu_only: if True, ignores the GPU requests of the jobs and runs them
+            with no visible GPU.
+        log_dir: if given, the output of each job goes to
+            log_dir/job_<id>.log instead of the terminal.
+        poll_interval: how often (in seconds) to look for jobs added to the
+            queue by other processes while waiting for running jobs.
+    """
+    def __init__(self,
+                 job_queue,
+                 gpus=None,
+                 gpu_mem_gb=None,
+                 cpus=None,
+                 mem_gb=None,
+                 cpu_only=False,
+                 log_dir=None,
+                 poll_interval=30.0):
+        self.job_queue = job_queue
+        self.cpu_only = cpu_only
+        if cpu_only:
+            gpus = []
+        elif gpus is None:
+            gpus = visible_gpus()
+        self.gpus = [str(g) for g in gpus]
+        if gpu_mem_gb is None:
+            gpu_mem_gb = _gpu_mem_gb(len(self.gpus)) if self.gpus else []
+        elif not isinstance(gpu_mem_gb, (list, tuple)):
+            gpu_mem_gb = [gpu_mem_gb] * len(self.gpus)
+        self.gpu_mem = dict(zip(self.gpus, gpu_mem_gb))
+        self.gpu_free_mem = dict(self.gpu_mem)
+        self.gpu_n_jobs = {g: 0 for g in self.gpus}
+        self.gpu_exclusive = {g: False for g in self.gpus}
+        self.total_cpus = cpus or os.cpu_count() or 1
+        self.free_cpus = self.total_cpus
+        self.total_mem = mem_gb or _host_mem_gb()
+        self.free_mem = self.total_mem
+        self.log_dir = None if log_dir is None else Path(log_dir)
+        self.poll_interval = poll_interval
+        self._running = {}  # job id -> (process, resources)
+        self._events = queue.Queue()
+
+    def _requests(self, job):
+        n_gpus = 0 if self.cpu_only else job['gpus']
+        # A job asking for more than the machine has runs on its own.
+        cpus = min(job['cpus'], self.total_cpus)
+        mem = min(job['mem_gb'], self.total_mem)
+        return n_gpus, job['gpu_mem_gb'], cpus, mem
+
+    def _is_feasible(self, job):
+        n_gpus, gpu_mem, _, _ = self._requests(job)
+        if n_gpus > len(self.gpus):
+            return False
+        if gpu_mem > 0 and n_gpus > 0:
+            fitting = [g for g in self.gpus if self.gpu_mem[g] >= gpu_mem]
+            return len(fitting) >= n_gpus
+        return True
+
+    def _allocate(self, job):
+        """Reserves resources for the job. Returns them, or None if the job
+        does not fit right now."""
+        n_gpus, gpu_mem, cpus, mem = self._requests(job)
+        if cpus > self.free_cpus or mem > self.free_mem:
+            return None
+        if gpu_mem > 0:
+            # Best fit: pack the job onto the fullest GPUs it fits on.
+            candidates = sorted(
+                (g for g in self.gpus if not self.gpu_exclusive[g]
+                 and self.gpu_free_mem[g] >= gpu_mem),
+                key=lambda g: self.gpu_free_mem[g])
+        else:
+            candidates = [g for g in self.gpus if self.gpu_n_jobs[g] == 0]
+        if len(candidates) < n_gpus:
+            return None
+        gpus = candidates[:n_gpus]
+        for g in gpus:
+            self.gpu_n_jobs[g] += 1
+            self.gpu_free_mem[g] -= gpu_mem
+            self.gpu_exclusive[g] = gpu_mem == 0
+        self.free_cpus -= cpus
+        self.free_mem -= mem
+        return {'gpus': gpus, 'gpu_mem': gpu_mem, 'cpus': cpus, 'mem': mem}
+
+    def _release(self, res):
+        for g in res['gpus']:
+            self.gpu_n_jobs[g] -= 1
+            self.gpu_free_mem[g] += res['gpu_mem']
+            self.gpu_exclusive[g] = False
+        self.free_cpus += res['cpus']
+        self.free_mem += res['mem']
+
+    def _start(self, job, res):
+        env = dict(os.environ)
+        env['CUDA_VISIBLE_DEVICES'] = ','.join(res['gpus'])
+        env['OMP_NUM_THREADS'] = str(res['cpus'])
+        env.update(job['env'])
+        if self.log_dir is not None:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            stdout = open(self.log_dir / f"job_{job['id']}.log", 'a')
+        else:
+            stdout = None
+        proc = subprocess.Popen(job['command'],
+                                shell=True,
+                                env=env,
+                                stdout=stdout,
+                                stderr=subprocess.STDOUT if stdout else None)
+        if stdout is not None:
+            stdout.close()  # the child keeps its own handle
+        self._running[job['id']] = (proc, res)
+        self.job_queue.update(job['id'],
+                              status=RUNNING,
+                              attempts=job['attempts'] + 1,
+                              gpus=res['gpus'])
+        where = (f"GPU(s) {','.join(res['gpus'])}" if res['gpus'] else 'CPU')
+        print(f"[scheduler] Started job {job['id']} on {where}: "
+              f"{job['command']}")
+
+        def wait():
+            self._events.put((job['id'], proc.wait()))
+
+        threading.Thread(target=wait, daemon=True).start()
+
+    def _finish(self, job_id, returncode):
+        _, res = self._running.pop(job_id)
+        self._release(res)
+        job = self.job_queue.jobs()[job_id]
+        if returncode == 0:
+            status = DONE
+            print(f'[scheduler] Job {job_id} finished.')
+        elif job['attempts'] <= job['max_retries']:
+            status = PENDING
+            print(f'[scheduler] Job {job_id} failed with code {returncode}; '
+                  'retrying.')
+        else:
+            status = FAILED
+            print(f'[scheduler] Job {job_id} failed with code {returncode}.')
+        self.job_queue.update(job_id, status=status, returncode=returncode)
+
+    def _schedule(self):
+        """Starts all pending jobs that fit. Returns the number of pending
+        jobs that did not fit."""
+        n_waiting = 0
+        for job in self.job_queue.jobs():
+            if job['status'] != PENDING or job['id'] in self._running:
+                continue
+            if not self._is_feasible(job):
+                print(f"[scheduler] Job {job['id']} asks for more than this "
+                      'machine has; marking it as failed.')
+                self.job_queue.update(job['id'], status=FAILED)
+                continue
+            res = self._allocate(job)
+            if res is None:
+                n_waiting += 1
+            else:
+                self._start(job, res)
+        return n_waiting
+
+    def run(self):
+        """Runs until there are no pending or running jobs left."""
+        self.job_queue.requeue_running()
+        try:
+            while True:
+                n_waiting = self._schedule()
+                if not self._running:
+                    # With nothing running, every feasible job fits.
+                    assert n_waiting == 0
+                    break
+                try:
+                    event = self._events.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    continue  # look for newly added jobs
+                self._finish(*event)
+                while not self._events.empty():
+                    self._finish(*self._events.get())
+        except KeyboardInterrupt:
+            print('[scheduler] Interrupted; stopping running jobs.')
+            for proc, _ in self._running.values():
+                proc.terminate()
+            for proc, _ in self._running.values():
+                proc.wait()
+            self.job_queue.requeue_running()
+            raise
+        jobs = self.job_queue.jobs()
+        n_failed = sum(job['status'] == FAILED for job in jobs)
+        print(f'[scheduler] Finished {len(jobs) - n_failed} jobs, '
+              f'{n_failed} failed.')
+        return n_failed
@@ -3,18 +3,22 @@
 https://github.com/openai/baselines/blob/ea25b9e8b234e6ee1bca43083f8f3cf974143998/baselines/logger.py
 """
 
+import atexit
 import datetime
 import json
 import os
 import os.path as osp
+import queue
 import shutil
 import sys
 import tempfile
+import threading
 import time
 import warnings
 from collections import defaultdict
 from contextlib import contextmanager
 
+import torch as th
 import torch.distributed as dist
 
 import wandb
@@ -270,6 +274,25 @@ def logkv_mean(key, val):
     get_current().logkv_mean(key, val)
 
 
+def logkv_mean_tensor(key, val):
+    """Like logkv_mean(), but for tensors.
+
+    The value is accumulated on its own device and only synchronised with
+    the host (and reduced across ranks) once, in dumpkvs().
+    """
+    get_current().logkv_mean_tensor(key, val)
+
+
+def logkv_sum_tensor(key, total, count):
+    """Accumulate a (sum, count) pair. The sum is a tensor, and the count a
+    tensor or a number.
+
+    The logged value is the sum of all totals divided by the sum of all
+    counts. Keys with a zero total count are dropped at dump time.
+    """
+    get_current().logkv_sum_tensor(key, total, count)
+
+
 def logkvs(d):
     """Log a dictionary of key-value pairs."""
     for (k, v) in d.items():
@@ -281,6 +304,11 @@ def dumpkvs():
     return get_current().dumpkvs()
 
 
+def flush():
+    """Wait for all pending dumpkvs() writes to finish."""
+    get_current().flush()
+
+
 def getkvs():
     return get_current().name2val
 
@@ -373,13 +401,27 @@ class Logger(object):
     # So that you can still log to the terminal without setting up any output files
     CURRENT = None  # Current logger being used by the free functions above
 
-    def __init__(self, dir, output_formats, comm=None):
+    def __init__(self, dir, output_formats, comm=None, async_dump=True):
         self.name2val = defaultdict(float)  # values this iteration
         self.name2cnt = defaultdict(int)
+        # On-device accumulators: key -> [sum, count]. The sum is a tensor,
+        # and the count a tensor or, when it is known on the host, a float.
+        self.name2acc = {}
         self.level = INFO
         self.dir = dir
         self.output_formats = output_formats
         self.comm = comm
+        self._dump_queue = None
+        self._dump_thread = None
+        self._dump_error = None
+        if async_dump and any(
+                isinstance(fmt, KVWriter) for fmt in output_formats):
+            self._dump_queue = queue.Queue()
+            self._dump_thread = threading.Thread(target=self._dump_worker,
+                                                 name='logger-dumpkvs',
+                                                 daemon=True)
+            self._dump_thread.start()
+            atexit.register(self.flush)
 
     # Logging API, forwarded
     # ----------------------------------------
@@ -391,7 +433,56 @@ class Logger(object):
         self.name2val[key] = oldval * cnt / (cnt + 1) + val / (cnt + 1)
         self.name2cnt[key] = cnt + 1
 
+    def logkv_mean_tensor(self, key, val):
+        val = val.detach()
+        self.logkv_sum_tensor(key, val.sum(), val.numel())
+
+    def logkv_sum_tensor(self, key, total, count):
+        total = total.detach().double()
+        if th.is_tensor(count):
+            count = count.detach().to(device=total.device, dtype=th.float64)
+        else:
+            # Kept on the host, so that logging does not copy it to the
+            # device (and wait for it).
+            count = float(count)
+        if key in self.name2acc:
+            acc = self.name2acc[key]
+            acc[0] = acc[0] + total
+            acc[1] = acc[1] + count
+        else:
+            self.name2acc[key] = [total, count]
+
+    def _reduce_tensor_accumulators(self):
+        """Reduce all on-device accumulators with a single all-reduce and a
+        single device-to-host copy.
+
+        Every rank must log the same set of tensor keys between two dumps.
+        """
+        if not self.name2acc:
+            return {}
+        keys = sorted(self.name2acc.keys())
+
+        def as_tensor(count, total):
+            if th.is_tensor(count):
+                return count
+            return th.full((), count, dtype=th.float64, device=total.device)
+
+        packed = th.stack([
+            th.stack([total, as_tensor(count, total)])
+            for total, count in (self.name2acc[k] for k in keys)
+        ])
+        if dist.is_available() and dist.is_initialized(
+        ) and dist.get_world_size() > 1:
+            dist.all_reduce(packed)
+        packed = packed.cpu().numpy()
+        self.name2acc.clear()
+        return {
+            k: float(total / count)
+            for k, (total, count) in zip(keys, packed) if count > 0
+        }
+
     def dumpkvs(self):
+        tensor_kvs = self._reduce_tensor_accumulators()
         if self.comm is None:
             d = self.name2val
         else:
@@ -404,14 +495,49 @@ class Logger(object):
             )
             if self.comm.rank != 0:
                 d['dummy'] = 1  # so we don't get a warning about empty dict
+        if self.comm is None or self.comm.rank == 0:
+            d.update(tensor_kvs)
         out = d.copy()  # Return the dict for unit testing purposes
-        for fmt in self.output_formats:
-            if isinstance(fmt, KVWriter):
-                fmt.writekvs(d)
+        if self._dump_queue is not None:
+            self._raise_dump_error()
+            # The writers run on a background thread, so hand them a copy
+            # that is not cleared below.
+            self._dump_queue.put(d.copy())
+        else:
+            self._writekvs(d)
         self.name2val.clear()
         self.name2cnt.clear()
         return out
 
+    def _writekvs(self, d):
+        for fmt in self.output_formats:
+            if isinstance(fmt, KVWriter):
+                fmt.writekvs(d)
+
+    def _dump_worker(self):
+        while True:
+            d = self._dump_queue.get()
+            try:
+                if d is None:
+                    return
+                if self._dump_error is None:
+                    self._writekvs(d)
+            except Exception as e:
+                self._dump_error = e
+            finally:
+                self._dump_queue.task_done()
+
+    def _raise_dump_error(self):
+        if self._dump_error is not None:
+            e, self._dump_error = self._dump_error, None
+            raise RuntimeError('Writing logged values failed.') from e
+
+    def flush(self):
+        """Block until all pending dumps have been written."""
+        if self._dump_queue is not None:
+            self._dump_queue.join()
+            self._raise_dump_error()
+
     def log(self, *args, level=INFO):
         if self.level <= level:
             self._do_log(args)
@@ -428,8 +554,13 @@ class Logger(object):
         return self.dir
 
     def close(self):
+        if self._dump_queue is not None:
+            self._dump_queue.put(None)
+            self._dump_thread.join()
+            self._dump_queue = None
         for fmt in self.output_formats:
             fmt.close()
+        self._raise_dump_error()
 
     # Misc
     # ----------------------------------------
@@ -481,8 +612,13 @@ def configure(dir=None,
               comm=None,
               log_suffix='',
               config=None,
+              async_dump=True,
               **wandb_kwargs):
-    """If comm is provided, average all numerical stats across that comm."""
+    """If comm is provided, average all numerical stats across that comm.
+
+    If async_dump is True, key/value writers run on a background thread so
+    that file and network I/O does not block the caller of dumpkvs().
+    """
     if dir is None:
         parent = os.getenv('OPENAI_LOGDIR')
         if parent is None:
@@ -514,7 +650,10 @@ def configure(dir=None,
                            wandb_kwargs=wandb_kwargs) for f in format_strs
     ]
 
-    Logger.CURRENT = Logger(dir=dir, output_formats=output_formats, comm=comm)
+    Logger.CURRENT = Logger(dir=dir,
+                            output_formats=output_formats,
+                            comm=comm,
+                            async_dump=async_dump)
     if output_formats:
         log(f'Rank {rank}.', 'Logging to %s' % dir)
 
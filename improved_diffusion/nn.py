@@ -151,21 +151,33 @@ class CheckpointFunction(th.autograd.Function):
 
     @staticmethod
     def backward(ctx, *output_grads):
+        # Only floating point inputs can have gradients. The others (e.g.
+        # frame indices, or an attention mask of None) are passed as they are.
         ctx.input_tensors = [
-            x.detach().requires_grad_(True) for x in ctx.input_tensors
+            x.detach().requires_grad_(True)
+            if th.is_tensor(x) and x.is_floating_point() else x
+            for x in ctx.input_tensors
         ]
         with th.enable_grad():
             # Fixes a bug where the first op in run_function modifies the
             # Tensor storage in place, which is not allowed for detach()'d
             # Tensors.
-            shallow_copies = [x.view_as(x) for x in ctx.input_tensors]
+            shallow_copies = [
+                x.view_as(x) if th.is_tensor(x) else x
+                for x in ctx.input_tensors
+            ]
             output_tensors = ctx.run_function(*shallow_copies)
-        input_grads = th.autograd.grad(
-            output_tensors,
-            ctx.input_tensors + ctx.input_params,
-            output_grads,
-            allow_unused=True,
-        )
+        inputs = ctx.input_tensors + ctx.input_params
+        needs_grad = [th.is_tensor(x) and x.requires_grad for x in inputs]
+        grads = iter(
+            th.autograd.grad(
+                output_tensors,
+                [x for x, needed in zip(inputs, needs_grad) if needed],
+                output_grads,
+                allow_unused=True,
+            ))
+        input_grads = tuple(
+            next(grads) if needed else None for needed in needs_grad)
         del ctx.input_tensors
         del ctx.input_params
         del output_tensors
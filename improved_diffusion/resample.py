@@ -63,7 +63,7 @@ class UniformSampler(ScheduleSampler):
 
 
 class LossAwareSampler(ScheduleSampler):
-    def update_with_local_losses(self, local_ts, local_losses):
+    def update_with_local_losses(self, local_ts, local_losses, max_size=None):
         """Update the reweighting using losses from a model.
 
         Call this method from each rank with a batch of timesteps and the
@@ -73,37 +73,31 @@ class LossAwareSampler(ScheduleSampler):
 
         :param local_ts: an integer Tensor of timesteps.
         :param local_losses: a 1D Tensor of losses.
+        :param max_size: if specified, the largest number of losses any rank
+                         passes (e.g. the batch size of each rank). If not,
+                         the ranks agree on it with an extra collective.
         """
-        batch_sizes = [
-            th.tensor([0], dtype=th.int32, device=local_ts.device)
-            for _ in range(dist.get_world_size())
+        # Gather the timesteps and losses of all ranks in a single collective,
+        # padded to the largest local batch, with timestep -1 marking the
+        # padding.
+        if max_size is None:
+            size = th.tensor([len(local_ts)], device=local_losses.device)
+            dist.all_reduce(size, op=dist.ReduceOp.MAX)
+            max_size = int(size.item())
+        assert len(local_ts) <= max_size
+        packed = th.full((2, max_size),
+                         -1.0,
+                         dtype=th.float64,
+                         device=local_losses.device)
+        packed[0, :len(local_ts)] = local_ts
+        packed[1, :len(local_losses)] = local_losses
+        gathered = [
+            th.empty_like(packed) for _ in range(dist.get_world_size())
         ]
-        dist.all_gather(
-            batch_sizes,
-            th.tensor([len(local_ts)], dtype=th.int32, device=local_ts.device),
-        )
-
-        # Pad all_gather batches to be the maximum batch size.
-        batch_sizes = [x.item() for x in batch_sizes]
-        max_bs = max(batch_sizes)
-
-        timestep_batches = [
-            th.zeros(max_bs).to(local_ts) for bs in batch_sizes
-        ]
-        loss_batches = [
-            th.zeros(max_bs).to(local_losses) for bs in batch_sizes
-        ]
-        dist.all_gather(timestep_batches, local_ts)
-        dist.all_gather(loss_batches, local_losses)
-        timesteps = [
-            x.item() for y, bs in zip(timestep_batches, batch_sizes)
-            for x in y[:bs]
-        ]
-        losses = [
-            x.item() for y, bs in zip(loss_batches, batch_sizes)
-            for x in y[:bs]
-        ]
-        self.update_with_all_losses(timesteps, losses)
+        dist.all_gather(gathered, packed)
+        gathered = th.cat(gathered, dim=1)
+        ts, losses = gathered[:, gathered[0] >= 0]
+        self.update_with_all_losses(ts.long(), losses)
 
     @abstractmethod
     def update_with_all_losses(self, ts, losses):
@@ -117,38 +111,104 @@ class LossAwareSampler(ScheduleSampler):
         ranks with identical arguments. Thus, it should have deterministic
         behavior to maintain state across workers.
 
-        :param ts: a list of int timesteps.
-        :param losses: a list of float losses, one per timestep.
+        :param ts: an integer Tensor (or a list) of timesteps.
+        :param losses: a Tensor (or a list) of float losses, one per timestep.
         """
 
 
 class LossSecondMomentResampler(LossAwareSampler):
+    """Samples timesteps with probabilities proportional to the root mean
+    square of the last history_per_term losses at each timestep (mixed with a
+    uniform distribution), once every timestep has that many losses.
+
+    The loss history is kept on the device of the losses, as one ring buffer
+    per timestep, and updated and sampled from without leaving the device.
+    """
     def __init__(self, diffusion, history_per_term=10, uniform_prob=0.001):
         self.diffusion = diffusion
         self.history_per_term = history_per_term
         self.uniform_prob = uniform_prob
-        self._loss_history = np.zeros(
-            [diffusion.num_timesteps, history_per_term], dtype=np.float64)
-        self._loss_counts = np.zeros([diffusion.num_timesteps], dtype=np.int)
-
-    def weights(self):
+        T = diffusion.num_timesteps
+        self._loss_history = th.zeros([T, history_per_term], dtype=th.float64)
+        self._loss_counts = th.zeros([T], dtype=th.long)
+        # Where each timestep's next loss goes in its row of _loss_history.
+        self._write_pos = th.zeros([T], dtype=th.long)
+        self._is_warmed_up = False
+
+    def _to(self, device):
+        if self._loss_history.device != device:
+            self._loss_history = self._loss_history.to(device)
+            self._loss_counts = self._loss_counts.to(device)
+            self._write_pos = self._write_pos.to(device)
+
+    def _weights_tensor(self):
         if not self._warmed_up():
-            return np.ones([self.diffusion.num_timesteps], dtype=np.float64)
-        weights = np.sqrt(np.mean(self._loss_history**2, axis=-1))
-        weights /= np.sum(weights)
+            return th.ones([self.diffusion.num_timesteps],
+                           dtype=th.float64,
+                           device=self._loss_history.device)
+        weights = th.sqrt(th.mean(self._loss_history**2, dim=-1))
+        weights /= th.sum(weights)
         weights *= 1 - self.uniform_prob
         weights += self.uniform_prob / len(weights)
         return weights
 
+    def weights(self):
+        return self._weights_tensor().cpu().numpy()
+
+    def sample(self, batch_size, device):
+        p = self._weights_tensor().to(device)
+        p = p / th.sum(p)
+        indices = th.multinomial(p, batch_size, replacement=True)
+        weights = 1 / (len(p) * p[indices])
+        return indices, weights.float()
+
     def update_with_all_losses(self, ts, losses):
-        for t, loss in zip(ts, losses):
-            if self._loss_counts[t] == self.history_per_term:
-                # Shift out the oldest loss term.
-                self._loss_history[t, :-1] = self._loss_history[t, 1:]
-                self._loss_history[t, -1] = loss
-            else:
-                self._loss_history[t, self._loss_counts[t]] = loss
-                self._loss_counts[t] += 1
+        if th.is_tensor(losses):
+            self._to(losses.device)
+        device = self._loss_history.device
+        ts = th.as_tensor(ts, device=device).long().view(-1)
+        losses = th.as_tensor(losses, device=device, dtype=th.float64).view(-1)
+        H = self.history_per_term
+        # Losses are written in order, so the rank of a loss among the ones of
+        # its timestep in this update is its offset from the write position.
+        ts, order = th.sort(ts, stable=True)
+        losses = losses[order]
+        counts = th.bincount(ts, minlength=len(self._loss_counts))
+        group_start = th.cumsum(counts, dim=0) - counts
+        rank = th.arange(len(ts), device=device) - group_start[ts]
+        # Only the last H losses of each timestep are kept.
+        keep = rank >= counts[ts] - H
+        ts, rank, losses = ts[keep], rank[keep], losses[keep]
+        self._loss_history[ts, (self._write_pos[ts] + rank) % H] = losses
+        self._write_pos = (self._write_pos + counts) % H
+        self._loss_counts = th.clamp(self._loss_counts + counts, max=H)
 
     def _warmed_up(self):
-        return (self._loss_counts == self.history_per_term).all()
+        # Once warmed up, always warmed up, so this only syncs until then.
+        if not self._is_warmed_up:
+            self._is_warmed_up = bool(
+                (self._loss_counts == self.history_per_term).all())
+        return self._is_warmed_up
+
+    def state_dict(self):
+        return {
+            'loss_history': self._loss_history.cpu().numpy(),
+            'loss_counts': self._loss_counts.cpu().numpy(),
+            'write_pos': self._write_pos.cpu().numpy(),
+        }
+
+    def load_state_dict(self, state_dict):
+        assert state_dict['loss_history'].shape == tuple(
+            self._loss_history.shape)
+        device = self._loss_history.device
+        self._loss_history = th.as_tensor(state_dict['loss_history'],
+                                          dtype=th.float64,
+                                          device=device)
+        self._loss_counts = th.as_tensor(state_dict['loss_counts'],
+                                         dtype=th.long,
+                                         device=device)
+        self._write_pos = th.as_tensor(state_dict.get(
+            'write_pos', state_dict['loss_counts'] % self.history_per_term),
+                                       dtype=th.long,
+                                       device=device)
+        self._is_warmed_up = False
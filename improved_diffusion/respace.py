@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 import torch as th
 
@@ -14,7 +16,14 @@ def space_timesteps(num_timesteps, section_counts):
     are strided to be 15 timesteps, and the final 100 are strided to be 20.
 
     If the stride is a string starting with "ddim", then the fixed striding
-    from the DDIM paper is used, and only one section is allowed.
+    from the DDIM paper is used, and only one section is allowed. If it starts
+    with "quad", the timesteps are spaced quadratically (also from the DDIM
+    paper), so that there are more of them near the data, which suits
+    few-step ODE samplers (see dpm_solver.py). "distillK" gives the timesteps
+    of a model distilled for K rounds of progressive distillation (see
+    GaussianDiffusion.distillation_losses()): each round keeps every other
+    timestep, starting from the second, so that each step of the student
+    spans two steps of its teacher.
 
     :param num_timesteps: the number of diffusion steps in the original
                           process to divide up.
@@ -22,7 +31,9 @@ def space_timesteps(num_timesteps, section_counts):
                            comma-separated numbers, indicating the step count
                            per section. As a special case, use "ddimN" where N
                            is a number of steps to use the striding from the
-                           DDIM paper.
+                           DDIM paper, "quadN" for quadratic spacing, or
+                           "distillK" for the timesteps after K rounds of
+                           progressive distillation.
     :return: a set of diffusion steps from the original process to use.
     """
     if isinstance(section_counts, str):
@@ -34,6 +45,27 @@ def space_timesteps(num_timesteps, section_counts):
             raise ValueError(
                 f'cannot create exactly {num_timesteps} steps with an integer stride'
             )
+        if section_counts.startswith('quad'):
+            desired_count = int(section_counts[len('quad'):])
+            steps = np.round(
+                np.linspace(0, np.sqrt(num_timesteps - 1), desired_count)**2)
+            # Move apart the first steps, which round to the same timestep.
+            for i in range(1, desired_count):
+                steps[i] = max(steps[i], steps[i - 1] + 1)
+            if desired_count > num_timesteps or steps[-1] >= num_timesteps:
+                raise ValueError(
+                    f'cannot space {desired_count} steps quadratically in '
+                    f'{num_timesteps}')
+            return set(steps.astype(int).tolist())
+        if section_counts.startswith('distill'):
+            rounds = int(section_counts[len('distill'):])
+            steps = list(range(num_timesteps))
+            for _ in range(rounds):
+                steps = steps[1::2]
+            if not steps:
+                raise ValueError(
+                    f'cannot distill {num_timesteps} steps {rounds} times')
+            return set(steps)
         section_counts = [int(x) for x in section_counts.split(',')]
     size_per = num_timesteps // len(section_counts)
     extra = num_timesteps % len(section_counts)
@@ -58,6 +90,43 @@ def space_timesteps(num_timesteps, section_counts):
     return set(all_steps)
 
 
+class _Spacing:
+    """The betas of the diffusion process that keeps the given timesteps of a
+    base process, and the map from its timesteps to the base process's."""
+    def __init__(self, base_betas, use_timesteps):
+        alphas_cumprod = np.cumprod(1.0 - base_betas)
+        last_alpha_cumprod = 1.0
+        new_betas = []
+        self.timestep_map = []
+        for i, alpha_cumprod in enumerate(alphas_cumprod):
+            if i in use_timesteps:
+                new_betas.append(1 - alpha_cumprod / last_alpha_cumprod)
+                last_alpha_cumprod = alpha_cumprod
+                self.timestep_map.append(i)
+        self.betas = np.array(new_betas)
+        # timestep_map as a tensor on each device it is used on, shared by
+        # the models wrapped by every SpacedDiffusion with this spacing.
+        self.timestep_map_tensors = {}
+
+
+# Spacings of base processes, keyed by (base betas, timesteps kept). Together
+# with the tables GaussianDiffusion keeps for each schedule, this means that
+# (re)creating a SpacedDiffusion with a recently used spacing (e.g. for each
+# run of an evaluation sweep over respacings) computes and copies nothing.
+# Only the most recently used spacings are kept, so that a long-running
+# process (such as the sampling daemon) does not keep every spacing it has
+# seen.
+@functools.lru_cache(maxsize=64)
+def _cached_spacing(base_betas_bytes, use_timesteps):
+    return _Spacing(np.frombuffer(base_betas_bytes, dtype=np.float64),
+                    set(use_timesteps))
+
+
+def _get_spacing(base_betas, use_timesteps):
+    base_betas = np.asarray(base_betas, dtype=np.float64)
+    return _cached_spacing(base_betas.tobytes(), tuple(sorted(use_timesteps)))
+
+
 class SpacedDiffusion(GaussianDiffusion):
     """A diffusion process which can skip steps in a base diffusion process.
 
@@ -67,20 +136,34 @@ class SpacedDiffusion(GaussianDiffusion):
     """
     def __init__(self, use_timesteps, **kwargs):
         self.use_timesteps = set(use_timesteps)
-        self.timestep_map = []
         self.original_num_steps = len(kwargs['betas'])
-
-        base_diffusion = GaussianDiffusion(**kwargs)  # pylint: disable=missing-kwoa
-        last_alpha_cumprod = 1.0
-        new_betas = []
-        for i, alpha_cumprod in enumerate(base_diffusion.alphas_cumprod):
-            if i in self.use_timesteps:
-                new_betas.append(1 - alpha_cumprod / last_alpha_cumprod)
-                last_alpha_cumprod = alpha_cumprod
-                self.timestep_map.append(i)
-        kwargs['betas'] = np.array(new_betas)
+        self.base_kwargs = dict(kwargs)
+        # Respacings of the same base process, keyed by section counts.
+        self._respaced = {}
+
+        spacing = _get_spacing(kwargs['betas'], self.use_timesteps)
+        self.timestep_map = spacing.timestep_map
+        self._timestep_map_tensors = spacing.timestep_map_tensors
+        kwargs['betas'] = spacing.betas
         super().__init__(**kwargs)
 
+    def respaced(self, section_counts):
+        """Returns a SpacedDiffusion over the same base diffusion process,
+        with the timesteps given by section_counts (see space_timesteps()).
+        The diffusions are cached, and share this one's guidance settings.
+
+        :param section_counts: the respacing, e.g. 50 or "ddim25".
+        """
+        section_counts = str(section_counts)
+        if section_counts not in self._respaced:
+            self._respaced[section_counts] = SpacedDiffusion(
+                space_timesteps(self.original_num_steps, section_counts),
+                **self.base_kwargs)
+        diffusion = self._respaced[section_counts]
+        diffusion.configure_guidance(self.guidance_type, self.guidance_weight,
+                                     self.guidance_checkpoint)
+        return diffusion
+
     def p_mean_variance(self, model, *args, **kwargs):  # pylint: disable=signature-differs
         return super().p_mean_variance(self._wrap_model(model), *args,
                                        **kwargs)
@@ -89,11 +172,16 @@ class SpacedDiffusion(GaussianDiffusion):
         return super().training_losses(self._wrap_model(model), *args,
                                        **kwargs)
 
+    def distillation_losses(self, model, *args, **kwargs):  # pylint: disable=signature-differs
+        return super().distillation_losses(self._wrap_model(model), *args,
+                                           **kwargs)
+
     def _wrap_model(self, model):
         if isinstance(model, _WrappedModel):
             return model
         return _WrappedModel(model, self.timestep_map, self.rescale_timesteps,
-                             self.original_num_steps)
+                             self.original_num_steps,
+                             self._timestep_map_tensors)
 
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
@@ -101,18 +189,28 @@ class SpacedDiffusion(GaussianDiffusion):
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps,
-                 original_num_steps):
+    def __init__(self,
+                 model,
+                 timestep_map,
+                 rescale_timesteps,
+                 original_num_steps,
+                 map_tensors=None):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        # timestep_map as a tensor, keyed by (device, dtype).
+        self.map_tensors = {} if map_tensors is None else map_tensors
 
     def __call__(self, x, timesteps, **kwargs):
         ts = timesteps
-        map_tensor = th.tensor(self.timestep_map,
-                               device=ts.device,
-                               dtype=ts.dtype)
+        key = (ts.device, ts.dtype)
+        map_tensor = self.map_tensors.get(key)
+        if map_tensor is None:
+            map_tensor = th.tensor(self.timestep_map,
+                                   device=ts.device,
+                                   dtype=ts.dtype)
+            self.map_tensors[key] = map_tensor
         new_ts = map_tensor[ts]
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
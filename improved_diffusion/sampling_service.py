@@ -0,0 +1,266 @@
+"""A long-lived local sampling service that keeps models warm between jobs.
+
+Every sampling/evaluation script loads its checkpoint from scratch, which for
+short jobs (a few videos, or a sweep over inference modes) takes longer than
+the work itself. A SamplingServer keeps a ModelPool of loaded models and
+serves requests from any number of local clients over a
+multiprocessing.connection socket:
+
+- A request is a dict with an 'op' naming one of the server's handlers, and
+  whatever arguments the handler takes.
+- A handler is a function handler(pool, request) yielding its results one at
+  a time (e.g. one per batch of videos). Each result is sent back to the
+  client as soon as it is yielded.
+- Requests run one at a time, so jobs do not compete for GPU memory, but
+  clients can connect (and queue) at any time.
+
+The server answers the 'stats' and 'shutdown' ops itself.
+
+Requests are pickled, so whoever can connect can run code as the server's
+user. By default, the server creates a random authkey when it starts, and
+writes it to a file only its user can read (see authkey_path), which the
+clients of the same user read it from.
+"""
+
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+import torch as th
+
+from . import compile_util, test_util
+
+DEFAULT_ADDRESS = ('localhost', 6010)
+AUTHKEY_DIR = Path.home() / '.cache' / 'video-diffusion'
+# An authkey anyone with the repository knows, for servers every user of the
+# machine may run code through. Only used when passed explicitly.
+PUBLIC_AUTHKEY = b'video-diffusion'
+
+
+def authkey_path(address):
+    """The file the authkey of the server at the given address is kept in."""
+    if isinstance(address, tuple):
+        name = f'{address[0]}_{address[1]}'
+    else:
+        name = str(Path(address).resolve()).strip('/').replace('/', '_')
+    return AUTHKEY_DIR / f'sampling_service_{name}.key'
+
+
+def create_authkey(address):
+    """Creates a random authkey for the server at the given address, and
+    writes it to authkey_path(address), readable only by the current user."""
+    path = authkey_path(address)
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    authkey = os.urandom(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        # The file may already exist with other permissions.
+        os.fchmod(f.fileno(), 0o600)
+        f.write(authkey)
+    return authkey
+
+
+def read_authkey(address):
+    """Reads the authkey create_authkey wrote for the server at the given
+    address."""
+    path = authkey_path(address)
+    if not path.exists():
+        raise FileNotFoundError(
+            f'No authkey for a sampling server at {address} ({path}). Is the '
+            'server running, as the same user?')
+    return path.read_bytes()
+
+
+class ModelPool:
+    """An LRU cache of loaded models and their diffusions.
+
+    Models are keyed by checkpoint path, and loaded with the full diffusion
+    process. Respaced diffusions (see SpacedDiffusion.respaced) and compiled
+    models (see compile_util) are built on demand and kept with the model, so
+    all the respacings and compile modes of a checkpoint share its weights.
+
+    Args:
+        capacity: maximum number of checkpoints to keep loaded. The least
+            recently used one is dropped when another one is loaded.
+        device: the device to load the models on.
+    """
+    def __init__(self, capacity=2, device=None):
+        assert capacity >= 1
+        self.capacity = capacity
+        self.device = device or ('cuda' if th.cuda.is_available() else 'cpu')
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, checkpoint_path):
+        while len(self._entries) >= self.capacity:
+            evicted, _ = self._entries.popitem(last=False)
+            print(f'Unloading {evicted}.')
+            if th.cuda.is_available():
+                th.cuda.empty_cache()
+        print(f'Loading {checkpoint_path}.')
+        (model, diffusion), model_args = test_util.load_checkpoint(
+            checkpoint_path, self.device)
+        return dict(model=model,
+                    diffusion=diffusion,
+                    model_args=model_args,
+                    compiled={'none': model})
+
+    def get(self, checkpoint_path, timestep_respacing='', compile_mode='none'):
+        """Returns the model, diffusion and model config of a checkpoint,
+        loading it if it is not in the pool.
+
+        Args:
+            checkpoint_path: path of the checkpoint.
+            timestep_respacing: the respacing of the diffusion, as in
+                create_gaussian_diffusion. '' for all the steps.
+            compile_mode: one of compile_util.COMPILE_MODES.
+
+        Returns:
+            (model, diffusion, model_args). model_args is the checkpoint's
+            config; it is shared, so callers should copy it before changing
+            it.
+        """
+        key = str(checkpoint_path)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            self.misses += 1
+            self._entries[key] = self._load(key)
+        entry = self._entries[key]
+        if compile_mode not in entry['compiled']:
+            entry['compiled'][
+                compile_mode] = compile_util.compile_for_inference(
+                    entry['model'], compile_mode)
+        diffusion = entry['diffusion']
+        if timestep_respacing:
+            diffusion = diffusion.respaced(timestep_respacing)
+        return entry['compiled'][compile_mode], diffusion, entry['model_args']
+
+    def stats(self):
+        return dict(loaded=list(self._entries),
+                    capacity=self.capacity,
+                    hits=self.hits,
+                    misses=self.misses)
+
+
+class SamplingServer:
+    """Serves requests to the given handlers with a shared ModelPool.
+
+    Args:
+        pool: the ModelPool passed to the handlers.
+        handlers: dict from op names to handler(pool, request) functions,
+            which yield picklable results.
+        address: the address to listen on: a (host, port) pair, or the path
+            of a Unix socket.
+        authkey: the key clients must connect with. If None, a random one
+            made by create_authkey.
+    """
+    def __init__(self, pool, handlers, address=DEFAULT_ADDRESS, authkey=None):
+        self.pool = pool
+        self.handlers = handlers
+        self.address = address
+        self.authkey = authkey
+        self._run_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def serve_forever(self):
+        if self.authkey is None:
+            self.authkey = create_authkey(self.address)
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f'Serving {sorted(self.handlers)} on {listener.address}.')
+            while not self._stopped.is_set():
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, AuthenticationError) as e:
+                    print(f'WARNING: rejected a connection ({e!r}).')
+                    continue
+                if self._stopped.is_set():
+                    conn.close()
+                    break
+                threading.Thread(target=self._serve_connection,
+                                 args=(conn, ),
+                                 daemon=True).start()
+
+    def shutdown(self):
+        self._stopped.set()
+        # Wake up the listener, which is blocked waiting for a connection.
+        Client(self.address, authkey=self.authkey).close()
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    return
+                op = request.get('op')
+                if op == 'stats':
+                    conn.send(dict(status='done', result=self.pool.stats()))
+                elif op == 'shutdown':
+                    conn.send(dict(status='done'))
+                    self.shutdown()
+                    return
+                elif op not in self.handlers:
+                    conn.send(
+                        dict(
+                            status='error',
+                            error=f'Unknown op {op!r}. Expected one of '
+                            f"{sorted(self.handlers) + ['stats', 'shutdown']}."
+                        ))
+                else:
+                    self._run(conn, self.handlers[op], request)
+
+    def _run(self, conn, handler, request):
+        with self._run_lock:
+            start = time.time()
+            try:
+                for result in handler(self.pool, request):
+                    conn.send(dict(status='result', result=result))
+            except (BrokenPipeError, ConnectionResetError):
+                print(f"WARNING: client of {request['op']} went away.")
+                return
+            except Exception:  # pylint: disable=broad-except
+                error = traceback.format_exc()
+                print(error)
+                conn.send(dict(status='error', error=error))
+                return
+            conn.send(dict(status='done', seconds=time.time() - start))
+
+
+def send_request(request, address=DEFAULT_ADDRESS, authkey=None):
+    """Sends a request to a SamplingServer and yields its results as they
+    arrive.
+
+    Args:
+        request: dict with the 'op' of the request and its arguments.
+        address: the address of the server.
+        authkey: the key of the server. If None, the one create_authkey
+            wrote for the address.
+
+    Returns:
+        A generator of the results of the request. For the 'stats' op, the
+        only result is the pool statistics.
+
+    Raises:
+        RuntimeError: if the request failed on the server.
+    """
+    if authkey is None:
+        authkey = read_authkey(address)
+    with Client(address, authkey=authkey) as conn:
+        conn.send(request)
+        while True:
+            reply = conn.recv()
+            if reply['status'] == 'error':
+                raise RuntimeError(
+                    f"{request.get('op')} request failed:\n{reply['error']}")
+            if 'result' in reply:
+                yield reply['result']
+            if reply['status'] == 'done':
+                return
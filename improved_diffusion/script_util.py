@@ -54,6 +54,9 @@ def video_model_and_diffusion_defaults():
     defaults['rp_beta'] = None
     defaults['rp_gamma'] = None
     defaults['allow_interactions_between_padding'] = True
+    # Rounds of progressive distillation the model has been through (see
+    # TrainLoop.run_distillation).
+    defaults['distill_rounds'] = 0
     return defaults
 
 
@@ -140,6 +143,7 @@ def create_video_model_and_diffusion(
     rp_gamma,
     cond_emb_type,
     allow_interactions_between_padding,
+    distill_rounds=0,
 ):
     model = create_video_model(
         T,
@@ -177,6 +181,7 @@ def create_video_model_and_diffusion(
         rescale_timesteps=rescale_timesteps,
         rescale_learned_sigmas=rescale_learned_sigmas,
         timestep_respacing=timestep_respacing,
+        distill_rounds=distill_rounds,
     )
     return model, diffusion
 
@@ -413,6 +418,7 @@ def create_gaussian_diffusion(
     rescale_timesteps=False,
     rescale_learned_sigmas=False,
     timestep_respacing='',
+    distill_rounds=0,
 ):
     betas = gd.get_named_beta_schedule(noise_schedule, steps)
     if use_kl:
@@ -421,6 +427,14 @@ def create_gaussian_diffusion(
         loss_type = gd.LossType.RESCALED_MSE
     else:
         loss_type = gd.LossType.MSE
+    if distill_rounds:
+        # A distilled model samples on the timesteps it was distilled for.
+        if timestep_respacing and timestep_respacing != f'distill{distill_rounds}':
+            print(f'WARNING: sampling a model distilled for {distill_rounds} '
+                  f'rounds with the respacing {timestep_respacing} instead of '
+                  f'the timesteps it was distilled for.')
+        else:
+            timestep_respacing = f'distill{distill_rounds}'
     if not timestep_respacing:
         timestep_respacing = [steps]
     return SpacedDiffusion(
@@ -447,7 +461,7 @@ def add_dict_to_argparser(parser, default_dict):
 
 
 def args_to_dict(args, keys):
-    backups = {'allow_interactions_between_padding': True}
+    backups = {'allow_interactions_between_padding': True, 'distill_rounds': 0}
     return {
         k: getattr(args, k) if hasattr(args, k) else backups[k]
         for k in keys
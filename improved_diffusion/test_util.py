@@ -1,4 +1,5 @@
 import argparse
+import json
 import os
 from pathlib import Path
 
@@ -10,6 +11,7 @@ from filelock import FileLock
 from PIL import Image
 
 from improved_diffusion import dist_util
+from improved_diffusion.gaussian_diffusion import GuidanceType
 from improved_diffusion.script_util import (args_to_dict,
                                             create_video_model_and_diffusion,
                                             video_model_and_diffusion_defaults)
@@ -120,11 +122,22 @@ def get_eval_run_identifier(args, postfix=''):
     if hasattr(args, 'optimality') and args.optimality is not None:
         res += f'_optimal-{args.optimality}'
     res += f'_{args.max_frames}_{args.step_size}_{args.T}_{args.obs_length}'
+    if getattr(args, 'stage_steps', ''):
+        res += '_steps-' + args.stage_steps.replace(':', '-').replace(',', '-')
+    # No sampler is the default sampler of the model (see configure_sampler).
+    if getattr(args, 'sampler', None) not in [None, 'ddpm']:
+        res += f'_{args.sampler}-o{args.solver_order}'
+        if args.timestep_respacing:
+            res += f'-{args.timestep_respacing}'
     if hasattr(args,
                'dataset_partition') and args.dataset_partition == 'train':
         res = 'trainset_' + res
     if hasattr(args, 'use_gradient_method') and args.use_gradient_method:
-        res = 'gradientmethod_' + res
+        prefix = ('batchedguidance' if getattr(args, 'batched_guidance', False)
+                  else 'gradientmethod')
+        if getattr(args, 'guidance_weight', None) is not None:
+            prefix += f'-w{args.guidance_weight:g}'
+        res = f'{prefix}_' + res
     if hasattr(args, 'override_dataset') and args.override_dataset is not None:
         res = f'{args.override_dataset}_' + res
     if postfix != '':
@@ -132,6 +145,111 @@ def get_eval_run_identifier(args, postfix=''):
     return res
 
 
+def configure_guidance(diffusion, args):
+    """Sets up the guidance used with --use_gradient_method from the sampling
+    arguments (--batched_guidance, --guidance_weight and
+    --guidance_checkpoint)."""
+    diffusion.configure_guidance(
+        guidance_type=(GuidanceType.BATCHED if args.batched_guidance else
+                       GuidanceType.RECONSTRUCTION),
+        weight=args.guidance_weight,
+        checkpoint=args.guidance_checkpoint,
+    )
+
+
+def configure_sampler(args, distill_rounds=0):
+    """Sets the sampler from the sampling arguments (--sampler and
+    --solver_order) and the model.
+
+    Models trained with progressive distillation (distill_rounds > 0, see
+    TrainLoop.run_distillation) are distilled for deterministic DDIM steps,
+    so they are sampled with DDIM (DPM-Solver++ of order 1) by default, and
+    cannot be sampled with ancestral sampling. Other models are sampled with
+    ancestral sampling by default.
+    """
+    if args.sampler is None:
+        if distill_rounds:
+            args.sampler, args.solver_order = 'dpm_solver++', 1
+        else:
+            args.sampler = 'ddpm'
+    elif args.sampler == 'ddpm' and distill_rounds:
+        raise ValueError(
+            f'The model was distilled for {distill_rounds} rounds for DDIM '
+            'steps, which ancestral sampling does not take. Sample it with '
+            '--sampler dpm_solver++ (--solver_order 1 for DDIM).')
+
+
+class FrameFile:
+    """A uint8 video that can be appended to frame by frame, and read back as
+    a memory-mapped TxCxHxW array.
+
+    The frames are stored back to back in <path>.u8, and their count and
+    shape in <path>.json. The json file is only updated once the appended
+    frames are on disk, so an interrupted writer leaves a valid (shorter)
+    video behind.
+
+    Args:
+        path: path of the video, without suffix.
+        frame_shape: shape (CxHxW) of the frames. Required if the video does
+            not exist yet.
+    """
+    def __init__(self, path, frame_shape=None):
+        path = Path(path)
+        self.data_path = path.parent / f'{path.name}.u8'
+        self.meta_path = path.parent / f'{path.name}.json'
+        if self.meta_path.exists():
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            self.frame_shape = tuple(meta['frame_shape'])
+            self.n_frames = meta['n_frames']
+            assert frame_shape is None or tuple(
+                frame_shape) == self.frame_shape, (
+                    f'Expected frames of shape {self.frame_shape} in '
+                    f'{self.data_path}, got {tuple(frame_shape)}.')
+        else:
+            assert frame_shape is not None, f'{self.meta_path} does not exist.'
+            self.frame_shape = tuple(frame_shape)
+            self.n_frames = 0
+            self._write_meta()
+        self._frame_bytes = int(np.prod(self.frame_shape))
+        # Drop anything written after the last update of the json file.
+        with open(self.data_path, 'ab') as f:
+            f.truncate(self.n_frames * self._frame_bytes)
+
+    def _write_meta(self):
+        tmp_path = self.meta_path.with_name(f'.{self.meta_path.name}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(
+                {
+                    'n_frames': self.n_frames,
+                    'frame_shape': list(self.frame_shape)
+                }, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def __len__(self):
+        return self.n_frames
+
+    def append(self, frames):
+        """Appends frames (NxCxHxW, uint8) to the video."""
+        frames = np.ascontiguousarray(frames, dtype=np.uint8)
+        assert frames.shape[1:] == self.frame_shape, frames.shape
+        with open(self.data_path, 'ab') as f:
+            f.write(frames.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.n_frames += len(frames)
+        self._write_meta()
+
+    def read(self):
+        """Returns the video as a read-only memory-mapped array."""
+        if self.n_frames == 0:
+            return np.zeros((0, *self.frame_shape), dtype=np.uint8)
+        return np.memmap(self.data_path,
+                         dtype=np.uint8,
+                         mode='r',
+                         shape=(self.n_frames, *self.frame_shape))
+
+
 ################################################################################
 #                           Visualization functions                            #
 ################################################################################
@@ -3,6 +3,7 @@ import functools
 import glob
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from time import time
 
@@ -12,6 +13,7 @@ import torch as th
 import torch.distributed as dist
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 from torch.nn.parallel.distributed import DistributedDataParallel as DDP
 from torch.optim import AdamW
 
@@ -24,7 +26,15 @@ from .fp16_util import (make_master_params, master_params_to_model_params,
 from .image_datasets import default_iterations_dict
 from .nn import update_ema
 from .resample import LossAwareSampler, UniformSampler
-from .rng_util import RNG, rng_decorator
+from .rng_util import RNG
+from .script_util import create_gaussian_diffusion
+
+# Hooks that compress the gradients before they are all-reduced (see
+# TrainLoop's ddp_comm_hook).
+DDP_COMM_HOOKS = {
+    'fp16': default_hooks.fp16_compress_hook,
+    'bf16': default_hooks.bf16_compress_hook,
+}
 
 # For ImageNet experiments, this was a good default value.
 # We found that the lg_loss_scale quickly climbed to
@@ -63,6 +73,15 @@ class TrainLoop:
         pad_with_random_frames=True,
         observed_frames='x_t_minus_1',
         use_gradient_method=False,
+        sample_use_ddim=False,
+        sample_timestep_respacing='',
+        async_sampling=True,
+        valid_interval=None,
+        n_valid_timesteps=16,
+        microbatch_memory_gb=None,
+        ddp_comm_hook='none',
+        batch_mean_loss=False,
+        bucket_by_length=False,
         args=None,
     ):
         current_rank = dist.get_rank() if dist.is_initialized() else 0
@@ -74,6 +93,15 @@ class TrainLoop:
         self.data = data
         self.batch_size = batch_size
         self.microbatch = microbatch if microbatch > 0 else batch_size
+        # If set, the microbatch size is chosen from the memory the first
+        # microbatch takes (see _set_microbatch_from_memory()).
+        self.microbatch_memory_gb = microbatch_memory_gb
+        assert ddp_comm_hook == 'none' or ddp_comm_hook in DDP_COMM_HOOKS
+        self._microbatch_measured = False
+        # If set, each microbatch's loss is weighted by its share of the
+        # batch, so that the gradient is the mean over the batch whatever
+        # the microbatch sizes, rather than the sum of the microbatch means.
+        self.batch_mean_loss = batch_mean_loss
         self.valid_microbatch = (args.valid_microbatch
                                  if args.valid_microbatch > 0 else batch_size)
         self.lr = lr
@@ -141,7 +169,14 @@ class TrainLoop:
                     bucket_cap_mb=128,
                     find_unused_parameters=False,
                 )
+                if ddp_comm_hook != 'none':
+                    # Compress each bucket of gradients before its all-reduce,
+                    # which still overlaps with the backward pass.
+                    self.ddp_model.register_comm_hook(
+                        None, DDP_COMM_HOOKS[ddp_comm_hook])
             else:
+                # There is nothing to synchronize.
+                self.use_ddp = False
                 self.ddp_model = self.model
         else:
             if dist.get_world_size() > 1:
@@ -151,9 +186,49 @@ class TrainLoop:
             self.ddp_model = self.model
         self.n_valid_batches = n_valid_batches
         self.n_valid_repeats = n_valid_repeats
+        self.valid_interval = valid_interval
+        self.n_valid_timesteps = n_valid_timesteps
+        self._valid_inputs = None
         self.n_interesting_masks = n_interesting_masks
         self.mask_distribution = mask_distribution
         self.pad_with_random_frames = pad_with_random_frames
+        # Padding with random frames trains on the padding frames, so only
+        # padding with copies of frames can be avoided by bucketing.
+        assert not (bucket_by_length and pad_with_random_frames), \
+            'bucket_by_length needs pad_with_random_frames=False.'
+        self.bucket_by_length = bucket_by_length
+        # Validation sampling runs on a separate EMA replica, optionally with a
+        # faster (respaced and/or DDIM) sampler.
+        self.sample_use_ddim = sample_use_ddim
+        if sample_timestep_respacing:
+            self.sample_diffusion = create_gaussian_diffusion(
+                steps=args.diffusion_steps,
+                learn_sigma=args.learn_sigma,
+                sigma_small=args.sigma_small,
+                noise_schedule=args.noise_schedule,
+                use_kl=args.use_kl,
+                predict_xstart=args.predict_xstart,
+                rescale_timesteps=args.rescale_timesteps,
+                rescale_learned_sigmas=args.rescale_learned_sigmas,
+                timestep_respacing=sample_timestep_respacing,
+            )
+        else:
+            self.sample_diffusion = diffusion
+        # Set by run_distillation().
+        self.teacher = None
+        self.teacher_diffusion = None
+        # When the last samples were logged (see _train_step()).
+        self._last_sample_time = time()
+        # Copies the next microbatch to the device while the current one is
+        # computed (see _prepare_microbatch()).
+        self._prefetch_stream = (th.cuda.Stream(
+            device=dist_util.dev()) if th.cuda.is_available() else None)
+        self.async_sampling = async_sampling and th.cuda.is_available()
+        self._sample_model = None
+        self._sample_stream = (th.cuda.Stream(
+            device=dist_util.dev()) if self.async_sampling else None)
+        self._sample_executor = None
+        self._pending_samples = None
         with RNG(0):
             self.valid_batches = [
                 next(self.data)[0][:self.valid_microbatch]
@@ -405,31 +480,107 @@ class TrainLoop:
     def run_loop(self):
         if 'carla' not in self._args.dataset:
             gather_and_log_videos('data/', next(self.data)[0], log_as='both')
-        last_sample_time = time()
+        self._last_sample_time = time()
         while not self.lr_anneal_steps or self.step < self.lr_anneal_steps:
-
-            t_0 = time()
-            self.run_step()
-            logger.logkv('timing/step_time', time() - t_0)
-            if self.step % self.log_interval == 0:
-                logger.dumpkvs()
-            if self.step % self.save_interval == 0:
-                self.save()
-                # Run for a finite amount of time in integration tests.
-                if os.environ.get('DIFFUSION_TRAINING_TEST',
-                                  '') and self.step > 0:
-                    return
-            if (self.sample_interval is not None and self.step != 0
-                    and (self.step % self.sample_interval == 0
-                         or self.step == 5)):  # noqa
-                self.log_samples()
-                logger.logkv('timing/time_between_samples',
-                             time() - last_sample_time)
-                last_sample_time = time()
-            self.step += 1
+            if self._train_step():
+                return
         # Save the last checkpoint if it wasn't already saved.
         if (self.step - 1) % self.save_interval != 0:
             self.save()
+        self._finish_pending_samples()
+        logger.dumpkvs()
+
+    def _train_step(self):
+        """Take a training step, and log, validate, save and sample at their
+        intervals. Returns True if training should stop."""
+        t_0 = time()
+        self.run_step()
+        logger.logkv('timing/step_time', time() - t_0)
+        if self.step % self.log_interval == 0:
+            self._poll_pending_samples()
+            logger.dumpkvs()
+        if self.valid_interval and self.step % self.valid_interval == 0:
+            self.log_validation_metrics()
+        if self.step % self.save_interval == 0:
+            self.save()
+            # Run for a finite amount of time in integration tests.
+            if os.environ.get('DIFFUSION_TRAINING_TEST', '') and self.step > 0:
+                self._finish_pending_samples()
+                return True
+        if (self.sample_interval is not None and self.step != 0 and
+            (self.step % self.sample_interval == 0 or self.step == 5)):  # noqa
+            self.log_samples()
+            logger.logkv('timing/time_between_samples',
+                         time() - self._last_sample_time)
+            self._last_sample_time = time()
+        self.step += 1
+        return False
+
+    def run_distillation(self, rounds, round_steps):
+        """Train with progressive distillation (Salimans & Ho, "Progressive
+        Distillation for Fast Sampling of Diffusion Models", 2022) instead of
+        the denoising objective.
+
+        The model is the teacher of the first round. In each round, a frozen
+        copy of the model is the teacher, and the model (the student) learns
+        to match two of its DDIM steps with one of its own (see
+        GaussianDiffusion.distillation_losses()), on the same masks as in
+        training. The students of later rounds start from and are taught by
+        the students of the rounds before. The optimizer, learning rate
+        schedule and EMAs start over in each round.
+
+        A checkpoint is saved at the end of each round, with distill_rounds
+        in its config set to the rounds the model has been through, so that
+        the sampling scripts sample it on its own timesteps, with DDIM (see
+        test_util.configure_sampler()).
+
+        :param rounds: the number of rounds, each of which halves the number
+                       of sampling steps.
+        :param round_steps: the number of training steps of each round.
+        """
+        self._last_sample_time = time()
+        for _ in range(rounds):
+            self._start_distillation_round(round_steps)
+            logger.log(f'distillation round {self._args.distill_rounds}: '
+                       f'{self.teacher_diffusion.num_timesteps} to '
+                       f'{self.diffusion.num_timesteps} steps...')
+            for _ in range(round_steps):
+                if self._train_step():
+                    return
+            if (self.step - 1) % self.save_interval != 0:
+                self.save()
+        self._finish_pending_samples()
+        logger.dumpkvs()
+
+    def _start_distillation_round(self, round_steps):
+        teacher = copy.deepcopy(self.model)
+        for p in teacher.parameters():
+            p.grad = None
+            p.requires_grad_(False)
+        teacher.eval()
+        self.teacher = teacher
+        self.teacher_diffusion = self.diffusion
+        self._args.distill_rounds += 1
+        self.diffusion = self.teacher_diffusion.respaced(
+            f'distill{self._args.distill_rounds}')
+        assert (self.diffusion.timestep_map ==
+                self.teacher_diffusion.timestep_map[1::2]), \
+            'The teacher must sample on the timesteps of the previous round.'
+        self.schedule_sampler = type(self.schedule_sampler)(self.diffusion)
+        # Validation samples show the student's few-step DDIM samples, and
+        # the validation losses are evaluated on its timesteps.
+        self.sample_diffusion = self.diffusion
+        self._valid_inputs = None
+        self.sample_use_ddim = True
+        self.opt = AdamW(self.master_params,
+                         lr=self.lr,
+                         weight_decay=self.weight_decay)
+        self.lr_scheduler = th.optim.lr_scheduler.CosineAnnealingWarmRestarts(
+            self.opt, round_steps)
+        self.ema_params = [
+            copy.deepcopy(self.master_params)
+            for _ in range(len(self.ema_rate))
+        ]
 
     def run_step(self):
         self.forward_backward()
@@ -439,35 +590,138 @@ class TrainLoop:
             self.optimize_normal()
         self.log_step()
 
+    def _microbatch_indices(self, masks):
+        """Split the batch into microbatches, as lists of example indices.
+
+        With bucket_by_length, the examples with the same number of frames
+        are put together in full microbatches, which have no padding. The
+        rest, sorted by their numbers of frames, are split into microbatches
+        padded to their longest example. So there are as many microbatches
+        of the same sizes as without bucketing, and the ranks run the same
+        number of them for batches of the same size.
+
+        :param masks: the (obs, latent, kinda_marg) masks of the batch.
+        """
+        batch_size = len(masks[0])
+        if not self.bucket_by_length:
+            return list(th.split(th.arange(batch_size), self.microbatch))
+        n_frames = sum(masks).clip(max=1).view(batch_size, -1).sum(dim=1)
+        order = th.argsort(n_frames, stable=True)
+        full = []
+        rest = []
+        for length in th.unique(n_frames):
+            bucket = order[n_frames[order] == length]
+            n_full = len(bucket) - len(bucket) % self.microbatch
+            full.extend(th.split(bucket[:n_full], self.microbatch))
+            rest.append(bucket[n_full:])
+        # (th.split gives an empty chunk for an empty tensor.)
+        return [
+            index
+            for index in full + list(th.split(th.cat(rest), self.microbatch))
+            if len(index)
+        ]
+
+    def _prepare_microbatch(self, batch1, batch2, masks, index):
+        """Gather the frames of the microbatch of batch1 (and batch2) made of
+        the examples index, and copy it to the device.
+
+        With CUDA, the copies are made from pinned memory on a side stream,
+        so that they neither wait for nor block the computation of the
+        previous microbatch. Pass the result to _wait_for_microbatch()
+        before using it.
+
+        :param masks: the (obs, latent, kinda_marg) masks of the batch, from
+                      sample_all_masks(gather=False).
+        :param index: the indices of the examples of the microbatch, from
+                      _microbatch_indices().
+        """
+        with logger.profile_kv('prepare_microbatch'):
+            masks = [m[index] for m in masks]
+            represented_mask = sum(masks).clip(max=1)
+            (
+                represented_mask,
+                batch,
+                masks,
+                frame_indices,
+            ) = self.gather_unmasked_elements(
+                represented_mask, batch1[index],
+                None if batch2 is None else batch2[index], masks)
+        # Count the frames that only pad the examples to the same length.
+        self._step_frames[0] += represented_mask.numel()
+        self._step_frames[1] += represented_mask.numel() - int(
+            represented_mask.sum())
+        tensors = [batch, frame_indices, *masks]
+        if self._prefetch_stream is None:
+            return [x.to(dist_util.dev()) for x in tensors]
+        with th.cuda.stream(self._prefetch_stream):
+            return [
+                x.pin_memory().to(dist_util.dev(), non_blocking=True)
+                for x in tensors
+            ]
+
+    def _wait_for_microbatch(self, tensors):
+        if self._prefetch_stream is not None:
+            current_stream = th.cuda.current_stream()
+            current_stream.wait_stream(self._prefetch_stream)
+            for x in tensors:
+                # The memory must not be reused before the current stream
+                # is done with it.
+                x.record_stream(current_stream)
+        return tensors
+
     def forward_backward(self):
         zero_grad(self.model_params)
         batch1 = next(self.data)[0]
         batch2 = next(self.data)[0] if self.pad_with_random_frames else None
-        for i in range(0, batch1.shape[0], self.microbatch):
-            micro1 = batch1[i:i + self.microbatch]
-            micro2 = batch2[i:i +
-                            self.microbatch] if batch2 is not None else None
+        batch_size = batch1.shape[0]
+        # The masks of the whole batch, so that microbatches can be made of
+        # examples with the same number of frames.
+        batch1, *masks = self.sample_all_masks(batch1, gather=False)
+        indices = self._microbatch_indices(masks)
+        # The numbers of frames of the microbatches, and of padding frames.
+        self._step_frames = [0, 0]
+        # The timesteps of the whole batch, sampled at once on the device,
+        # where a LossAwareSampler keeps its loss history. The microbatches
+        # take the next ones in turn.
+        step_ts, step_weights = self.schedule_sampler.sample(
+            batch_size, dist_util.dev())
+        step_losses = []
+        # Measured on the first microbatch, but the ranks only agree on the
+        # new microbatch size after the gradients are all-reduced, so that
+        # all ranks run their collectives in the same order.
+        measured_memory = None
+        prepared = self._prepare_microbatch(batch1, batch2, masks, indices[0])
+        for i in range(len(indices)):
             (
                 micro,
                 frame_indices,
                 obs_mask,
                 latent_mask,
                 kinda_marg_mask,
-            ) = self.sample_all_masks(micro1, micro2)
-            micro = micro.to(dist_util.dev())
-            frame_indices = frame_indices.to(dist_util.dev())
-            obs_mask = obs_mask.to(dist_util.dev())
-            latent_mask = latent_mask.to(dist_util.dev())
-            kinda_marg_mask = kinda_marg_mask.to(dist_util.dev())
-
-            last_batch = (i + self.microbatch) >= batch1.shape[0]
-            t, weights = self.schedule_sampler.sample(micro.shape[0],
-                                                      dist_util.dev())
+            ) = self._wait_for_microbatch(prepared)
+            start = sum(len(index) for index in indices[:i])
+            t = step_ts[start:start + len(micro)]
+            weights = step_weights[start:start + len(micro)]
+            last_batch = i == len(indices) - 1
+            measure_memory = (i == 0 and self.microbatch_memory_gb is not None
+                              and not self._microbatch_measured
+                              and self.sync_cuda)
+            if measure_memory:
+                th.cuda.synchronize(dist_util.dev())
+                th.cuda.reset_peak_memory_stats(dist_util.dev())
+                memory_before = th.cuda.memory_allocated(dist_util.dev())
 
             loss_mask = ((1 - obs_mask - kinda_marg_mask)
                          if self.pad_with_random_frames else latent_mask)
+            if self.teacher is None:
+                losses_fn = self.diffusion.training_losses
+            else:
+                losses_fn = functools.partial(
+                    self.diffusion.distillation_losses,
+                    teacher=self.teacher,
+                    teacher_diffusion=self.teacher_diffusion)
             compute_losses = functools.partial(
-                self.diffusion.training_losses,
+                losses_fn,
                 self.ddp_model,
                 micro,
                 t,
@@ -484,17 +738,20 @@ class TrainLoop:
                 obs_mask=obs_mask,
             )
 
+            # Gradients are only all-reduced in the backward pass of the last
+            # microbatch, in buckets that overlap with the rest of it.
             if last_batch or not self.use_ddp:
                 losses = compute_losses()
             else:
                 with self.ddp_model.no_sync():
                     losses = compute_losses()
 
-            if isinstance(self.schedule_sampler, LossAwareSampler):
-                self.schedule_sampler.update_with_local_losses(
-                    t, losses['loss'].detach())
+            step_losses.append(losses['loss'].detach())
 
-            loss = (losses['loss'] * weights).mean()
+            if self.batch_mean_loss:
+                loss = (losses['loss'] * weights).sum() / batch_size
+            else:
+                loss = (losses['loss'] * weights).mean()
             log_loss_dict(self.diffusion, t,
                           {k: v * weights
                            for k, v in losses.items()})
@@ -504,6 +761,44 @@ class TrainLoop:
             else:
                 loss.backward()
 
+            if measure_memory:
+                measured_memory = (
+                    micro.shape[0],
+                    th.cuda.max_memory_allocated(dist_util.dev()) -
+                    memory_before)
+            # Prepare the next microbatch while this one is computed.
+            if not last_batch:
+                prepared = self._prepare_microbatch(batch1, batch2, masks,
+                                                    indices[i + 1])
+        if measured_memory is not None:
+            self._set_microbatch_from_memory(*measured_memory, batch_size)
+        logger.logkv_mean('padding_fraction',
+                          self._step_frames[1] / self._step_frames[0])
+        if isinstance(self.schedule_sampler, LossAwareSampler):
+            # Once per step, with the losses of the whole batch, which has at
+            # most batch_size examples on every rank.
+            self.schedule_sampler.update_with_local_losses(
+                step_ts, th.cat(step_losses), max_size=self.batch_size)
+
+    def _set_microbatch_from_memory(self, measured_size, peak_bytes,
+                                    batch_size):
+        """Set the microbatch size so that a microbatch's forward and
+        backward passes take about microbatch_memory_gb of device memory,
+        given the memory a microbatch of measured_size took. All the ranks
+        use the smallest size any of them can."""
+        peak_gb = peak_bytes / 2**30
+        size = th.tensor(max(
+            1,
+            int(self.microbatch_memory_gb * measured_size /
+                max(peak_gb, 1e-9))),
+                         device=dist_util.dev())
+        if dist.is_initialized():
+            dist.all_reduce(size, op=dist.ReduceOp.MIN)
+        self.microbatch = min(int(size.item()), batch_size)
+        self._microbatch_measured = True
+        logger.log(f'a microbatch of {measured_size} took {peak_gb:.2f} GB, '
+                   f'training with microbatches of {self.microbatch}')
+
     def optimize_fp16(self):
         if any(not th.isfinite(p.grad).all() for p in self.model_params):
             self.lg_loss_scale -= 1
@@ -531,10 +826,9 @@ class TrainLoop:
             update_ema(params, self.master_params, rate=rate)
 
     def _log_grad_norm(self):
-        sqsum = 0.0
-        for p in self.master_params:
-            sqsum += (p.grad**2).sum().item()
-        logger.logkv_mean('grad_norm', np.sqrt(sqsum))
+        sqsum = th.stack([(p.grad.float()**2).sum()
+                          for p in self.master_params]).sum()
+        logger.logkv_mean_tensor('grad_norm', sqsum.sqrt())
 
     def _anneal_lr(self):
         if not self.lr_anneal_steps:
@@ -629,16 +923,173 @@ class TrainLoop:
             'kinda_marg': kinda_marg_mask
         }
 
-    @rng_decorator(seed=0)
-    def log_samples(self):
-        sample_start = time()
+    def _get_validation_inputs(self):
+        """The masks and noise of the validation batches, and the timesteps
+        to evaluate them at, drawn once and reused at every validation."""
+        if self._valid_inputs is None:
+            # The decoder term, and a timestep in the middle of each of
+            # n_valid_timesteps buckets of equal size of the others.
+            edges = np.linspace(1, self.diffusion.num_timesteps,
+                                self.n_valid_timesteps + 1).astype(int)
+            edges = np.unique(edges)
+            t_seq = [0, *((edges[:-1] + edges[1:] - 1) // 2)]
+            batches = []
+            with RNG(0):
+                for batch in self.valid_batches:
+                    (
+                        batch,
+                        frame_indices,
+                        obs_mask,
+                        latent_mask,
+                        kinda_marg_mask,
+                    ) = self.sample_all_masks(batch)
+                    noise = th.randn(len(t_seq), *batch.shape)
+                    batches.append([
+                        t.to(dist_util.dev()) for t in [
+                            batch, frame_indices, obs_mask, latent_mask,
+                            kinda_marg_mask, noise
+                        ]
+                    ])
+            self._valid_inputs = {
+                't_seq': t_seq,
+                # The number of timesteps each evaluated timestep stands for.
+                'bucket_sizes': np.array([1, *np.diff(edges)]),
+                'batches': batches,
+            }
+        return self._valid_inputs
+
+    def log_validation_metrics(self):
+        """Log the losses of the model on the validation batches, at a fixed
+        set of timesteps and with fixed masks and noise, so that they are
+        comparable from one validation to the next.
+
+        Each validation batch takes a single forward pass (without
+        gradients) over all the timesteps, which is far cheaper than
+        log_samples(). Logs:
+        - valid/elbo_bpd: an estimate of the ELBO (in bits per dimension of
+          the latent frames) from the decoder and prior terms and one
+          timestep per bucket of the others,
+        - valid/mse: the MSE of the model output on the latent frames, over
+          all the timesteps, as the training loss would be,
+        - valid/mse_q0 to valid/mse_q3: the MSE in each quarter of the
+          timesteps, as for the training losses,
+        - valid/xstart_mse: the MSE of the x_0 predictions.
+        """
+        start = time()
+        inputs = self._get_validation_inputs()
+        t_seq = inputs['t_seq']
+        bucket_sizes = th.tensor(inputs['bucket_sizes'],
+                                 dtype=th.float,
+                                 device=dist_util.dev())
+        quartiles = (4 * th.tensor(t_seq, device=dist_util.dev()) //
+                     self.diffusion.num_timesteps).clamp(max=3)
+        metrics = []
+        was_training = self.model.training
         self.model.eval()
-        orig_state_dict = copy.deepcopy(self.model.state_dict())
-        self.model.load_state_dict(
-            copy.deepcopy(self._master_params_to_state_dict(
-                self.ema_params[0])))
+        for (batch, frame_indices, obs_mask, latent_mask, kinda_marg_mask,
+             noise) in inputs['batches']:
+            out = self.diffusion.calc_bpd_loop_subsampled(
+                self.model,
+                batch,
+                # Clipping would change the MSEs from the training losses'.
+                clip_denoised=False,
+                model_kwargs={
+                    'frame_indices': frame_indices,
+                    'obs_mask': obs_mask,
+                    'latent_mask': latent_mask,
+                    'kinda_marg_mask': kinda_marg_mask,
+                    'x0': batch,
+                    'observed_frames': self.observed_frames,
+                },
+                latent_mask=latent_mask,
+                t_seq=t_seq,
+                noise=noise,
+                timesteps_per_call=len(t_seq),
+            )
+            metrics.append({
+                'elbo_bpd':
+                (out['vb'] * bucket_sizes).sum(dim=1) + out['prior_bpd'],
+                'mse':
+                out['mse'],
+                'xstart_mse':
+                out['xstart_mse'],
+            })
+        self.model.train(was_training)
+        metrics = {
+            k: th.cat([m[k] for m in metrics], dim=0)
+            for k in metrics[0]
+        }
+        logger.logkv_mean_tensor('valid/elbo_bpd', metrics['elbo_bpd'])
+        for key in ['mse', 'xstart_mse']:
+            # Means over the timesteps, each weighted by its bucket's size.
+            per_timestep = metrics[key].mean(dim=0)
+            logger.logkv_mean_tensor(f'valid/{key}',
+                                     (per_timestep * bucket_sizes).sum() /
+                                     bucket_sizes.sum())
+        sums = th.zeros(4, device=dist_util.dev()).index_add_(
+            0, quartiles, metrics['mse'].mean(dim=0) * bucket_sizes)
+        counts = th.zeros(4, device=dist_util.dev()).index_add_(
+            0, quartiles, bucket_sizes)
+        for quartile in range(4):
+            logger.logkv_sum_tensor(f'valid/mse_q{quartile}', sums[quartile],
+                                    counts[quartile])
+        logger.logkv('timing/validation_time', time() - start)
 
+    def log_samples(self):
+        """Sample from the EMA model on the validation batches and log the
+        samples, errors and attention weights.
+
+        Sampling uses a separate replica of the model which receives a
+        snapshot of the EMA parameters, so the training model is never
+        touched. With async_sampling, the replica samples on a background
+        thread and CUDA stream, and the results are logged by the first
+        call to _poll_pending_samples() after it finishes.
+        """
+        self._finish_pending_samples()
         logger.log('sampling...')
+        if self.async_sampling:
+            # The sampling noise is drawn from the sampler's own generator
+            # (see _sample()), so training draws from the global RNG as if
+            # there were no sampling.
+            with RNG(0):
+                inputs = self._prepare_sample_inputs()
+            self._snapshot_ema_params()
+            if self._sample_executor is None:
+                self._sample_executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='log_samples')
+            self._pending_samples = self._sample_executor.submit(
+                self._sample_in_background, inputs)
+        else:
+            with RNG(0):
+                inputs = self._prepare_sample_inputs()
+                self._snapshot_ema_params()
+                results = self._sample(inputs)
+            self._log_sample_results(results)
+
+    def _get_sample_model(self):
+        if self._sample_model is None:
+            self._sample_model = copy.deepcopy(self.model)
+            for p in self._sample_model.parameters():
+                p.grad = None
+                p.requires_grad_(False)
+            self._sample_model.eval()
+        return self._sample_model
+
+    def _snapshot_ema_params(self):
+        """Copy the current EMA parameters into the sampling replica."""
+        model = self._get_sample_model()
+        state_dict = self._master_params_to_state_dict(self.ema_params[0])
+        if self._sample_stream is None:
+            model.load_state_dict(state_dict)
+            return
+        current_stream = th.cuda.current_stream()
+        self._sample_stream.wait_stream(current_stream)
+        with th.cuda.stream(self._sample_stream):
+            model.load_state_dict(state_dict)
+        # Later EMA updates must not run before the copy has been made.
+        current_stream.wait_stream(self._sample_stream)
+
+    def _prepare_sample_inputs(self):
         orig_batch = th.cat(self.valid_batches, dim=0).to(dist_util.dev())
         set_masks = self.make_interesting_masks(orig_batch)
         (
@@ -648,7 +1099,6 @@ class TrainLoop:
             latent_mask,
             kinda_marg_mask,
         ) = self.sample_all_masks(orig_batch, set_masks=set_masks)
-        sample_fn = self.diffusion.p_sample_loop
 
         def repeat(t):
             return th.repeat_interleave(t, repeats=self.n_valid_repeats, dim=0)
@@ -660,6 +1110,38 @@ class TrainLoop:
                 kinda_marg_mask
             ],
         )
+        return {
+            'batch': batch,
+            'orig_batch': orig_batch,
+            'frame_indices': frame_indices,
+            'obs_mask': obs_mask,
+            'latent_mask': latent_mask,
+            'kinda_marg_mask': kinda_marg_mask,
+            'n_preset_masks': len(set_masks['obs']) * self.n_valid_repeats,
+        }
+
+    def _sample_in_background(self, inputs):
+        th.cuda.set_device(dist_util.dev())
+        with th.cuda.stream(self._sample_stream):
+            return self._sample(inputs)
+
+    def _sample(self, inputs):
+        """Run the sampler on the replica and turn the outputs into loggable
+        CPU tensors and figures.
+
+        This does not communicate with other ranks, and draws the sampling
+        noise from its own seeded generator rather than the global RNG, so it
+        is safe to run on a background thread.
+        """
+        sample_start = time()
+        generator = th.Generator(device=dist_util.dev()).manual_seed(0)
+        model = self._get_sample_model()
+        batch = inputs['batch']
+        orig_batch = inputs['orig_batch']
+        frame_indices = inputs['frame_indices']
+        obs_mask = inputs['obs_mask']
+        latent_mask = inputs['latent_mask']
+        kinda_marg_mask = inputs['kinda_marg_mask']
 
         samples = []
         attns = []
@@ -672,21 +1154,34 @@ class TrainLoop:
         for x0, fi, om, lm, kmm in zip(*map(chunk, [
                 batch, frame_indices, obs_mask, latent_mask, kinda_marg_mask
         ])):  # noqa
-            s, a = sample_fn(
-                self.model,
-                x0.shape,
-                clip_denoised=True,
-                model_kwargs={
-                    'frame_indices': fi,
-                    'x0': x0,
-                    'obs_mask': om,
-                    'latent_mask': lm,
-                    'kinda_marg_mask': kmm,
-                    'observed_frames': self.observed_frames,
-                },
-                latent_mask=lm,
-                return_attn_weights=True,
-            )
+            model_kwargs = {
+                'frame_indices': fi,
+                'x0': x0,
+                'obs_mask': om,
+                'latent_mask': lm,
+                'kinda_marg_mask': kmm,
+                'observed_frames': self.observed_frames,
+            }
+            if self.sample_use_ddim:
+                s = self.sample_diffusion.ddim_sample_loop(
+                    model,
+                    x0.shape,
+                    clip_denoised=True,
+                    model_kwargs=model_kwargs,
+                    latent_mask=lm,
+                    generator=generator,
+                )
+                a = {}
+            else:
+                s, a = self.sample_diffusion.p_sample_loop(
+                    model,
+                    x0.shape,
+                    clip_denoised=True,
+                    model_kwargs=model_kwargs,
+                    latent_mask=lm,
+                    return_attn_weights=True,
+                    generator=generator,
+                )
             samples.append(s)
             attns.append(a)
         sample = th.cat(samples, dim=0)
@@ -711,28 +1206,21 @@ class TrainLoop:
             latent_frame_indices = frame_indices[b, is_latent]
             error_all[b, latent_frame_indices] = error[b, is_latent]
         rmse = ((error**2).mean() / latent_mask.mean()).sqrt()
-        gather_and_log_videos('sample/', vis_all, log_as='array')
-        n_samples_with_preset_masks = len(
-            set_masks['obs']) * self.n_valid_repeats
-        if n_samples_with_preset_masks > 0:
-            gather_and_log_videos('sample/',
-                                  vis[:n_samples_with_preset_masks],
-                                  log_as='video')
-        gather_and_log_videos('error/', error_all, log_as='array')
-        logger.log('sampling complete')
-        logger.logkv('timing/sampling_time', time() - sample_start)
-        logger.logkv('rmse', rmse.cpu().item())
+        results = {
+            'vis_all': vis_all.cpu(),
+            'vis_preset': vis[:inputs['n_preset_masks']].cpu(),
+            'error_all': error_all.cpu(),
+            'rmse': rmse.cpu().item(),
+            'figures': {},
+        }
 
         # visualise the attn weights ------------------------------------------
         spatial_attn = {k: v for k, v in attns.items() if 'spatial' in k}
         frame_attn = {k: v for k, v in attns.items() if 'temporal' in k}
         for k, v in spatial_attn.items():
-            logger.logkv(
-                k,
-                wandb.Image(
-                    concat_images_with_padding(v.unsqueeze(1),
-                                               horizontal=False).cpu()),
-            )
+            results['figures'][k] = wandb.Image(
+                concat_images_with_padding(v.unsqueeze(1),
+                                           horizontal=False).cpu())
         for k, attn in frame_attn.items():
             fig = Figure(figsize=(5, 4.5 * len(batch)))
             canvas = FigureCanvas(fig)  # noqa
@@ -751,9 +1239,45 @@ class TrainLoop:
                     set_ticks(np.linspace(0, n_frames - 1, n_frames))
                     set_labels(fi)  # (fi if axis == 'x' else fi[::-1])
                     set_lim(-0.5, n_frames - 0.5)
+            results['figures'][k] = fig
+        results['sampling_time'] = time() - sample_start
+        return results
+
+    def _log_sample_results(self, results):
+        # Gathering the videos communicates with the other ranks, so this has
+        # to run on the main thread, at the same step on every rank.
+        gather_and_log_videos('sample/', results['vis_all'], log_as='array')
+        if len(results['vis_preset']) > 0:
+            gather_and_log_videos('sample/',
+                                  results['vis_preset'],
+                                  log_as='video')
+        gather_and_log_videos('error/', results['error_all'], log_as='array')
+        logger.log('sampling complete')
+        logger.logkv('timing/sampling_time', results['sampling_time'])
+        logger.logkv('rmse', results['rmse'])
+        for k, fig in results['figures'].items():
             logger.logkv(k, fig)
-        self.model.train()
-        self.model.load_state_dict(orig_state_dict)
+
+    def _poll_pending_samples(self):
+        """Log the results of background sampling if every rank has
+        finished."""
+        if self._pending_samples is None:
+            return
+        done = th.tensor(float(self._pending_samples.done()),
+                         device=dist_util.dev())
+        if dist.is_initialized():
+            dist.all_reduce(done, op=dist.ReduceOp.MIN)
+        if done.item():
+            self._finish_pending_samples()
+
+    def _finish_pending_samples(self):
+        if self._pending_samples is None:
+            return
+        wait_start = time()
+        results = self._pending_samples.result()
+        self._pending_samples = None
+        logger.logkv('timing/sampling_wait_time', time() - wait_start)
+        self._log_sample_results(results)
 
     def visualise(self):
         batch = th.cat(self.valid_batches)
@@ -954,10 +1478,17 @@ def find_ema_checkpoint(main_checkpoint, step, rate, save_latest_only):
 
 
 def log_loss_dict(diffusion, ts, losses):
+    # Everything stays on the device; the logger reduces the accumulated
+    # values once per dumpkvs().
+    quartiles = (4 * ts // diffusion.num_timesteps).clamp(max=3)
+    counts = th.zeros(4, device=ts.device).index_add_(
+        0, quartiles, th.ones_like(ts, dtype=th.float))
     for key, values in losses.items():
-        logger.logkv_mean(key, values.mean().item())
+        values = values.detach().float()
+        logger.logkv_mean_tensor(key, values)
         # Log the quantiles (four quartiles, in particular).
-        for sub_t, sub_loss in zip(ts.cpu().numpy(),
-                                   values.detach().cpu().numpy()):
-            quartile = int(4 * sub_t / diffusion.num_timesteps)
-            logger.logkv_mean(f'{key}_q{quartile}', sub_loss)
+        sums = th.zeros(4,
+                        device=values.device).index_add_(0, quartiles, values)
+        for quartile in range(4):
+            logger.logkv_sum_tensor(f'{key}_q{quartile}', sums[quartile],
+                                    counts[quartile])
@@ -955,23 +955,31 @@ class CondMargVideoModel(
             indicator_template = th.ones_like(x[:, :, :1, :, :])
             obs_indicator = indicator_template * obs_mask
             kinda_marg_indicator = indicator_template * kinda_marg_mask
-            observed_dict = {
-                'x_0': x0,
-                'x_t': x,
-                'x_t_minus_1': kwargs['x_t_minus_1'],
-                'x_random': kwargs['x_random'] if self.training else None,
-                'hybrid': kwargs['hybrid'] if self.training else None,
-            }
-            if 'hybrid' in kwargs['observed_frames']:
-                threshold = int(kwargs['observed_frames'].split('_')[-1])
-                fully_diffusion_mask = ((
-                    timesteps < threshold)[:, :, None, None,
-                                           None].expand(obs_mask.shape).int())
-                observed_frames = kwargs[
-                    'x_t_minus_1'] * fully_diffusion_mask + kwargs[
-                        'hybrid'] * (1 - fully_diffusion_mask)
+            # Only the input of the observed frames selected by
+            # observed_frames is read (and computed by the diffusion).
+            mode = kwargs['observed_frames']
+            if 'hybrid' in mode:
+                threshold = int(mode.split('_')[-1])
+                fully_diffusion_mask = (timesteps < threshold).int()
+                frame_mask = fully_diffusion_mask[:, :, None, None, None]
+                observed_frames = (kwargs['x_t_minus_1'] * frame_mask +
+                                   kwargs['hybrid'] * (1 - frame_mask))
+                timesteps_obs = (fully_diffusion_mask * (timesteps - 1) +
+                                 (1 - fully_diffusion_mask) * threshold)
+            elif mode == 'x_0':
+                observed_frames = x0
+                timesteps_obs = th.zeros_like(timesteps)
+            elif mode == 'x_t':
+                observed_frames = x
+                timesteps_obs = timesteps
+            elif mode == 'x_t_minus_1':
+                observed_frames = kwargs['x_t_minus_1']
+                timesteps_obs = timesteps - 1
+            elif mode == 'x_random':
+                observed_frames = kwargs['x_random']
+                timesteps_obs = kwargs['random_t'].view(B, 1).expand(B, T)
             else:
-                observed_frames = observed_dict[kwargs['observed_frames']]
+                raise NotImplementedError(mode)
             x = th.cat(
                 [
                     x * latent_mask + observed_frames * obs_mask + x *
@@ -981,34 +989,6 @@ class CondMargVideoModel(
                 ],
                 dim=2,
             )
-            # if 'x_t_minus_1' in kwargs:
-            #     del kwargs['x_t_minus_1']
-            # if 'x_random' in kwargs:
-            #     del kwargs['x_random']
-            # if 'random_t' in kwargs:
-            #     random_t = kwargs['random_t']
-            #     del kwargs['random_t']
-            timestamp_dict = {
-                'x_0':
-                th.zeros_like(timesteps[:, 0]),
-                'x_t':
-                timesteps[:, 0].detach().clone(),
-                'x_t_minus_1':
-                timesteps[:, 0].detach().clone() - 1,
-                'x_random':
-                kwargs['random_t'].detach().clone() if self.training else None,
-            }
-            if 'hybrid' in kwargs['observed_frames']:
-                threshold = int(kwargs['observed_frames'].split('_')[-1])
-                fully_diffusion_mask = (timesteps < threshold).int()
-                timesteps_obs = (
-                    fully_diffusion_mask *
-                    timestamp_dict['x_t_minus_1'].unsqueeze(-1) +
-                    (1 - fully_diffusion_mask) *
-                    th.ones_like(timesteps[:, 0]).unsqueeze(-1) * threshold)
-            else:
-                timesteps_obs = timestamp_dict[
-                    kwargs['observed_frames']].expand(T, B).T
             timesteps = timesteps_obs * obs_mask.view(
                 B, T) + timesteps * (1 - obs_mask.view(B, T))
         elif self.cond_emb_type in ['duplicate', 'all']:
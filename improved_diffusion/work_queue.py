@@ -0,0 +1,176 @@
+"""A work queue shared by any number of evaluation workers through a
+directory of lease files.
+
+Each unit of work (e.g. one video/sample pair) is claimed by taking a lease
+on it. Workers renew their leases while they work, and a lease that is not
+renewed in time (because its worker died or was pre-empted) expires, so
+another worker can reclaim the unit. All state lives in the queue directory,
+guarded by a test_util.Protect lock, so workers only need a shared file
+system (and roughly synchronised clocks).
+"""
+
+import json
+import os
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from filelock import Timeout
+
+from .test_util import Protect
+
+
+class WorkQueue:
+    """A queue of named work units backed by a directory of lease files.
+
+    Args:
+        queue_dir: directory holding the lease files. All workers sharing the
+            work must use the same directory.
+        units: names (strings) of all the units of work.
+        is_done: optional function from a unit to whether its output already
+            exists. Units it returns True for are never claimed.
+        lease_seconds: how long a claim lasts without being renewed.
+        worker_id: name of this worker. Defaults to <host>-<pid>.
+    """
+    def __init__(self,
+                 queue_dir,
+                 units,
+                 is_done=None,
+                 lease_seconds=600,
+                 worker_id=None):
+        self.dir = Path(queue_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.units = list(units)
+        self.is_done = is_done
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self._lock = Protect(self.dir / 'queue', timeout=60)
+
+    def _lease_path(self, unit):
+        return self.dir / f'{unit}.lease'
+
+    def _done_path(self, unit):
+        return self.dir / f'{unit}.done'
+
+    def _read_lease(self, unit):
+        try:
+            with open(self._lease_path(unit)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_lease(self, unit):
+        lease = {
+            'worker': self.worker_id,
+            'expires': time.time() + self.lease_seconds
+        }
+        with open(self._lease_path(unit), 'w') as f:
+            json.dump(lease, f)
+
+    def _unit_done(self, unit):
+        return self._done_path(unit).exists() or (self.is_done is not None
+                                                  and self.is_done(unit))
+
+    def claim(self, n):
+        """Claims up to n units that are neither done nor leased by another
+        worker (expired leases are reclaimed). Returns the claimed units."""
+        claimed = []
+        with self._lock:
+            now = time.time()
+            for unit in self.units:
+                if len(claimed) == n:
+                    break
+                if self._unit_done(unit):
+                    continue
+                lease = self._read_lease(unit)
+                if (lease is not None and lease['worker'] != self.worker_id
+                        and lease['expires'] > now):
+                    continue
+                self._write_lease(unit)
+                claimed.append(unit)
+        return claimed
+
+    def renew(self, units):
+        """Extends the leases on the given units, unless another worker has
+        reclaimed them in the meantime. Returns the units still held."""
+        held = []
+        with self._lock:
+            for unit in units:
+                lease = self._read_lease(unit)
+                if lease is None or lease['worker'] == self.worker_id:
+                    self._write_lease(unit)
+                    held.append(unit)
+        return held
+
+    def complete(self, units):
+        """Marks the given units as done."""
+        with self._lock:
+            for unit in units:
+                self._done_path(unit).touch()
+                self._lease_path(unit).unlink(missing_ok=True)
+
+    def release(self, units):
+        """Gives up the leases on the given units without completing them."""
+        with self._lock:
+            for unit in units:
+                lease = self._read_lease(unit)
+                if lease is not None and lease['worker'] == self.worker_id:
+                    self._lease_path(unit).unlink(missing_ok=True)
+
+    def n_remaining(self):
+        """Number of units not done yet (including the leased ones)."""
+        return sum(not self._unit_done(unit) for unit in self.units)
+
+    @contextmanager
+    def lease(self, units):
+        """Keeps the leases on units renewed while the block runs. The units
+        are completed if the block succeeds and released otherwise."""
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    lost = set(units) - set(self.renew(units))
+                except Timeout:
+                    continue
+                if lost:
+                    print(f'WARNING: lost the lease on {sorted(lost)} to '
+                          'another worker.')
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield units
+        except BaseException:
+            stop.set()
+            thread.join()
+            self.release(units)
+            raise
+        stop.set()
+        thread.join()
+        self.complete(units)
+
+    def batches(self, batch_size, wait=True):
+        """Yields batches of up to batch_size claimed units, holding their
+        leases until the next batch is requested.
+
+        If wait is True and all remaining units are leased by other workers,
+        waits for them to either finish or let their leases expire instead of
+        returning.
+        """
+        while True:
+            try:
+                units = self.claim(batch_size)
+            except Timeout:
+                continue
+            if units:
+                with self.lease(units):
+                    yield units
+            elif wait and self.n_remaining() > 0:
+                time.sleep(
+                    random.uniform(0.5, 1.0) * min(self.lease_seconds / 4, 60))
+            else:
+                return
@@ -0,0 +1,103 @@
+"""Measures the peak memory and time of a guided sampling step
+(--use_gradient_method) for each guidance variant, on a randomly initialised
+video model, against an unguided step.
+"""
+import time
+from argparse import ArgumentParser
+
+import torch
+from video_sample import get_masks
+
+from improved_diffusion.gaussian_diffusion import GuidanceType
+from improved_diffusion.script_util import (create_video_model_and_diffusion,
+                                            video_model_and_diffusion_defaults)
+
+
+def measure(diffusion, model, x, t, model_kwargs, use_gradient_method, n_iters,
+            device):
+    """Returns the peak memory (in MB, above the memory in use before the
+    steps) and the time of a sampling step."""
+    def step():
+        diffusion.p_sample(model,
+                           x,
+                           t,
+                           model_kwargs=model_kwargs,
+                           use_gradient_method=use_gradient_method)
+
+    with torch.no_grad():
+        step()  # warm up
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            baseline = torch.cuda.memory_allocated(device)
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    seconds = (time.perf_counter() - start) / n_iters
+    if device.type != 'cuda':
+        return float('nan'), seconds
+    peak = torch.cuda.max_memory_allocated(device) - baseline
+    return peak / 2**20, seconds
+
+
+def main(args):
+    device = torch.device(args.device)
+    model_args = video_model_and_diffusion_defaults()
+    model_args.update(T=args.max_frames,
+                      image_size=args.image_size,
+                      num_channels=args.num_channels,
+                      num_res_blocks=args.num_res_blocks,
+                      rp_alpha=args.max_frames,
+                      rp_beta=args.max_frames,
+                      rp_gamma=args.max_frames)
+    model, diffusion = create_video_model_and_diffusion(**model_args)
+    model = model.to(device).eval()
+
+    B = args.batch_size
+    x0 = torch.rand(
+        B, args.max_frames, 3, args.image_size, args.image_size,
+        device=device) * 2 - 1
+    obs_mask, latent_mask, kinda_marg_mask = get_masks(x0, args.n_obs)
+    model_kwargs = dict(
+        frame_indices=torch.arange(args.max_frames,
+                                   device=device).repeat(B, 1),
+        x0=x0,
+        obs_mask=obs_mask,
+        latent_mask=latent_mask,
+        kinda_marg_mask=kinda_marg_mask,
+        x_t_minus_1=x0,
+        observed_frames='x_t_minus_1',
+    )
+    x = torch.randn_like(x0)
+    t = torch.full((B, ), diffusion.num_timesteps // 2, device=device)
+
+    variants = [
+        ('unguided', False, GuidanceType.RECONSTRUCTION, False),
+        ('reconstruction', True, GuidanceType.RECONSTRUCTION, False),
+        ('reconstruction + checkpointing', True, GuidanceType.RECONSTRUCTION,
+         True),
+        ('batched', True, GuidanceType.BATCHED, False),
+    ]
+    print(f"{'guidance':32s} {'peak MB':>10s} {'ms/step':>10s}")
+    for name, guided, guidance_type, checkpoint in variants:
+        diffusion.configure_guidance(guidance_type, checkpoint=checkpoint)
+        peak_mb, seconds = measure(diffusion, model, x, t, model_kwargs,
+                                   guided, args.n_iters, device)
+        print(f'{name:32s} {peak_mb:10.1f} {seconds * 1e3:10.1f}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--device',
+                        type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--max_frames', type=int, default=10)
+    parser.add_argument('--n_obs', type=int, default=4)
+    parser.add_argument('--image_size', type=int, default=64)
+    parser.add_argument('--num_channels', type=int, default=64)
+    parser.add_argument('--num_res_blocks', type=int, default=1)
+    parser.add_argument('--n_iters', type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,89 @@
+"""Measures the time of a full ELBO evaluation (calc_bpd_loop_subsampled) on a
+randomly initialised video model for several numbers of timesteps per model
+call, and checks that they all give the same terms as one timestep per call.
+"""
+import time
+from argparse import ArgumentParser
+
+import torch
+from video_sample import get_masks
+
+from improved_diffusion.script_util import (create_video_model_and_diffusion,
+                                            video_model_and_diffusion_defaults)
+
+
+def main(args):
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    model_args = video_model_and_diffusion_defaults()
+    model_args.update(T=args.max_frames,
+                      image_size=args.image_size,
+                      num_channels=args.num_channels,
+                      num_res_blocks=args.num_res_blocks,
+                      diffusion_steps=args.diffusion_steps,
+                      rp_alpha=args.max_frames,
+                      rp_beta=args.max_frames,
+                      rp_gamma=args.max_frames)
+    model, diffusion = create_video_model_and_diffusion(**model_args)
+    model = model.to(device).eval()
+
+    B = args.batch_size
+    x0 = torch.rand(
+        B, args.max_frames, 3, args.image_size, args.image_size,
+        device=device) * 2 - 1
+    obs_mask, latent_mask, kinda_marg_mask = get_masks(x0, args.n_obs)
+    model_kwargs = dict(
+        frame_indices=torch.arange(args.max_frames,
+                                   device=device).repeat(B, 1),
+        x0=x0,
+        obs_mask=obs_mask,
+        latent_mask=latent_mask,
+        kinda_marg_mask=kinda_marg_mask,
+        x_t_minus_1=x0,
+        observed_frames='x_0',
+    )
+    noise = torch.randn(diffusion.num_timesteps, *x0.shape)
+
+    def evaluate(timesteps_per_call):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        metrics = diffusion.calc_bpd_loop_subsampled(
+            model,
+            x0,
+            model_kwargs=model_kwargs,
+            latent_mask=latent_mask,
+            noise=noise,
+            timesteps_per_call=timesteps_per_call)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        return metrics, time.perf_counter() - start
+
+    expected, _ = evaluate(1)  # warm up
+    print(f"{'timesteps/call':>15s} {'seconds':>10s} {'videos/s':>10s} "
+          f"{'max abs error':>14s}")
+    for timesteps_per_call in args.timesteps_per_call:
+        metrics, seconds = evaluate(timesteps_per_call)
+        error = max(
+            (metrics[k] - expected[k]).abs().max().item() for k in expected)
+        print(f'{timesteps_per_call:15d} {seconds:10.2f} {B / seconds:10.2f} '
+              f'{error:14.2e}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--device',
+                        type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--timesteps_per_call',
+                        type=int,
+                        nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--max_frames', type=int, default=10)
+    parser.add_argument('--n_obs', type=int, default=4)
+    parser.add_argument('--image_size', type=int, default=32)
+    parser.add_argument('--num_channels', type=int, default=32)
+    parser.add_argument('--num_res_blocks', type=int, default=1)
+    parser.add_argument('--diffusion_steps', type=int, default=32)
+    main(parser.parse_args())
@@ -0,0 +1,105 @@
+"""Measures the per-step overhead of the diffusion sampler, i.e. the time spent
+in p_sample() outside of the model, with a tiny model so that the overhead is
+not hidden behind the network.
+
+Compares gathering the coefficients from the numpy tables at every step (as
+_extract_into_tensor() does when given an array) with the tables kept on the
+device by GaussianDiffusion._extract().
+"""
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from improved_diffusion.gaussian_diffusion import _extract_into_tensor
+from improved_diffusion.script_util import create_gaussian_diffusion
+
+
+class TinyModel(torch.nn.Module):
+    """A single convolution applied to every frame, with the interface of the
+    video models."""
+    def __init__(self, channels):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(channels, channels, 3, padding=1)
+
+    def forward(self, x, timesteps, return_attn_weights=False, **kwargs):
+        B, T = x.shape[:2]
+        out = self.conv(x.flatten(end_dim=1))
+        return out.view(B, T, *out.shape[1:]), None
+
+
+def timeit(fn, n_iters, device):
+    for _ in range(3):  # warm up (and let the JIT fuse the scripted updates)
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / n_iters
+
+
+def main(args):
+    device = torch.device(args.device)
+    diffusion = create_gaussian_diffusion(steps=args.diffusion_steps)
+    model = TinyModel(args.channels).to(device).eval()
+    shape = (args.batch_size, args.max_frames, args.channels, args.image_size,
+             args.image_size)
+    x = torch.randn(*shape, device=device)
+    t = torch.randint(0,
+                      diffusion.num_timesteps, (args.batch_size, ),
+                      device=device)
+
+    names = [
+        'sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod',
+        'posterior_mean_coef1', 'posterior_mean_coef2',
+        'fixed_large_log_variance'
+    ]
+
+    def extract_from_numpy():
+        for name in names:
+            _extract_into_tensor(getattr(diffusion, name), t, x.shape)
+
+    def extract_from_device():
+        for name in names:
+            diffusion._extract(name, t, x.shape)
+
+    def model_only():
+        with torch.no_grad():
+            model(x, t)
+
+    def sample_step():
+        with torch.no_grad():
+            diffusion.p_sample(model, x, t, clip_denoised=True)
+
+    results = {
+        'coefficient gathers (numpy tables)': extract_from_numpy,
+        'coefficient gathers (device tables)': extract_from_device,
+        'model forward': model_only,
+        'p_sample step': sample_step,
+    }
+    times = {
+        name: timeit(fn, args.n_iters, device)
+        for name, fn in results.items()
+    }
+    for name, seconds in times.items():
+        print(f'{name:40s} {seconds * 1e6:10.1f} us')
+    overhead = times['p_sample step'] - times['model forward']
+    print(
+        f"{'p_sample overhead (step - model)':40s} {overhead * 1e6:10.1f} us")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--device',
+                        type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--max_frames', type=int, default=10)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--image_size', type=int, default=32)
+    parser.add_argument('--diffusion_steps', type=int, default=1000)
+    parser.add_argument('--n_iters', type=int, default=200)
+    main(parser.parse_args())
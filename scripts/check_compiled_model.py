@@ -0,0 +1,96 @@
+"""Checks that the compiled sampling paths of compile_util give the same
+outputs as the eager model, on a small randomly initialised video model (runs
+on CPU), and reports the time per model call of each path.
+
+Exits with a non-zero status if a compiled path differs from the eager model
+or silently fell back to it.
+"""
+import sys
+import time
+from argparse import ArgumentParser
+
+import torch
+from video_sample import get_masks
+
+from improved_diffusion import compile_util
+from improved_diffusion.script_util import (create_video_model_and_diffusion,
+                                            video_model_and_diffusion_defaults)
+
+
+def time_calls(model, inputs, n_iters):
+    with torch.no_grad():
+        model(**inputs)  # compiles on the first call
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            out, _ = model(**inputs)
+    return out, (time.perf_counter() - start) / n_iters
+
+
+def main(args):
+    torch.manual_seed(0)
+    model_args = video_model_and_diffusion_defaults()
+    model_args.update(T=args.max_frames,
+                      image_size=32,
+                      num_channels=32,
+                      num_res_blocks=1,
+                      diffusion_steps=50,
+                      rp_alpha=args.max_frames,
+                      rp_beta=args.max_frames,
+                      rp_gamma=args.max_frames)
+    model, diffusion = create_video_model_and_diffusion(**model_args)
+    model = model.to(args.device).eval()
+
+    B = args.batch_size
+    x0 = torch.rand(B, args.max_frames, 3, 32, 32, device=args.device) * 2 - 1
+    obs_mask, latent_mask, kinda_marg_mask = get_masks(x0, args.n_obs)
+    frame_indices = torch.stack([
+        torch.randperm(4 * args.max_frames)[:args.max_frames].sort().values
+        for _ in range(B)
+    ]).to(args.device)
+    inputs = dict(
+        x=torch.randn_like(x0),
+        timesteps=torch.randint(0, 1000, (B, ), device=args.device),
+        frame_indices=frame_indices,
+        x0=x0,
+        obs_mask=obs_mask,
+        latent_mask=latent_mask,
+        kinda_marg_mask=kinda_marg_mask,
+        x_t_minus_1=x0,
+        observed_frames='x_0',
+    )
+
+    expected, eager_time = time_calls(model, inputs, args.n_iters)
+    print(f"{'eager':10s} {eager_time * 1e3:8.2f} ms/call")
+    failed = False
+    for mode in args.modes:
+        compiled = compile_util.InferenceModel(model, mode=mode, check=False)
+        try:
+            out, seconds = time_calls(compiled, inputs, args.n_iters)
+        except Exception as e:  # pylint: disable=broad-except
+            print(f'{mode:10s} failed: {e!r}')
+            failed = True
+            continue
+        error = (out - expected).abs().max().item()
+        fell_back = all(fn is None for fn in compiled._compiled.values())
+        ok = error <= args.atol and not fell_back
+        failed = failed or not ok
+        print(f'{mode:10s} {seconds * 1e3:8.2f} ms/call, max abs error '
+              f"{error:.2e}{' (fell back to eager)' if fell_back else ''}"
+              f"{'' if ok else '  FAILED'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--modes',
+                        type=str,
+                        nargs='+',
+                        default=['trace', 'cudagraph'],
+                        choices=compile_util.COMPILE_MODES[1:])
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--max_frames', type=int, default=10)
+    parser.add_argument('--n_obs', type=int, default=4)
+    parser.add_argument('--n_iters', type=int, default=5)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    main(parser.parse_args())
@@ -0,0 +1,123 @@
+"""Checks the progressive distillation losses
+(GaussianDiffusion.distillation_losses) on the toy video model of
+check_dpm_solver.py as the teacher:
+
+- the timesteps of each round of distillation must be every other timestep
+  of the previous round's,
+- a student whose output minimizes the losses must take in one DDIM step
+  what the teacher takes two DDIM steps for, on the latent frames.
+
+The student is a free output tensor trained on the losses for a fixed batch,
+so that the check does not depend on how well a network can fit the target.
+Runs on CPU. Exits with a non-zero status if a check fails.
+"""
+import sys
+from argparse import ArgumentParser
+
+import torch
+import torch.nn as nn
+from check_dpm_solver import GaussianVideoModel
+
+from improved_diffusion.script_util import create_gaussian_diffusion
+
+
+class FreeOutput(nn.Module):
+    """A student that outputs the same trainable tensor for any input."""
+    def __init__(self, shape):
+        super().__init__()
+        self.output = nn.Parameter(torch.zeros(shape))
+
+    def forward(self, x, timesteps, **kwargs):
+        return self.output, None
+
+
+def main(args):
+    torch.manual_seed(0)
+    failed = False
+    base = create_gaussian_diffusion(steps=args.diffusion_steps)
+    for rounds in range(1, args.rounds + 1):
+        student = base.respaced(f'distill{rounds}')
+        teacher = base.respaced(f'distill{rounds - 1}')
+        nested = student.timestep_map == teacher.timestep_map[1::2]
+        failed = failed or not nested
+        print(f'distill{rounds}: {student.num_timesteps} steps, from '
+              f"{student.timestep_map[0]} to {student.timestep_map[-1]}: "
+              f"{'ok' if nested else 'FAILED'}")
+
+    teacher_diffusion = create_gaussian_diffusion(steps=args.diffusion_steps,
+                                                  distill_rounds=args.rounds -
+                                                  1)
+    diffusion = teacher_diffusion.respaced(f'distill{args.rounds}')
+    teacher = GaussianVideoModel(
+        create_gaussian_diffusion(steps=args.diffusion_steps).alphas_cumprod,
+        args.scale)
+    shape = (args.batch_size, args.max_frames, 3, args.image_size,
+             args.image_size)
+    x_start = (torch.rand(*shape) * 2 - 1) * 0.8
+    obs_mask = torch.zeros_like(x_start[:, :, :1, :1, :1])
+    obs_mask[:, :args.n_obs] = 1
+    latent_mask = 1 - obs_mask
+    noise = torch.randn(*shape)
+    # The first and last timesteps, and random ones in between.
+    t = torch.randint(0, diffusion.num_timesteps, (args.batch_size, ))
+    t[0], t[-1] = 0, diffusion.num_timesteps - 1
+
+    def model_kwargs():
+        return dict(x0=x_start,
+                    obs_mask=obs_mask,
+                    latent_mask=latent_mask,
+                    kinda_marg_mask=torch.zeros_like(obs_mask),
+                    observed_frames='x_0')
+
+    model = FreeOutput(shape)
+    opt = torch.optim.Adam(model.parameters(), lr=args.lr)
+    for _ in range(args.steps):
+        losses = diffusion.distillation_losses(
+            model,
+            x_start,
+            t,
+            model_kwargs=model_kwargs(),
+            latent_mask=latent_mask,
+            eval_mask=latent_mask,
+            noise=noise,
+            teacher=teacher,
+            teacher_diffusion=teacher_diffusion)
+        opt.zero_grad()
+        losses['loss'].sum().backward()
+        opt.step()
+
+    x_t = diffusion.q_sample(x_start, t, noise=noise)
+    with torch.no_grad():
+        expected = x_t
+        for teacher_t in [2 * t + 1, 2 * t]:
+            expected = teacher_diffusion.ddim_sample(
+                teacher, expected, teacher_t,
+                model_kwargs=model_kwargs())['sample']
+        sample = diffusion.ddim_sample(model,
+                                       x_t,
+                                       t,
+                                       clip_denoised=False,
+                                       model_kwargs=model_kwargs())['sample']
+    is_latent = latent_mask.bool().expand(shape)
+    error = (sample - expected)[is_latent].abs().max().item()
+    step_ok = error <= args.tolerance
+    print(f'Student DDIM step vs two teacher DDIM steps: max abs error '
+          f"{error:.2e} ({'ok' if step_ok else 'FAILED'}), final loss "
+          f"{losses['loss'].mean().item():.2e}")
+    failed = failed or not step_ok
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--lr', type=float, default=0.05)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    parser.add_argument('--scale', type=float, default=0.5)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--max_frames', type=int, default=6)
+    parser.add_argument('--n_obs', type=int, default=2)
+    parser.add_argument('--image_size', type=int, default=8)
+    parser.add_argument('--diffusion_steps', type=int, default=1000)
+    main(parser.parse_args())
@@ -0,0 +1,155 @@
+"""Checks the DPM-Solver++ sampler (improved_diffusion.dpm_solver) on a toy
+video model whose predictions are exact for Gaussian data, so that the
+probability flow ODE has a closed form solution:
+
+- the first order solver must match DDIM on the same timesteps,
+- the observed frames of the samples must be the observed frames given,
+- with the most steps (25 by default), the higher order solvers must be
+  closer to the exact solution than the first order one, and within a
+  tolerance of it.
+
+The solver runs on quadratically spaced timesteps by default (see
+respace.space_timesteps); on uniformly spaced ones, the first steps are so
+large that the higher orders need more steps for the same error.
+
+The latent frames of the toy data are Gaussian around the mean of the observed
+frames, so the check also fails if the observed frames do not reach the
+model. Runs on CPU. Exits with a non-zero status if a check fails.
+"""
+import sys
+from argparse import ArgumentParser
+
+import torch
+import torch.nn as nn
+
+from improved_diffusion.dpm_solver import dpm_solver_sample_loop
+from improved_diffusion.script_util import create_gaussian_diffusion
+
+
+class GaussianVideoModel(nn.Module):
+    """Predicts the noise exactly for videos whose latent frames are
+    N(mu, scale^2) per pixel, where mu is half the mean of the observed
+    frames."""
+    def __init__(self, alphas_cumprod, scale):
+        super().__init__()
+        self.register_buffer('alphas_cumprod',
+                             torch.tensor(alphas_cumprod, dtype=torch.float64))
+        self.scale = scale
+
+    def mean(self, x0, obs_mask):
+        return 0.5 * (x0 * obs_mask).sum(1, keepdim=True) / obs_mask.sum(
+            1, keepdim=True)
+
+    def forward(self, x, timesteps, x0, obs_mask, **kwargs):
+        alpha_bar = self.alphas_cumprod[timesteps].view(-1, 1, 1, 1, 1)
+        alpha, sigma = alpha_bar.sqrt(), (1 - alpha_bar).sqrt()
+        variance = alpha_bar * self.scale**2 + sigma**2
+        eps = sigma * (x.double() - alpha * self.mean(x0, obs_mask)) / variance
+        return eps.float(), None
+
+    def exact_sample(self, x_T, t_T, x0, obs_mask):
+        """The x_0 prediction at timestep 0 at the end of the ODE trajectory
+        from x_T at timestep t_T."""
+        mu = self.mean(x0, obs_mask)
+
+        def std(t):
+            alpha_bar = self.alphas_cumprod[t]
+            return (alpha_bar * self.scale**2 + 1 - alpha_bar).sqrt()
+
+        z = (x_T.double() - self.alphas_cumprod[t_T].sqrt() * mu) / std(t_T)
+        return (mu + z * self.scale**2 * self.alphas_cumprod[0].sqrt() /
+                std(0)).float()
+
+
+def main(args):
+    torch.manual_seed(0)
+    diffusion = create_gaussian_diffusion(steps=args.diffusion_steps)
+    model = GaussianVideoModel(diffusion.alphas_cumprod, args.scale)
+    shape = (args.batch_size, args.max_frames, 3, args.image_size,
+             args.image_size)
+    x0 = (torch.rand(*shape) * 2 - 1) * 0.8
+    obs_mask = torch.zeros_like(x0[:, :, :1, :1, :1])
+    obs_mask[:, :args.n_obs] = 1
+    latent_mask = 1 - obs_mask
+    model_kwargs = dict(x0=x0,
+                        obs_mask=obs_mask,
+                        latent_mask=latent_mask,
+                        kinda_marg_mask=torch.zeros_like(obs_mask),
+                        observed_frames='x_0')
+    noise = torch.randn(*shape)
+    exact = model.exact_sample(noise, diffusion.num_timesteps - 1, x0,
+                               obs_mask)
+    is_latent = latent_mask.bool().expand(shape)
+
+    def latent_error(sample, reference):
+        return (sample - reference)[is_latent].abs().max().item()
+
+    ddim = diffusion.ddim_sample_loop(model,
+                                      shape,
+                                      noise=noise,
+                                      device='cpu',
+                                      clip_denoised=False,
+                                      model_kwargs=dict(model_kwargs))
+    ddim_error = latent_error(ddim, exact)
+    print(f'DDIM, {diffusion.num_timesteps} steps: max abs error '
+          f'{ddim_error:.2e} from the exact solution.')
+
+    failed = False
+    print(f"{'order':>5s} {'steps':>5s} {'vs exact':>10s} "
+          f"{'vs DDIM':>10s} {'obs kept':>9s}")
+    for order in args.orders:
+        errors = []
+        for steps in args.steps:
+            respaced = diffusion.respaced(steps if args.spacing ==
+                                          'uniform' else f'quad{steps}')
+            sample = dpm_solver_sample_loop(respaced,
+                                            model,
+                                            shape,
+                                            noise=noise,
+                                            device='cpu',
+                                            clip_denoised=False,
+                                            model_kwargs=dict(model_kwargs),
+                                            order=order)
+            errors.append(latent_error(sample, exact))
+            obs_kept = bool((sample[~is_latent] == x0[~is_latent]).all())
+            failed = failed or not obs_kept
+            print(f'{order:5d} {steps:5d} {errors[-1]:10.2e} '
+                  f'{latent_error(sample, ddim):10.2e} {str(obs_kept):>9s}')
+            if order == 1:
+                same_grid_ddim = respaced.ddim_sample_loop(
+                    model,
+                    shape,
+                    noise=noise,
+                    device='cpu',
+                    clip_denoised=False,
+                    model_kwargs=dict(model_kwargs))
+                if latent_error(sample, same_grid_ddim) > 1e-4:
+                    print('  FAILED: differs from DDIM on the same steps.')
+                    failed = True
+        if order == 1:
+            first_order_error = errors[-1]
+        elif errors[-1] > min(args.tolerance, first_order_error):
+            print(f'  FAILED: error above {args.tolerance:g} or the first '
+                  f'order error with {args.steps[-1]} steps.')
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--orders', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--steps',
+                        type=int,
+                        nargs='+',
+                        default=[10, 15, 20, 25])
+    parser.add_argument('--spacing',
+                        default='quad',
+                        choices=['quad', 'uniform'])
+    parser.add_argument('--tolerance', type=float, default=5e-2)
+    parser.add_argument('--scale', type=float, default=0.5)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--max_frames', type=int, default=6)
+    parser.add_argument('--n_obs', type=int, default=2)
+    parser.add_argument('--image_size', type=int, default=8)
+    parser.add_argument('--diffusion_steps', type=int, default=1000)
+    main(parser.parse_args())
@@ -0,0 +1,123 @@
+"""Checks that the optimal schedule search (video_optimal_schedule.py) gives
+the same candidate MSEs when its candidates are spread over several devices
+as on a single device, on the toy video model of check_dpm_solver.py:
+
+- every input of each model replica must be on the replica's device,
+- the MSEs of every candidate must match the single device ones,
+- the results must be plain Python numbers, which torch.load() loads with
+  weights_only (as the partial schedule is reloaded).
+
+By default, the candidates are spread over all the CUDA devices if there are
+at least two, and over two threads on the CPU otherwise (which does not check
+the devices of the inputs). Exits with a non-zero status if a check fails.
+"""
+import copy
+import sys
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+
+import torch
+from check_dpm_solver import GaussianVideoModel
+from torch.utils.data import DataLoader, TensorDataset
+from video_optimal_schedule import CandidateEvaluator, update_schedule_on_disk
+
+from improved_diffusion.script_util import create_gaussian_diffusion
+
+
+class DeviceCheckingModel(GaussianVideoModel):
+    """Fails if an input is not on the device of the model."""
+    def forward(self, x, timesteps, **kwargs):
+        device = self.alphas_cumprod.device
+        for name, value in [('x', x), ('timesteps', timesteps),
+                            *kwargs.items()]:
+            if torch.is_tensor(value) and value.device != device:
+                raise RuntimeError(f'{name} is on {value.device}, but the '
+                                   f'model is on {device}.')
+        return super().forward(x, timesteps, **kwargs)
+
+
+def main(args):
+    torch.manual_seed(0)
+    devices = args.devices
+    if devices is None:
+        n_cuda = torch.cuda.device_count()
+        devices = ([f'cuda:{i}'
+                    for i in range(n_cuda)] if n_cuda >= 2 else ['cpu', 'cpu'])
+    print(f'Devices: {devices}')
+    diffusion = create_gaussian_diffusion(steps=args.diffusion_steps)
+    model = DeviceCheckingModel(diffusion.alphas_cumprod, args.scale)
+    videos = (torch.rand(args.n_videos, args.T, 3, args.image_size,
+                         args.image_size) * 2 - 1) * 0.8
+    dataloader = DataLoader(TensorDataset(videos, torch.zeros(len(videos))),
+                            batch_size=args.batch_size)
+    latent_frame_indices = [args.T - 2, args.T - 1]
+    obs_frame_indices = [0]
+    candidates = list(range(1, args.T - 2))
+    kwargs = dict(latent_frame_indices=latent_frame_indices,
+                  obs_frame_indices=obs_frame_indices,
+                  diffusion=diffusion,
+                  dataloader=dataloader,
+                  num_timesteps=args.num_timesteps,
+                  seed=0)
+
+    failed = False
+    results = {}
+    for name, evaluator_devices in [('single', devices[:1]),
+                                    ('spread', devices)]:
+        evaluator = CandidateEvaluator(copy.deepcopy(model),
+                                       devices=evaluator_devices,
+                                       candidate_batch_size=1)
+        try:
+            results[name] = evaluator.evaluate(candidates, **kwargs)
+        except RuntimeError as e:
+            print(f'{name}: FAILED: {e}')
+            sys.exit(1)
+
+    error = max(
+        abs(a - b) for candidate in candidates
+        for t in results['single'][candidate] for a, b in zip(
+            results['single'][candidate][t], results['spread'][candidate][t]))
+    same = (results['single'].keys() == results['spread'].keys()
+            and error <= args.tolerance)
+    print(f'{len(candidates)} candidates on {len(devices)} devices vs one: '
+          f"max abs MSE difference {error:.2e} ({'ok' if same else 'FAILED'})")
+    failed = failed or not same
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'partial.pt'
+        try:
+            # One save per candidate, as the search saves its progress after
+            # each chunk. Each save reloads the previous ones.
+            for candidate, candidate_results in results['spread'].items():
+                update_schedule_on_disk(
+                    path,
+                    {('candidates', 0, 1): {
+                         candidate: candidate_results
+                     }},
+                    force=False)
+            torch.load(path)
+            loads = True
+        except Exception as e:  # pylint: disable=broad-except
+            print(e)
+            loads = False
+    print(f"Progress saved and reloaded: {'ok' if loads else 'FAILED'}")
+    failed = failed or not loads
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--devices',
+                        nargs='+',
+                        default=None,
+                        help='e.g. "cuda:0 cuda:1".')
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    parser.add_argument('--scale', type=float, default=0.5)
+    parser.add_argument('--n_videos', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_timesteps', type=int, default=4)
+    parser.add_argument('--T', type=int, default=8)
+    parser.add_argument('--image_size', type=int, default=8)
+    parser.add_argument('--diffusion_steps', type=int, default=1000)
+    main(parser.parse_args())
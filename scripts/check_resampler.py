@@ -0,0 +1,108 @@
+"""Checks that LossSecondMomentResampler keeps the same loss history (and so
+gives the same weights) as a plain Python reimplementation of the per-loss
+updates, on random updates with repeated timesteps, and that its samples
+follow its weights. Runs on CPU, in a single-process gloo group.
+
+Exits with a non-zero status if a check fails.
+"""
+import os
+import sys
+from argparse import ArgumentParser
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from improved_diffusion.resample import LossSecondMomentResampler
+
+
+class ReferenceResampler:
+    """The loss history updated one loss at a time, shifting out the oldest
+    loss of a full history."""
+    def __init__(self, num_timesteps, history_per_term):
+        self.history_per_term = history_per_term
+        self.loss_history = np.zeros([num_timesteps, history_per_term])
+        self.loss_counts = np.zeros([num_timesteps], dtype=np.int64)
+
+    def update_with_all_losses(self, ts, losses):
+        for t, loss in zip(ts, losses):
+            if self.loss_counts[t] == self.history_per_term:
+                self.loss_history[t, :-1] = self.loss_history[t, 1:]
+                self.loss_history[t, -1] = loss
+            else:
+                self.loss_history[t, self.loss_counts[t]] = loss
+                self.loss_counts[t] += 1
+
+
+def main(args):
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '29512')
+    dist.init_process_group('gloo', rank=0, world_size=1)
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    diffusion = SimpleNamespace(num_timesteps=args.num_timesteps)
+    sampler = LossSecondMomentResampler(diffusion,
+                                        history_per_term=args.history)
+    reference = ReferenceResampler(args.num_timesteps, args.history)
+
+    failed = False
+    for step in range(args.steps):
+        t, _ = sampler.sample(args.batch_size, 'cpu')
+        # Few distinct timesteps, so that updates repeat timesteps (more
+        # often than the history length).
+        t = t % args.distinct_timesteps
+        losses = torch.from_numpy(rng.rand(args.batch_size))
+        sampler.update_with_local_losses(t, losses)
+        reference.update_with_all_losses(t.tolist(), losses.tolist())
+
+        counts = sampler.state_dict()['loss_counts']
+        history = np.sort(sampler.state_dict()['loss_history'], axis=1)
+        expected = np.sort(reference.loss_history, axis=1)
+        if not ((counts == reference.loss_counts).all()
+                and np.allclose(history, expected)):
+            print(f'step {step}: the loss history differs from the reference.')
+            failed = True
+            break
+    print(f'History after {args.steps} updates: '
+          f"{'FAILED' if failed else 'ok'}")
+
+    # Fill the history of every timestep, and compare the weights and the
+    # sampled frequencies with the reference's.
+    ts = np.repeat(np.arange(args.num_timesteps), args.history)
+    losses = rng.rand(len(ts)) * (1 + ts)
+    sampler.update_with_all_losses(torch.from_numpy(ts),
+                                   torch.from_numpy(losses))
+    reference.update_with_all_losses(ts, losses)
+    expected = np.sqrt(np.mean(reference.loss_history**2, axis=-1))
+    expected /= expected.sum()
+    expected = expected * (1 - sampler.uniform_prob) + (sampler.uniform_prob /
+                                                        args.num_timesteps)
+    weights_ok = np.allclose(sampler.weights(), expected)
+    t, weights = sampler.sample(args.n_samples, 'cpu')
+    frequencies = np.bincount(t.numpy(), minlength=args.num_timesteps)
+    frequencies = frequencies / args.n_samples
+    # Four standard deviations of the frequencies.
+    bound = 4 * np.sqrt(expected * (1 - expected) / args.n_samples)
+    sampling_ok = (np.abs(frequencies - expected) <= bound).all()
+    reweighting_ok = np.allclose(weights.numpy(),
+                                 1 /
+                                 (args.num_timesteps * expected[t.numpy()]),
+                                 rtol=1e-5)
+    print(f"Weights: {'ok' if weights_ok else 'FAILED'}")
+    print(f"Sampled frequencies: {'ok' if sampling_ok else 'FAILED'}")
+    print(f"Loss reweighting: {'ok' if reweighting_ok else 'FAILED'}")
+    failed = failed or not (weights_ok and sampling_ok and reweighting_ok)
+    dist.destroy_process_group()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--num_timesteps', type=int, default=50)
+    parser.add_argument('--history', type=int, default=4)
+    parser.add_argument('--distinct_timesteps', type=int, default=7)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--n_samples', type=int, default=200000)
+    main(parser.parse_args())
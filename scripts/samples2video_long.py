@@ -8,8 +8,8 @@ import PIL
 import torch
 from tqdm.auto import tqdm
 
-from improved_diffusion.test_util import (mark_as_observed, tensor2avi,
-                                          tensor2gif, tensor2mp4)
+from improved_diffusion.test_util import (FrameFile, mark_as_observed,
+                                          tensor2avi, tensor2gif, tensor2mp4)
 
 if __name__ == '__main__':
     parser = ArgumentParser()
@@ -43,7 +43,11 @@ if __name__ == '__main__':
     if not args.force:
         assert not out_path.exists(), f'{out_path} already exists.'
 
-    if args.path.is_dir():
+    # A video streamed by video_sample_long.py --output_format memmap
+    streamed = args.path.is_dir() and (args.path / 'frames.json').exists()
+    if streamed:
+        filenames = [args.path / 'frames']
+    elif args.path.is_dir():
         filenames = list(args.path.glob('video_*.npy'))
         filenames.sort(key=lambda x: int(x.stem.split('_')[-1]))
     else:
@@ -59,7 +63,10 @@ if __name__ == '__main__':
 
     random_str = uuid.uuid4()
 
-    video = np.concatenate([np.load(f) for f in filenames], axis=0)
+    if streamed:
+        video = np.array(FrameFile(filenames[0]).read())
+    else:
+        video = np.concatenate([np.load(f) for f in filenames], axis=0)
     if args.obs_length > 0:
         mark_as_observed(video[:args.obs_length])
     # Add a final frame to mark the end of the video
@@ -0,0 +1,214 @@
+"""Runs video_sample.py and video_nll.py jobs in a long-lived process that
+keeps the models loaded between jobs (see improved_diffusion.sampling_service).
+
+Start the daemon once:
+    python scripts/sampling_daemon.py serve --capacity 2
+then send it jobs with the command line arguments of the scripts:
+    python scripts/sampling_daemon.py sample -- <checkpoint> --inference_mode autoreg --indices 0 1 2 3
+    python scripts/sampling_daemon.py nll -- <checkpoint> --inference_mode autoreg --indices 0 1 2 3
+The outputs are written to the same files as the scripts would write them, and
+their paths are printed as each batch finishes. Checkpoints are loaded on
+their first job, and stay loaded (with all their respacings and compiled
+versions) until the least recently used ones are dropped to load others.
+Run the daemon from the directory the scripts would be run from: the outputs
+go to the same (relative) paths.
+"""
+import json
+import logging
+import sys
+from argparse import ArgumentParser
+from functools import lru_cache
+from pathlib import Path
+
+import torch
+import video_nll
+import video_sample
+
+from improved_diffusion import test_util
+from improved_diffusion.image_datasets import (default_T_dict,
+                                               get_test_dataset,
+                                               get_train_dataset)
+from improved_diffusion.sampling_service import (DEFAULT_ADDRESS,
+                                                 PUBLIC_AUTHKEY, ModelPool,
+                                                 SamplingServer, send_request)
+
+dataset_getters = dict(train=get_train_dataset, test=get_test_dataset)
+
+
+@lru_cache(maxsize=8)
+def load_dataset(partition, dataset_name, T):
+    return dataset_getters[partition](dataset_name=dataset_name, T=T)
+
+
+def get_model(pool, args):
+    """Returns the model and diffusion for the job, and a copy of the model
+    config updated as the scripts update it."""
+    model, diffusion, model_args = pool.get(
+        args.checkpoint_path,
+        timestep_respacing=args.timestep_respacing,
+        compile_mode=getattr(args, 'compile_mode', 'none'))
+    model_args = vars(model_args).copy()
+    model_args.update(use_ddim=args.use_ddim,
+                      timestep_respacing=args.timestep_respacing)
+    if getattr(args, 'override_dataset', None) is not None:
+        model_args['dataset'] = args.override_dataset
+    if args.max_frames is None:
+        args.max_frames = model_args['max_frames']
+    return model, diffusion, model_args
+
+
+def save_model_config(args, model_args):
+    json_path = args.eval_dir / 'model_config.json'
+    if not json_path.exists():
+        with test_util.Protect(json_path):  # avoids race conditions
+            with open(json_path, 'w') as f:
+                json.dump(model_args, f, indent=4)
+
+
+def batches(indices, batch_size):
+    for i in range(0, len(indices), batch_size):
+        yield indices[i:i + batch_size]
+
+
+def handle_sample(pool, request):
+    args = video_sample.create_argparser().parse_args(request['argv'])
+    assert args.dataset_partition != 'variable_length', \
+        'variable_length is not supported by the daemon.'
+    assert not (args.just_visualise or args.work_queue)
+    # As in video_sample.py, the identifier uses the max_frames and T given.
+    args.eval_dir = test_util.get_model_results_path(
+        args) / test_util.get_eval_run_identifier(args)
+    model, diffusion, model_args = get_model(pool, args)
+    test_util.configure_guidance(diffusion, args)
+    test_util.configure_sampler(args, model_args.get('distill_rounds', 0))
+    (args.eval_dir / 'samples').mkdir(parents=True, exist_ok=True)
+    dataset = load_dataset(args.dataset_partition, model_args['dataset'],
+                           args.T)
+    if args.indices is None:
+        args.indices = list(
+            range(
+                len(dataset) if args.subset_size is None else args.subset_size)
+        )
+    if args.T is None:
+        args.T = dataset[0][0].shape[0]
+    save_model_config(args, model_args)
+    optimal_schedule_path = (None if args.optimality is None else
+                             args.eval_dir / 'optimal_schedule.pt')
+    # infer_video reads the arguments of the run from the module.
+    video_sample.args = args
+    sample_indices = (range(args.num_samples)
+                      if args.sample_idx is None else [args.sample_idx])
+    for video_indices in batches(args.indices, args.batch_size):
+        batch = torch.stack([dataset[i][0] for i in video_indices])
+        for sample_idx in sample_indices:
+            file_ids = [f'{i:04d}-{sample_idx}' for i in video_indices]
+            video_sample.sample_and_save(args, model, diffusion, batch,
+                                         file_ids, optimal_schedule_path,
+                                         args.use_gradient_method)
+            yield [
+                str(args.eval_dir / 'samples' / f'sample_{file_id}.npy')
+                for file_id in file_ids
+            ]
+
+
+def handle_nll(pool, request):
+    args = video_nll.create_argparser().parse_args(request['argv'])
+    assert not args.work_queue
+    args.adaptive = 'adaptive' in args.inference_mode
+    model, diffusion, model_args = get_model(pool, args)
+    args.eval_dir = test_util.get_model_results_path(
+        args) / test_util.get_eval_run_identifier(args)
+    (args.eval_dir / 'elbos').mkdir(parents=True, exist_ok=True)
+    if args.T is None:
+        args.T = default_T_dict[model_args['dataset']]
+    dataset = load_dataset(args.dataset_partition, model_args['dataset'],
+                           args.T)
+    args.test_set_size = len(dataset)
+    if args.indices is None:
+        args.indices = list(range(len(dataset)))
+    if args.indices_path is None:
+        args.indices_path = args.eval_dir / 'frame_indices.pt'
+    postfix = video_nll.get_postfix(args)
+    video_nll.create_proposal(args, diffusion)
+    save_model_config(args, model_args)
+    optimal_schedule_path = (None if args.optimality is None else
+                             args.eval_dir / 'optimal_schedule.pt')
+    for video_indices in batches(args.indices, args.batch_size):
+        batch = torch.stack([dataset[i][0] for i in video_indices])
+        video_nll.evaluate_and_save(args,
+                                    model,
+                                    diffusion,
+                                    batch,
+                                    video_indices,
+                                    optimal_schedule_path,
+                                    postfix=postfix)
+        yield [
+            str(args.eval_dir / 'elbos' / f'elbo_{i}{postfix}.pkl')
+            for i in video_indices
+        ]
+
+
+def parse_address(address):
+    """host:port, or the path of a Unix socket."""
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return address
+
+
+def get_authkey(args):
+    """None for the random authkey of the server (see
+    sampling_service.create_authkey)."""
+    return PUBLIC_AUTHKEY if args.public_authkey else None
+
+
+def serve(args):
+    logging.basicConfig(format='%(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    video_sample.logger = logging.getLogger()
+    video_sample.drange = [-1, 1]
+    pool = ModelPool(capacity=args.capacity, device=args.device)
+    server = SamplingServer(pool,
+                            dict(sample=handle_sample, nll=handle_nll),
+                            address=parse_address(args.address),
+                            authkey=get_authkey(args))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    job_args = []
+    if '--' in argv:
+        job_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    parser = ArgumentParser()
+    parser.add_argument(
+        'op', choices=['serve', 'sample', 'nll', 'stats', 'shutdown'])
+    parser.add_argument('--address',
+                        type=str,
+                        default=f'{DEFAULT_ADDRESS[0]}:{DEFAULT_ADDRESS[1]}',
+                        help='host:port, or the path of a Unix socket.')
+    parser.add_argument(
+        '--capacity',
+        type=int,
+        default=2,
+        help='With serve, the number of checkpoints to keep loaded.')
+    parser.add_argument(
+        '--public_authkey',
+        action='store_true',
+        help='Use the authkey in the repository instead of a random one only '
+        'the current user can read. Any user of the machine can then run code '
+        'as the server\'s user. The server and its clients must agree.')
+    parser.add_argument('--device',
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args(argv)
+    if args.op == 'serve':
+        serve(args)
+    else:
+        # Relative paths are relative to the client's working directory.
+        if job_args:
+            job_args[0] = str(Path(job_args[0]).resolve())
+        for result in send_request(dict(op=args.op, argv=job_args),
+                                   address=parse_address(args.address),
+                                   authkey=get_authkey(args)):
+            print('\n'.join(result) if isinstance(result, list) else result)
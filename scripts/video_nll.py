@@ -17,11 +17,14 @@ from improved_diffusion import dist_util, logger, test_util
 from improved_diffusion.image_datasets import (default_T_dict,
                                                get_test_dataset,
                                                get_train_dataset, load_data)
-from improved_diffusion.inference_util import inference_strategies
+from improved_diffusion.inference_util import (get_inference_strategy,
+                                               inference_strategies)
+from improved_diffusion.resample import LossSecondMomentResampler
 from improved_diffusion.script_util import (args_to_dict,
                                             create_video_model_and_diffusion,
                                             str2bool,
                                             video_model_and_diffusion_defaults)
+from improved_diffusion.work_queue import WorkQueue
 
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
@@ -39,7 +42,8 @@ def get_eval_frame_indices(args, batch=None, optimal_schedule_path=None):
         print('loaded inference frame indices')
     else:
         adaptive_kwargs = dict(distance='lpips') if args.adaptive else {}
-        frame_indices_iterator = inference_strategies[args.inference_mode](
+        frame_indices_iterator = get_inference_strategy(
+            args.inference_mode,
             video_length=args.T,
             num_obs=args.obs_length,
             max_frames=args.max_frames,
@@ -82,6 +86,103 @@ def get_eval_frame_indices(args, batch=None, optimal_schedule_path=None):
     return obs_indices, lat_indices
 
 
+def evaluate_and_save(args,
+                      model,
+                      diffusion,
+                      batch,
+                      video_indices,
+                      optimal_schedule_path,
+                      postfix=''):
+    """Computes the ELBOs of the videos in batch (with dataset indices
+    video_indices) and saves them, unless they all exist already."""
+    fnames = [
+        args.eval_dir / 'elbos' / f'elbo_{video_idx}{postfix}.pkl'
+        for video_idx in video_indices
+    ]
+    if all([os.path.exists(f) for f in fnames]):
+        print('Already exist. Skipping', fnames)
+        return
+    obs_indices, lat_indices = get_eval_frame_indices(
+        args,
+        batch=batch if args.adaptive else None,
+        optimal_schedule_path=optimal_schedule_path,
+    )
+    batch_obs_indices = (obs_indices if args.adaptive else
+                         [obs_indices[i] for i in video_indices])
+    batch_lat_indices = (lat_indices if args.adaptive else
+                         [lat_indices[i] for i in video_indices])
+    returns = []
+    n_index_types = len(batch_obs_indices[0])
+    for i in range(n_index_types):
+        obs_indices = [b[i] for b in batch_obs_indices]
+        lat_indices = [b[i] for b in batch_lat_indices]
+        returns.append(
+            run_bpd_evaluation(
+                model=model,
+                diffusion=diffusion,
+                batch=batch,
+                clip_denoised=args.clip_denoised,
+                obs_indices=obs_indices,
+                lat_indices=lat_indices,
+                timesteps_per_call=args.timesteps_per_call,
+                memory_budget_gb=args.nll_memory_gb,
+                **importance_sampling_kwargs(args),
+            ))
+    returns = {
+        k: np.stack([r[k] for r in returns], axis=1)
+        for k in returns[0].keys()
+    }
+    for j in range(len(returns['total_bpd'])):
+        fname = fnames[j]
+        pickle.dump({k: v[j] for k, v in returns.items()}, open(fname, 'wb'))
+        print('Saved to', fname)
+    if args.importance_sampling:
+        save_proposal(args)
+
+
+def get_postfix(args):
+    """The postfix of the ELBO file names of the run."""
+    postfix = ''
+    if args.use_ddim:
+        postfix += '_ddim'
+    if args.timestep_respacing != '':
+        postfix += '_' + f'respace{args.timestep_respacing}'
+    if args.importance_sampling:
+        postfix += '_is'
+    return postfix
+
+
+def create_proposal(args, diffusion):
+    """Sets args.proposal to the loss-aware timestep proposal of
+    --importance_sampling, loaded from args.nll_proposal if it exists."""
+    args.proposal = None
+    if not args.importance_sampling:
+        return
+    if args.nll_proposal is None:
+        args.nll_proposal = args.eval_dir / 'nll_proposal.npz'
+    args.proposal = LossSecondMomentResampler(diffusion)
+    if os.path.exists(args.nll_proposal):
+        with np.load(args.nll_proposal) as state:
+            args.proposal.load_state_dict(dict(state))
+        print(f'Loaded the timestep proposal from {args.nll_proposal}')
+
+
+def save_proposal(args):
+    tmp_path = f'{args.nll_proposal}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, **args.proposal.state_dict())
+    os.replace(tmp_path, args.nll_proposal)
+
+
+def importance_sampling_kwargs(args):
+    if not args.importance_sampling:
+        return {}
+    return dict(proposal=args.proposal,
+                tolerance=args.nll_tolerance,
+                confidence=args.nll_confidence,
+                samples_per_round=args.nll_samples_per_round,
+                max_samples=args.nll_max_timesteps)
+
+
 def main(args, model, diffusion, dataloader, postfix='', dataset_indices=None):
     optimal_schedule_path = (None if args.optimality is None else
                              args.eval_dir / 'optimal_schedule.pt')
@@ -91,65 +192,75 @@ def main(args, model, diffusion, dataloader, postfix='', dataset_indices=None):
 
     cnt = 0
     for i, (batch, _) in enumerate(dataloader):
-        fnames = [
-            args.eval_dir / 'elbos' /
-            f'elbo_{dataset_idx_translate(cnt+j)}{postfix}.pkl'
-            for j in range(len(batch))
+        video_indices = [
+            dataset_idx_translate(cnt + j) for j in range(len(batch))
         ]
-        if all([os.path.exists(f) for f in fnames]):
-            print('Already exist. Skipping', fnames)
-            cnt += len(batch)
-            continue
-        obs_indices, lat_indices = get_eval_frame_indices(
-            args,
-            batch=batch if args.adaptive else None,
-            optimal_schedule_path=optimal_schedule_path,
-        )
-        if not args.adaptive:
-            # frame_indices = ([obs_indices[i] for i in args.indices], [lat_indices[i] for i in args.indices],)
-            obs_indices = [obs_indices[i] for i in args.indices]
-            lat_indices = [lat_indices[i] for i in args.indices]
-        batch_obs_indices = (obs_indices if args.adaptive else
-                             obs_indices[cnt:cnt + len(batch)])
-        batch_lat_indices = (lat_indices if args.adaptive else
-                             lat_indices[cnt:cnt + len(batch)])
-        returns = []
-        n_index_types = len(batch_obs_indices[0])
-        for i in range(n_index_types):
-            obs_indices = [b[i] for b in batch_obs_indices]
-            lat_indices = [b[i] for b in batch_lat_indices]
-            returns.append(
-                run_bpd_evaluation(
-                    model=model,
-                    diffusion=diffusion,
-                    batch=batch,
-                    clip_denoised=args.clip_denoised,
-                    obs_indices=obs_indices,
-                    lat_indices=lat_indices,
-                ))
-        returns = {
-            k: np.stack([r[k] for r in returns], axis=1)
-            for k in returns[0].keys()
-        }
-        for j in range(len(returns['total_bpd'])):
-            fname = fnames[j]
-            pickle.dump({k: v[j]
-                         for k, v in returns.items()}, open(fname, 'wb'))
-            print('Saved to', fname)
+        evaluate_and_save(args,
+                          model,
+                          diffusion,
+                          batch,
+                          video_indices,
+                          optimal_schedule_path,
+                          postfix=postfix)
         cnt += len(batch)
 
 
+def main_work_queue(args, model, diffusion, dataset, postfix=''):
+    """Like main(), but claims videos from a work queue shared with all other
+    workers running on the same eval_dir, so any number of workers can be
+    started and they stay busy until everything is done."""
+    optimal_schedule_path = (None if args.optimality is None else
+                             args.eval_dir / 'optimal_schedule.pt')
+    work_queue = WorkQueue(
+        args.eval_dir / f'work_queue{postfix}',
+        [str(video_idx) for video_idx in args.indices],
+        is_done=lambda unit:
+        (args.eval_dir / 'elbos' / f'elbo_{unit}{postfix}.pkl').exists(),
+        lease_seconds=args.lease_seconds,
+    )
+    print(f'{work_queue.n_remaining()} of {len(args.indices)} videos left.')
+    for units in work_queue.batches(args.batch_size):
+        video_indices = [int(unit) for unit in units]
+        batch = torch.stack([dataset[i][0] for i in video_indices])
+        evaluate_and_save(args,
+                          model,
+                          diffusion,
+                          batch,
+                          video_indices,
+                          optimal_schedule_path,
+                          postfix=postfix)
+
+
 def run_bpd_evaluation(model,
                        diffusion,
                        batch,
                        clip_denoised,
                        obs_indices,
                        lat_indices,
-                       t_seq=None):
+                       t_seq=None,
+                       noise=None,
+                       timesteps_per_call=1,
+                       memory_budget_gb=None,
+                       proposal=None,
+                       tolerance=None,
+                       device=None,
+                       **estimator_kwargs):
+    """Computes the ELBO terms of the videos in batch, summed over frames.
+
+    If a proposal (a resample.ScheduleSampler) is given, the ELBO is estimated
+    from importance-sampled timesteps, to within the given tolerance (see
+    GaussianDiffusion.calc_bpd_importance_sampled, which estimator_kwargs are
+    passed to). Otherwise, all the timesteps in t_seq are evaluated.
+
+    The inputs of the model are put on device (by default dist_util.dev()),
+    which must be the device of the model.
+    """
+    if device is None:
+        device = dist_util.dev()
     max_frames = max(
         len(o) + len(l) for o, l in zip(obs_indices, lat_indices)
     )  # len(obs_indices[0]) + len(lat_indices[0]) didn't work for variable length obs/lat indices
-    x0 = torch.zeros_like(batch[:, :max_frames].to(dist_util.dev()))
+    x0 = torch.zeros_like(batch[:, :max_frames].to(device))
     obs_mask = torch.zeros_like(x0[:, :, :1, :1, :1])
     lat_mask = torch.zeros_like(x0[:, :, :1, :1, :1])
     kinda_marg_mask = torch.zeros_like(x0[:, :, :1, :1, :1])
@@ -169,26 +280,47 @@ def run_bpd_evaluation(model,
         latent_mask=lat_mask,
         kinda_marg_mask=kinda_marg_mask,
     )
-    metrics = diffusion.calc_bpd_loop_subsampled(
-        model,
-        x0,
-        clip_denoised=clip_denoised,
-        model_kwargs=model_kwargs,
-        latent_mask=lat_mask,
-        t_seq=t_seq,
-    )
+    if proposal is None:
+        metrics = diffusion.calc_bpd_loop_subsampled(
+            model,
+            x0,
+            clip_denoised=clip_denoised,
+            model_kwargs=model_kwargs,
+            latent_mask=lat_mask,
+            t_seq=t_seq,
+            noise=noise,
+            timesteps_per_call=timesteps_per_call,
+            memory_budget_gb=memory_budget_gb,
+        )
+    else:
+        metrics = diffusion.calc_bpd_importance_sampled(
+            model,
+            x0,
+            proposal,
+            clip_denoised=clip_denoised,
+            model_kwargs=model_kwargs,
+            latent_mask=lat_mask,
+            # The tolerance is on the sum over frames, as returned.
+            tolerance=None if tolerance is None else tolerance / max_frames,
+            timesteps_per_call=timesteps_per_call,
+            memory_budget_gb=memory_budget_gb,
+            **estimator_kwargs,
+        )
 
     metrics = {
         k: v.sum(dim=1) if v.ndim > 1 else v
         for k, v in metrics.items()
     }
     # sum (rather than mean) over frame dimension by multiplying by number of frames
-    metrics = {k: v * max_frames for (k, v) in metrics.items()}
+    metrics = {
+        k: v if k == 'num_timesteps' else v * max_frames
+        for (k, v) in metrics.items()
+    }
     metrics = {k: v.detach().cpu().numpy() for k, v in metrics.items()}
     return metrics
 
 
-if __name__ == '__main__':
+def create_argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('checkpoint_path', type=str)
     parser.add_argument('--batch_size', type=int, default=8)
@@ -262,7 +394,67 @@ if __name__ == '__main__':
         help=
         'Whcih optimality schedule to use for choosing observed frames. The optimal schedule should be generated before via video_optimal_schedule.py. Default is to not use any optimality.',
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        '--timesteps_per_call',
+        type=int,
+        default=1,
+        help=
+        'Number of diffusion timesteps to evaluate in each model call, by tiling the batch. With --nll_memory_gb, only used for the first call.',
+    )
+    parser.add_argument(
+        '--nll_memory_gb',
+        type=float,
+        default=None,
+        help=
+        'If given, evaluates as many timesteps in each model call as fit in this much GPU memory (measured on the first call).',
+    )
+    parser.add_argument(
+        '--importance_sampling',
+        action='store_true',
+        help=
+        'If given, estimates the ELBO from timesteps sampled from a loss-aware proposal, with confidence intervals, instead of evaluating every timestep.',
+    )
+    parser.add_argument(
+        '--nll_tolerance',
+        type=float,
+        default=None,
+        help=
+        'With --importance_sampling, stops sampling timesteps for a video once the half-width of the confidence interval of its ELBO is below this. Defaults to always sampling --nll_max_timesteps timesteps.',
+    )
+    parser.add_argument('--nll_confidence', type=float, default=0.95)
+    parser.add_argument(
+        '--nll_samples_per_round',
+        type=int,
+        default=10,
+        help=
+        'With --importance_sampling, the number of timesteps sampled for each video between checks of the tolerance.',
+    )
+    parser.add_argument('--nll_max_timesteps', type=int, default=1000)
+    parser.add_argument(
+        '--nll_proposal',
+        type=str,
+        default=None,
+        help=
+        'With --importance_sampling, the file the statistics of the timestep proposal are loaded from (if it exists) and saved to, so that they carry over between runs. Defaults to nll_proposal.npz in the eval_dir.',
+    )
+    parser.add_argument(
+        '--work_queue',
+        action='store_true',
+        help=
+        'If given, claims videos from a work queue in eval_dir shared by all workers, instead of processing a fixed set of indices.',
+    )
+    parser.add_argument(
+        '--lease_seconds',
+        type=int,
+        default=600,
+        help=
+        'With --work_queue, how long a claim on a video lasts if its worker stops renewing it.',
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_argparser().parse_args()
     args.adaptive = 'adaptive' in args.inference_mode
 
     # Load the checkpoint (state dictionary and config)
@@ -306,7 +498,8 @@ if __name__ == '__main__':
     args.test_set_size = len(dataset)
     print(f'Dataset size = {args.test_set_size}')
     # Prepare the indices
-    if args.indices is None and 'SLURM_ARRAY_TASK_ID' in os.environ:
+    if (args.indices is None and 'SLURM_ARRAY_TASK_ID' in os.environ
+            and not args.work_queue):
         task_id = int(os.environ['SLURM_ARRAY_TASK_ID'])
         args.indices = list(
             range(task_id * args.batch_size, (task_id + 1) * args.batch_size))
@@ -317,6 +510,7 @@ if __name__ == '__main__':
     else:
         raise NotImplementedError
     # Take a subset of the dataset according to the indices
+    full_dataset = dataset
     dataset = torch.utils.data.Subset(dataset, args.indices)
     print(
         f'Dataset size (after subsampling according to indices) = {len(dataset)}'
@@ -329,11 +523,8 @@ if __name__ == '__main__':
         args.indices_path = args.eval_dir / 'frame_indices.pt'
 
     # Prepare the diffusion sampling arguments (DDIM/respacing)
-    postfix = ''
-    if args.use_ddim:
-        postfix += '_ddim'
-    if args.timestep_respacing != '':
-        postfix += '_' + f'respace{args.timestep_respacing}'
+    postfix = get_postfix(args)
+    create_proposal(args, diffusion)
 
     # Store model configs in a JSON file
     json_path = args.eval_dir / 'model_config.json'
@@ -344,11 +535,14 @@ if __name__ == '__main__':
         print(f'Saved model config at {json_path}')
 
     # Generate the samples
-    main(
-        args,
-        model,
-        diffusion,
-        dataloader,
-        postfix=postfix,
-        dataset_indices=args.indices,
-    )
+    if args.work_queue:
+        main_work_queue(args, model, diffusion, full_dataset, postfix=postfix)
+    else:
+        main(
+            args,
+            model,
+            diffusion,
+            dataloader,
+            postfix=postfix,
+            dataset_indices=args.indices,
+        )
@@ -17,7 +17,7 @@ from improved_diffusion import dist_util, logger, test_util
 from improved_diffusion.image_datasets import (default_T_dict,
                                                get_test_dataset,
                                                get_train_dataset, load_data)
-from improved_diffusion.inference_util import inference_strategies
+from improved_diffusion.inference_util import get_inference_plan
 from improved_diffusion.script_util import (args_to_dict,
                                             create_video_model_and_diffusion,
                                             str2bool,
@@ -55,13 +55,14 @@ def main(args,
             cnt += len(batch)
             continue
         returns = []
-        inference_strategy = inference_strategies[args.inference_mode](
-            video_length=args.T, num_obs=args.obs_length)
-        for obs_indices, lat_indices in inference_strategy:
+        plan = get_inference_plan(args.inference_mode,
+                                  video_length=args.T,
+                                  num_obs=args.obs_length)
+        for stage, (obs_indices, lat_indices) in enumerate(plan):
             obs_indices = [obs_indices for _ in range(len(batch))]
             lat_indices = [lat_indices for _ in range(len(batch))]
-            model = models[inference_strategy._active_iterator]
-            diffusion = diffusions[inference_strategy._active_iterator]
+            model = models[plan.tags[stage]]
+            diffusion = diffusions[plan.tags[stage]]
             returns.append(
                 run_bpd_evaluation(
                     model=model,
@@ -1,9 +1,14 @@
+import contextlib
+import copy
 import os
+import queue
 import sched
+import shlex
 import subprocess
 import sys
 from argparse import ArgumentParser, Namespace
 from ast import parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from shutil import move
 
@@ -15,6 +20,7 @@ from video_nll import run_bpd_evaluation
 
 from improved_diffusion import dist_util, inference_util, test_util
 from improved_diffusion.image_datasets import get_train_dataset
+from improved_diffusion.job_scheduler import JobQueue, LocalScheduler, make_job
 from improved_diffusion.rng_util import RNG
 from improved_diffusion.script_util import (args_to_dict,
                                             create_video_model_and_diffusion,
@@ -73,6 +79,32 @@ def submit(remaining_steps, args):
         subprocess.call(cmd, shell=True)
 
 
+def submit_local(remaining_steps, args):
+    """Like submit(), but runs the array job on this machine with the local
+    job scheduler.
+
+    Each step runs as its own job with SLURM_ARRAY_TASK_ID set, exactly as
+    it would in a SLURM array job. The queue is kept in args.local_queue, so
+    re-running the submission resumes it.
+    """
+    if len(remaining_steps) == 0:
+        print('Nothing left to do!')
+        return
+    script_args = ' '.join(
+        shlex.quote(arg) for arg in sys.argv if arg != '--submit')
+    job_queue = JobQueue(args.local_queue)
+    job_queue.add([
+        make_job(f'python {script_args}',
+                 gpus=1,
+                 gpu_mem_gb=args.local_gpu_mem_gb,
+                 env={'SLURM_ARRAY_TASK_ID': step},
+                 max_retries=1) for step in remaining_steps
+    ])
+    LocalScheduler(job_queue,
+                   cpu_only=args.local_cpu_only,
+                   log_dir=Path(args.local_queue).parent / 'logs').run()
+
+
 @torch.no_grad()
 def get_mse_random(
     latent_frame_indices,
@@ -103,6 +135,7 @@ def get_mse_random(
             obs_indices=obs_incides[:len(batch)],
             lat_indices=lat_indices[:len(batch)],
             t_seq=t_seq,
+            device=device,
         )
         metrics = {
             k: v / t_seq.shape[1] * diffusion.num_timesteps
@@ -188,6 +221,7 @@ def get_mse_linspace(
             obs_indices=obs_incides[:len(batch)],
             lat_indices=lat_indices[:len(batch)],
             t_seq=t_seq,
+            device=device,
         )
         metrics = {
             k: v / t_seq.shape[1] * diffusion.num_timesteps
@@ -206,6 +240,141 @@ def get_mse_linspace(
     return res
 
 
+@torch.no_grad()
+def get_mse_linspace_batched(
+    latent_frame_indices,
+    obs_frame_indices,
+    candidates,
+    model,
+    diffusion,
+    dataloader,
+    device,
+    num_timesteps,
+    seed=0,
+):
+    """Batched version of get_mse_linspace() for several candidate observed
+    frames at once.
+
+    Every video of a batch is repeated once per candidate, with that candidate
+    appended to obs_frame_indices, so all candidates are evaluated in the same
+    forward passes. The diffusion noise is seeded per video (by seed and the
+    position of the video in the dataloader), which makes the candidates
+    directly comparable, even when they are evaluated in different calls or
+    on different devices.
+
+    Args:
+        latent_frame_indices (list): List of latent frame indices
+        obs_frame_indices (list): List of observed frame indices, shared by all
+            the candidates
+        candidates (list): List of candidate frame indices to add to
+            obs_frame_indices
+        model (torch.nn.Module): The DDPM model
+        diffusion (SpacedDiffusion): The Gaussian diffusion process
+        dataloader (torhc.utils.data.DataLoader): The dataloader
+        device (torch.device)
+        num_timesteps (int): Number of timesteps equally spaced on the set of DDPM timesteps.
+        seed (int): Seed for the diffusion noise.
+
+    Returns:
+        dict: A dictionary of {candidate: {DDPM-timestep: [list of MSE values for test videos]}},
+            of plain Python ints and floats, so that torch.load() can load it
+            with weights_only.
+    """
+    n_cand = len(candidates)
+    t_seq_all = (diffusion.num_timesteps - 1 - np.linspace(
+        0, diffusion.num_timesteps, num_timesteps, endpoint=False, dtype=int))
+    res = {int(candidate_idx): {} for candidate_idx in candidates}
+    video_cnt = 0
+    for batch, _ in dataloader:
+        B = len(batch)
+        t_seq = t_seq_all.take(range(video_cnt, video_cnt + B), mode='wrap')
+        max_frames = len(obs_frame_indices) + 1 + len(latent_frame_indices)
+        generator = torch.Generator().manual_seed(seed * 1000003 + video_cnt)
+        noise = torch.randn((1, B, max_frames, *batch.shape[2:]),
+                            generator=generator)
+        video_cnt += B
+
+        # Rows are ordered video-major: row b * n_cand + c is video b with
+        # candidate c.
+        metrics = run_bpd_evaluation(
+            model=model,
+            diffusion=diffusion,
+            batch=batch.to(device).repeat_interleave(n_cand, dim=0),
+            clip_denoised=True,
+            obs_indices=[
+                list(obs_frame_indices) + [candidate_idx] for _ in range(B)
+                for candidate_idx in candidates
+            ],
+            lat_indices=[latent_frame_indices] * (B * n_cand),
+            t_seq=t_seq.repeat(n_cand).reshape(-1, 1),
+            noise=noise.repeat_interleave(n_cand, dim=1),
+            device=device,
+        )
+        mse = metrics['mse'] * diffusion.num_timesteps
+        assert mse.ndim == 1
+        mse = mse.reshape(B, n_cand)
+        for b, t in enumerate(t_seq):
+            for c, candidate_idx in enumerate(candidates):
+                res[int(candidate_idx)].setdefault(int(t),
+                                                   []).append(float(mse[b, c]))
+    return res
+
+
+class CandidateEvaluator:
+    """Evaluates candidate observed frames in chunks of candidate_batch_size
+    candidates, spread over one model replica per device."""
+    def __init__(self, model, devices, candidate_batch_size):
+        self.devices = devices
+        self.candidate_batch_size = candidate_batch_size
+        self.models = {
+            device:
+            model.to(device) if i == 0 else copy.deepcopy(model).to(device)
+            for i, device in enumerate(devices)
+        }
+        self._free_devices = queue.Queue()
+        for device in devices:
+            self._free_devices.put(device)
+        self._executor = ThreadPoolExecutor(max_workers=len(devices))
+
+    def _evaluate_chunk(self, chunk, **kwargs):
+        device = self._free_devices.get()
+        try:
+            # So that the CUDA tensors created without a device index go to
+            # this replica's device rather than the default one.
+            with (torch.cuda.device(device) if torch.device(device).type
+                  == 'cuda' else contextlib.nullcontext()):
+                return get_mse_linspace_batched(candidates=chunk,
+                                                model=self.models[device],
+                                                device=device,
+                                                **kwargs)
+        finally:
+            self._free_devices.put(device)
+
+    def evaluate(self, candidates, on_result=None, **kwargs):
+        """Returns {candidate: {DDPM-timestep: [MSE values]}} for all the
+        candidates. kwargs are passed to get_mse_linspace_batched(). If given,
+        on_result is called on the results of each chunk as soon as it is
+        done."""
+        chunks = [
+            candidates[i:i + self.candidate_batch_size]
+            for i in range(0, len(candidates), self.candidate_batch_size)
+        ]
+        futures = [
+            self._executor.submit(self._evaluate_chunk, chunk, **kwargs)
+            for chunk in chunks
+        ]
+        results = {}
+        for future in tqdm(as_completed(futures),
+                           total=len(futures),
+                           desc='Candidate chunk',
+                           leave=False):
+            chunk_results = future.result()
+            if on_result is not None:
+                on_result(chunk_results)
+            results.update(chunk_results)
+        return results
+
+
 def update_schedule_on_disk(schedule_path, schedule, force=True):
     with test_util.Protect(schedule_path):
         # Re-load the test schedule, in case it was modified by another process.
@@ -222,19 +391,23 @@ def update_schedule_on_disk(schedule_path, schedule, force=True):
 def main(args, model, diffusion, dataset, schedule_path, verbose=True):
     task_id = (int(os.environ['SLURM_ARRAY_TASK_ID'])
                if 'SLURM_ARRAY_TASK_ID' in os.environ else None)
-    frame_indices_iterator = inference_util.inference_strategies[
-        args.inference_mode](
-            video_length=args.T,
-            num_obs=args.obs_length,
-            max_frames=args.max_frames,
-            step_size=args.step_size,
-        )
+    plan = inference_util.get_inference_plan(
+        args.inference_mode,
+        video_length=args.T,
+        num_obs=args.obs_length,
+        max_frames=args.max_frames,
+        step_size=args.step_size,
+    )
     inference_schedule = (
         {}
     )  # A dictionary from "inference step" to the list of optimal observed frame indices.
     schedule_path = Path(schedule_path)
     partial_schedule_path = schedule_path.parent / ('.' + schedule_path.stem +
                                                     '_partial.pt')
+    evaluator = CandidateEvaluator(
+        model,
+        devices=args.devices,
+        candidate_batch_size=args.candidate_batch_size)
     # Load the schedule, if it exists
     if schedule_path.exists():
         with test_util.Protect(schedule_path):
@@ -249,7 +422,7 @@ def main(args, model, diffusion, dataset, schedule_path, verbose=True):
     else:
         partial_schedule = {}
     for cnt, (_, latent_frame_indices) in enumerate(
-            tqdm(frame_indices_iterator, leave=False, desc='Inference step')):
+            tqdm(plan, leave=False, desc='Inference step')):
         if task_id is not None and cnt != task_id:
             print(
                 f'Skipping inference step {cnt}; not for this instance of array job.'
@@ -258,8 +431,9 @@ def main(args, model, diffusion, dataset, schedule_path, verbose=True):
         if cnt in saved_schedule:
             print(f'Skipping inference step {cnt}; already done.')
             continue
-        n_to_condition_on = frame_indices_iterator._max_frames - len(
-            latent_frame_indices)
+        # Frames that are available once this step's latents are generated
+        done_frames = plan.done_frames(cnt)
+        n_to_condition_on = plan.max_frames - len(latent_frame_indices)
         obs_frame_indices = (
             set()
             if cnt not in partial_schedule else set(partial_schedule[cnt])
@@ -268,13 +442,12 @@ def main(args, model, diffusion, dataset, schedule_path, verbose=True):
             force_nearby(
                 latent_frame_indices=latent_frame_indices,
                 obs_frame_indices=obs_frame_indices,
-                done_frame_indices=frame_indices_iterator._done_frames,
+                done_frame_indices=done_frames,
             )
-        while len(obs_frame_indices) < min(
-                len(frame_indices_iterator._done_frames), n_to_condition_on):
+        while len(obs_frame_indices) < min(len(done_frames),
+                                           n_to_condition_on):
             # Prepare the dataloader and the metric computation function based on the optimality
             if 'linspace-t' in args.optimality:
-                get_metric_fn = get_mse_linspace
                 # Get a new subset of the dataset for each  step of choosing a frame in each inference step.
                 # Each "step" here means choosing one frame in one  inference step of the model
                 # (i.e., choosing one frame in one line of the inference strategy visualization)
@@ -301,33 +474,47 @@ def main(args, model, diffusion, dataset, schedule_path, verbose=True):
             )
 
             # Find the next best observed frame index
-            metrics = (
-                {}
+            # Candidate metrics already computed by an earlier (interrupted)
+            # run are kept in the partial schedule, under this key.
+            progress_key = ('candidates', cnt, len(obs_frame_indices))
+            metrics = dict(
+                partial_schedule.get(progress_key, {})
             )  # Will be a dictionary of the form {frame_idx: {diffusion_t: [list of metric values]}}
-            for candidate_idx in tqdm(frame_indices_iterator._done_frames,
-                                      desc='Candidate index'):
-                if (candidate_idx in latent_frame_indices
-                        or candidate_idx in obs_frame_indices):
-                    # Skip the latent frames (these are just added to the done list by the InferenceStrategyBase class)
-                    # Also skip the frames that are already in the observed list
-                    continue
-                metrics[candidate_idx] = get_metric_fn(
-                    latent_frame_indices=latent_frame_indices,
-                    obs_frame_indices=list(obs_frame_indices) +
-                    [candidate_idx],
-                    model=model,
-                    diffusion=diffusion,
-                    dataloader=dataloader,
-                    device=args.device,
-                    num_timesteps=args.num_timesteps,
+            # Skip the latent frames (these are just added to the done list by the InferenceStrategyBase class)
+            # Also skip the frames that are already in the observed list
+            candidates = [
+                candidate_idx for candidate_idx in done_frames
+                if candidate_idx not in latent_frame_indices and candidate_idx
+                not in obs_frame_indices and candidate_idx not in metrics
+            ]
+
+            def save_progress(chunk_metrics):
+                metrics.update(chunk_metrics)
+                update_schedule_on_disk(
+                    schedule_path=partial_schedule_path,
+                    schedule={progress_key: dict(metrics)},
+                    force=False,
                 )
                 if verbose:
-                    cur_metrics_array = np.array(
-                        list(metrics[candidate_idx].values()))
-                    cur_metrics_array = cur_metrics_array.mean(axis=0)
-                    print(
-                        f'(Step #{cnt}) Candidate frame {candidate_idx}: ({cur_metrics_array.mean(axis=0)}, {cur_metrics_array.std(axis=0)}) --- Latent: {latent_frame_indices} --- Observed: {list(obs_frame_indices)}'
-                    )
+                    for candidate_idx, candidate_metrics in chunk_metrics.items(
+                    ):
+                        cur_metrics_array = np.array(
+                            list(candidate_metrics.values()))
+                        cur_metrics_array = cur_metrics_array.mean(axis=0)
+                        print(
+                            f'(Step #{cnt}) Candidate frame {candidate_idx}: ({cur_metrics_array.mean(axis=0)}, {cur_metrics_array.std(axis=0)}) --- Latent: {latent_frame_indices} --- Observed: {list(obs_frame_indices)}'
+                        )
+
+            evaluator.evaluate(
+                candidates,
+                on_result=save_progress,
+                latent_frame_indices=latent_frame_indices,
+                obs_frame_indices=list(obs_frame_indices),
+                diffusion=diffusion,
+                dataloader=dataloader,
+                num_timesteps=args.num_timesteps,
+                seed=cnt * 1000 + len(obs_frame_indices),
+            )
             # Transfrom metrics form the dictionary format to a list of piars of (candidate_idx, candidate_avg_metric)
             metrics = [(candidate_idx,
                         np.array(list(candidate_metrics.values())).mean())
@@ -341,10 +528,10 @@ def main(args, model, diffusion, dataset, schedule_path, verbose=True):
             # Update the partial schedule
             update_schedule_on_disk(
                 schedule_path=partial_schedule_path,
-                schedule={cnt: list(obs_frame_indices)},
+                schedule={cnt: [int(i) for i in obs_frame_indices]},
                 force=False,
             )
-        obs_frame_indices = sorted(list(obs_frame_indices))
+        obs_frame_indices = sorted(int(i) for i in obs_frame_indices)
         inference_schedule[cnt] = obs_frame_indices
         print(
             f'Step #{cnt}:\n\tLatent: {latent_frame_indices}\n\tObserved: {obs_frame_indices}'
@@ -366,6 +553,20 @@ if __name__ == '__main__':
     )
     parser.add_argument('--device',
                         default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument(
+        '--devices',
+        nargs='*',
+        default=None,
+        help=
+        'Devices to spread the candidate evaluations over, e.g. "cuda:0 cuda:1". Defaults to --device.',
+    )
+    parser.add_argument(
+        '--candidate_batch_size',
+        type=int,
+        default=4,
+        help=
+        'Number of candidate frames evaluated together in one forward pass. Each pass has batch_size x candidate_batch_size rows.',
+    )
     # Inference arguments
     parser.add_argument(
         '--optimality',
@@ -462,10 +663,28 @@ if __name__ == '__main__':
     )
     parser.add_argument('--slurm_time_hrs', type=int, default=3)
     parser.add_argument('--slurm_mem', type=str, default='32G')
+    parser.add_argument(
+        '--local_queue',
+        type=str,
+        default=None,
+        help=
+        'If given with --submit, runs the array job on this machine with the local job scheduler, keeping its queue in this file.',
+    )
+    parser.add_argument(
+        '--local_gpu_mem_gb',
+        type=float,
+        default=0.0,
+        help='GPU memory per local job. If positive, several jobs share a GPU.',
+    )
+    parser.add_argument('--local_cpu_only',
+                        action='store_true',
+                        help='Run the local jobs without GPUs.')
     args = parser.parse_args()
 
     if args.subset_size is None:
         args.subset_size = args.num_timesteps * 10  # TODO: un-comment
+    if args.devices is None:
+        args.devices = [args.device]
 
     # Load the checkpoint (state dictionary and config)
     data = dist_util.load_state_dict(args.checkpoint_path, map_location='cpu')
@@ -513,18 +732,21 @@ if __name__ == '__main__':
         # Figure out which steps are remaining
         saved_schedule = {} if not schedule_path.exists() else torch.load(
             schedule_path)
-        frame_indices_iterator = inference_util.inference_strategies[
-            args.inference_mode](
+        num_steps = len(
+            inference_util.get_inference_plan(
+                args.inference_mode,
                 video_length=args.T,
                 num_obs=args.obs_length,
                 max_frames=args.max_frames,
                 step_size=args.step_size,
-            )
-        num_steps = len(list(frame_indices_iterator))
+            ))
         remaining_steps = [
             step for step in range(num_steps) if step not in saved_schedule
         ]
-        submit(remaining_steps, args=args)
+        if args.local_queue is not None:
+            submit_local(remaining_steps, args=args)
+        else:
+            submit(remaining_steps, args=args)
         quit()
 
     # Generate the samples
@@ -9,7 +9,8 @@ from PIL import Image
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
-from improved_diffusion import dist_util, inference_util, test_util
+from improved_diffusion import (compile_util, dist_util, dpm_solver,
+                                inference_util, test_util)
 from improved_diffusion.image_datasets import (get_test_dataset,
                                                get_train_dataset,
                                                get_variable_length_dataset)
@@ -17,6 +18,7 @@ from improved_diffusion.script_util import (args_to_dict,
                                             create_video_model_and_diffusion,
                                             str2bool,
                                             video_model_and_diffusion_defaults)
+from improved_diffusion.work_queue import WorkQueue
 
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
@@ -67,32 +69,39 @@ def infer_video(
     CxWxH: image size
     """
     B, T, C, H, W = batch.shape
-    samples = torch.zeros_like(batch).cpu()
-    samples[:, :obs_length] = batch[:, :obs_length]
+    samples = inference_util.VideoCanvas(batch.shape,
+                                         device=batch.device,
+                                         dtype=batch.dtype,
+                                         max_device_gb=args.max_canvas_gb)
+    samples.write(list(range(obs_length)), batch[:, :obs_length])
     if 'goal-directed' in mode:
-        samples[:, -5] = batch[:, -5]
+        samples.write([T - 5], batch[:, -5:-4])
     adaptive_kwargs = dict(distance='lpips') if 'adaptive' in mode else {}
-    frame_indices_iterator = iter(inference_util.inference_strategies[mode](
+    frame_indices_iterator = inference_util.get_inference_strategy(
+        mode,
         video_length=T,
         num_obs=obs_length,
         max_frames=max_frames,
         step_size=step_size,
         optimal_schedule_path=optimal_schedule_path,
         **adaptive_kwargs,
-    ))
-    timesteps = list(range(diffusion.num_timesteps))[::-1]
+    )
+    stage_steps = inference_util.StageStepSchedule(args.stage_steps)
+    assert not (stage_steps and args.save_all_timesteps
+                ), '--save_all_timesteps needs the same steps in every stage.'
     if args.save_all_timesteps:
         all_timestep_samples = torch.zeros(
             [B, diffusion.num_timesteps, T, C, H, W]).cpu()
         all_timestep_samples[:, :, :obs_length] = (
-            samples[:, :obs_length].unsqueeze(1).expand(
+            batch[:, :obs_length].cpu().unsqueeze(1).expand(
                 -1, diffusion.num_timesteps, -1, -1, -1, -1))
     else:
         all_timestep_samples = torch.zeros([1])
 
     while True:
         if 'adaptive' in mode:
-            frame_indices_iterator.set_videos(samples.to(batch.device))
+            frame_indices_iterator.set_videos(samples.videos,
+                                              device=batch.device)
         try:
             obs_frame_indices, latent_frame_indices = next(
                 frame_indices_iterator)
@@ -101,35 +110,11 @@ def infer_video(
         logger.info(f'Conditioning on {sorted(obs_frame_indices)} frames, '
                     f'predicting {sorted(latent_frame_indices)}.\n')
         # Prepare network's input
-        if 'adaptive' in mode:
-            frame_indices = torch.cat(
-                [
-                    torch.tensor(obs_frame_indices),
-                    torch.tensor(latent_frame_indices)
-                ],
-                dim=1,
-            )
-            x0 = torch.stack(
-                [samples[i, fi] for i, fi in enumerate(frame_indices)],
-                dim=0).clone()
-            obs_mask, latent_mask, kinda_marg_mask = get_masks(
-                x0, len(obs_frame_indices[0]))
-            n_latent = len(latent_frame_indices[0])
-        else:
-            x0 = torch.cat([
-                samples[:, obs_frame_indices], samples[:, latent_frame_indices]
-            ],
-                           dim=1).clone()
-            frame_indices = torch.cat(
-                [
-                    torch.tensor(obs_frame_indices),
-                    torch.tensor(latent_frame_indices)
-                ],
-                dim=0,
-            ).repeat((B, 1))
-            obs_mask, latent_mask, kinda_marg_mask = get_masks(
-                x0, len(obs_frame_indices))
-            n_latent = len(latent_frame_indices)
+        x0, frame_indices = samples.read_stage(obs_frame_indices,
+                                               latent_frame_indices)
+        n_obs = (len(obs_frame_indices[0])
+                 if 'adaptive' in mode else len(obs_frame_indices))
+        obs_mask, latent_mask, kinda_marg_mask = get_masks(x0, n_obs)
         # Prepare masks
         logger.info(f"{'Frame indices':20}: {frame_indices[0].cpu().numpy()}.")
         logger.info(
@@ -138,34 +123,35 @@ def infer_video(
         logger.info(
             f"{'Latent mask':20}: {latent_mask[0].cpu().int().numpy().squeeze()}"
         )
+        # Respace the diffusion to the step budget of the stage (spaced
+        # quadratically for the ODE solver)
+        n_steps = stage_steps(obs_frame_indices, latent_frame_indices,
+                              frame_indices_iterator.stage_level)
+        stage_diffusion = inference_util.respace_stage(diffusion, n_steps,
+                                                       args.sampler)
+        logger.info(f"{'Denoising steps':20}: {stage_diffusion.num_timesteps}")
         logger.info('-' * 40)
-        # Move tensors to the correct device
-        [x0, obs_mask, latent_mask, kinda_marg_mask, frame_indices] = [
-            xyz.to(batch.device) for xyz in
-            [x0, obs_mask, latent_mask, kinda_marg_mask, frame_indices]
-        ]
 
         all_timestep_local_samples = []
-        local_samples = x0.clone()
-        for timestep in timesteps:
-            local_samples = diffusion.p_sample(
+        model_kwargs = dict(
+            frame_indices=frame_indices,
+            x0=x0,
+            obs_mask=obs_mask,
+            latent_mask=latent_mask,
+            kinda_marg_mask=kinda_marg_mask,
+            x_t_minus_1=x0,  # placeholder, x_t_minus_1 not allowed
+            observed_frames=args.observed_frames,
+        )
+        for out in inference_util.sample_stage(
                 model,
-                local_samples,
-                t=torch.tensor([timestep] * x0.shape[0],
-                               device=next(model.parameters()).device),
-                clip_denoised=True,
-                model_kwargs=dict(
-                    frame_indices=frame_indices,
-                    x0=x0,
-                    obs_mask=obs_mask,
-                    latent_mask=latent_mask,
-                    kinda_marg_mask=kinda_marg_mask,
-                    x_t_minus_1=x0,  # placeholder, x_t_minus_1 not allowed
-                    observed_frames=args.observed_frames,
-                ),
-                return_attn_weights=False,
+                stage_diffusion,
+                x0,
+                model_kwargs,
+                sampler=args.sampler,
+                solver_order=args.solver_order,
                 use_gradient_method=use_gradient_method,
-            )['sample']
+        ):
+            local_samples = out['sample']
             if args.save_all_timesteps:
                 all_timestep_local_samples.append(local_samples.clone())
         if args.save_all_timesteps:
@@ -173,23 +159,112 @@ def infer_video(
                 all_timestep_local_samples, dim=1)  # BxTimestepxTxCxHxW
 
         # Fill in the generated frames
-        if 'adaptive' in mode:
-            n_obs = len(obs_frame_indices[0])
-            for i, li in enumerate(latent_frame_indices):
-                samples[i, li] = local_samples[i, n_obs:].cpu()
-                if args.save_all_timesteps:
+        samples.write(latent_frame_indices, local_samples[:, n_obs:])
+        if args.save_all_timesteps:
+            if 'adaptive' in mode:
+                for i, li in enumerate(latent_frame_indices):
                     all_timestep_samples[
                         i, :, li] = all_timestep_local_samples[i, :,
                                                                n_obs:].cpu()
-        else:
-            samples[:, latent_frame_indices] = local_samples[:,
-                                                             -n_latent:].cpu()
-            if args.save_all_timesteps:
+            else:
                 all_timestep_samples[:, :, latent_frame_indices] = \
-                    all_timestep_local_samples[:, :, -n_latent:].cpu()
+                    all_timestep_local_samples[:, :, n_obs:].cpu()
     return samples.numpy(), all_timestep_samples.numpy()
 
 
+def sample_and_save(args, model, diffusion, batch, file_ids,
+                    optimal_schedule_path, use_gradient_method):
+    """Samples the videos in batch and saves them under the given file ids
+    (of the form <video index>-<sample index>). Does nothing if all the
+    samples already exist."""
+    batch_size = len(batch)
+    samples_dir = args.eval_dir / 'samples'
+    output_filenames = [
+        samples_dir / f'sample_{file_id}.npy' for file_id in file_ids
+    ]
+    all_timestep_output_filenames = [
+        samples_dir / f'all_timestep_sample_{file_id}.npy'
+        for file_id in file_ids
+    ]
+    q_sample_file_names = [
+        samples_dir / f'q_sample_{file_id}.npy' for file_id in file_ids
+    ]
+    error_file_names = [
+        samples_dir / f'error_{file_id}.npy' for file_id in file_ids
+    ]
+    todo = [not p.exists() for (i, p) in enumerate(output_filenames)
+            ]  # Whether the file should be generated
+    if not any(todo):
+        logger.info(f'Nothing to do for {file_ids[0]} - {file_ids[-1]}.')
+        return
+    if args.T is not None:
+        batch = batch[:, :args.T]
+    batch = batch.to(args.device)
+
+    # q_sample the whole video
+    if args.save_all_timesteps:
+        timesteps = list(range(diffusion.num_timesteps))
+        all_timestep_q_sample = []
+        for timestep in timesteps:
+            t = torch.tensor(timestep).to(args.device)
+            single_timestep_q_sample = diffusion.q_sample(batch,
+                                                          t=t).detach().cpu()
+            all_timestep_q_sample.append(single_timestep_q_sample)
+        all_timestep_q_sample = torch.stack(all_timestep_q_sample,
+                                            dim=1).numpy()
+
+    recon, all_timestep_recon = infer_video(
+        mode=args.inference_mode,
+        model=model,
+        diffusion=diffusion,
+        batch=batch,
+        max_frames=args.max_frames,
+        obs_length=args.obs_length,
+        step_size=args.step_size,
+        optimal_schedule_path=optimal_schedule_path,
+        use_gradient_method=use_gradient_method,
+    )
+
+    recon = ((recon - drange[0]) / (drange[1] - drange[0]) * 255
+             )  # recon with pixel values in [0, 255]
+    recon = recon.astype(np.uint8)
+    for i in range(batch_size):
+        if todo[i]:
+            np.save(output_filenames[i], recon[i])
+            logger.info(f'*** Saved {output_filenames[i]} ***')
+        else:
+            logger.info(f'Skipped {output_filenames[i]}')
+
+    # compute errors
+    if args.save_all_timesteps:
+        for i in range(batch_size):
+            if todo[i]:
+                np.save(q_sample_file_names[i], all_timestep_q_sample[i])
+                logger.info(f'*** Saved {q_sample_file_names[i]} ***')
+            else:
+                logger.info(f'Skipped {q_sample_file_names[i]}')
+
+        error = all_timestep_q_sample - all_timestep_recon
+        for i in range(batch_size):
+            if todo[i]:
+                np.save(error_file_names[i], error[i])
+                logger.info(f'*** Saved {error_file_names[i]} ***')
+            else:
+                logger.info(f'Skipped {error_file_names[i]}')
+
+        all_timestep_recon = (
+            (all_timestep_recon - drange[0]) / (drange[1] - drange[0]) * 255
+        )  # recon with pixel values in [0, 255]
+        all_timestep_recon = all_timestep_recon.astype(np.uint8)
+        for i in range(batch_size):
+            if todo[i]:
+                np.save(all_timestep_output_filenames[i],
+                        all_timestep_recon[i])
+                logger.info(f'*** Saved {output_filenames[i]} ***')
+            else:
+                logger.info(f'Skipped {output_filenames[i]}')
+
+
 def main(args,
          model,
          diffusion,
@@ -208,104 +283,43 @@ def main(args,
         batch_size = len(batch)
         for sample_idx in (range(args.num_samples)
                            if args.sample_idx is None else [args.sample_idx]):
-            output_filenames = [
-                args.eval_dir / 'samples' /
-                f'sample_{dataset_idx_translate(cnt + i):04d}-{sample_idx}.npy'
+            file_ids = [
+                f'{dataset_idx_translate(cnt + i):04d}-{sample_idx}'
                 for i in range(batch_size)
             ]
-            all_timestep_output_filenames = [
-                args.eval_dir / 'samples' /
-                f'all_timestep_sample_{dataset_idx_translate(cnt + i):04d}-{sample_idx}.npy'  # noqa
-                for i in range(batch_size)
-            ]
-            q_sample_file_names = [
-                args.eval_dir / 'samples' /
-                f'q_sample_{dataset_idx_translate(cnt + i):04d}-{sample_idx}.npy'  # noqa
-                for i in range(batch_size)
-            ]
-            error_file_names = [
-                args.eval_dir / 'samples' /
-                f'error_{dataset_idx_translate(cnt + i):04d}-{sample_idx}.npy'  # noqa
-                for i in range(batch_size)
-            ]
-            todo = [not p.exists() for (i, p) in enumerate(output_filenames)
-                    ]  # Whether the file should be generated
-            if not any(todo):
-                logger.info(
-                    f'Nothing to do for the batches {cnt} - {cnt + batch_size - 1}, sample #{sample_idx}.'  # noqa
-                )
-            else:
-                if args.T is not None:
-                    batch = batch[:, :args.T]
-                batch = batch.to(args.device)
-
-                # q_sample the whole video
-                if args.save_all_timesteps:
-                    timesteps = list(range(diffusion.num_timesteps))
-                    all_timestep_q_sample = []
-                    for timestep in timesteps:
-                        t = torch.tensor(timestep).to(args.device)
-                        single_timestep_q_sample = diffusion.q_sample(
-                            batch, t=t).detach().cpu()
-                        all_timestep_q_sample.append(single_timestep_q_sample)
-                    all_timestep_q_sample = torch.stack(all_timestep_q_sample,
-                                                        dim=1).numpy()
-
-                recon, all_timestep_recon = infer_video(
-                    mode=args.inference_mode,
-                    model=model,
-                    diffusion=diffusion,
-                    batch=batch,
-                    max_frames=args.max_frames,
-                    obs_length=args.obs_length,
-                    step_size=args.step_size,
-                    optimal_schedule_path=optimal_schedule_path,
-                    use_gradient_method=use_gradient_method,
-                )
+            sample_and_save(args, model, diffusion, batch, file_ids,
+                            optimal_schedule_path, use_gradient_method)
+        cnt += batch_size
 
-                recon = ((recon - drange[0]) / (drange[1] - drange[0]) * 255
-                         )  # recon with pixel values in [0, 255]
-                recon = recon.astype(np.uint8)
-                for i in range(batch_size):
-                    if todo[i]:
-                        np.save(output_filenames[i], recon[i])
-                        logger.info(f'*** Saved {output_filenames[i]} ***')
-                    else:
-                        logger.info(f'Skipped {output_filenames[i]}')
-
-                # compute errors
-                if args.save_all_timesteps:
-                    for i in range(batch_size):
-                        if todo[i]:
-                            np.save(q_sample_file_names[i],
-                                    all_timestep_q_sample[i])
-                            logger.info(
-                                f'*** Saved {q_sample_file_names[i]} ***')
-                        else:
-                            logger.info(f'Skipped {q_sample_file_names[i]}')
-
-                    error = all_timestep_q_sample - all_timestep_recon
-                    for i in range(batch_size):
-                        if todo[i]:
-                            np.save(error_file_names[i], error[i])
-                            logger.info(f'*** Saved {error_file_names[i]} ***')
-                        else:
-                            logger.info(f'Skipped {error_file_names[i]}')
-
-                    all_timestep_recon = (
-                        (all_timestep_recon - drange[0]) /
-                        (drange[1] - drange[0]) * 255
-                    )  # recon with pixel values in [0, 255]
-                    all_timestep_recon = all_timestep_recon.astype(np.uint8)
-                    for i in range(batch_size):
-                        if todo[i]:
-                            np.save(all_timestep_output_filenames[i],
-                                    all_timestep_recon[i])
-                            logger.info(f'*** Saved {output_filenames[i]} ***')
-                        else:
-                            logger.info(f'Skipped {output_filenames[i]}')
 
-        cnt += batch_size
+def main_work_queue(args, model, diffusion, dataset, use_gradient_method):
+    """Like main(), but claims (video, sample) pairs from a work queue shared
+    with all other workers running on the same eval_dir, so any number of
+    workers can be started and they stay busy until everything is done.
+
+    dataset is indexed by the dataset indices in args.indices.
+    """
+    optimal_schedule_path = (None if args.optimality is None else
+                             args.eval_dir / 'optimal_schedule.pt')
+    sample_indices = (range(args.num_samples)
+                      if args.sample_idx is None else [args.sample_idx])
+    units = [
+        f'{video_idx:04d}-{sample_idx}' for video_idx in args.indices
+        for sample_idx in sample_indices
+    ]
+    work_queue = WorkQueue(
+        args.eval_dir / 'work_queue',
+        units,
+        is_done=lambda unit:
+        (args.eval_dir / 'samples' / f'sample_{unit}.npy').exists(),
+        lease_seconds=args.lease_seconds,
+    )
+    logger.info(f'{work_queue.n_remaining()} of {len(units)} samples left.')
+    for file_ids in work_queue.batches(args.batch_size):
+        batch = torch.stack(
+            [dataset[int(file_id.split('-')[0])][0] for file_id in file_ids])
+        sample_and_save(args, model, diffusion, batch, file_ids,
+                        optimal_schedule_path, use_gradient_method)
 
 
 def visualise(args):
@@ -325,15 +339,15 @@ def visualise(args):
         adaptive_kwargs = dict(distance='lpips')
     else:
         adaptive_kwargs = {}
-    frame_indices_iterator = inference_util.inference_strategies[
-        args.inference_mode](
-            video_length=args.T,
-            num_obs=args.obs_length,
-            max_frames=args.max_frames,
-            step_size=args.step_size,
-            optimal_schedule_path=optimal_schedule_path,
-            **adaptive_kwargs,
-        )
+    frame_indices_iterator = inference_util.get_inference_strategy(
+        args.inference_mode,
+        video_length=args.T,
+        num_obs=args.obs_length,
+        max_frames=args.max_frames,
+        step_size=args.step_size,
+        optimal_schedule_path=optimal_schedule_path,
+        **adaptive_kwargs,
+    )
 
     def visualise_obs_lat_sequence(sequence, index, path):
         """if index is None, expects sequence to be a list of tuples of form
@@ -401,7 +415,7 @@ def visualise(args):
         visualise_obs_lat_sequence(indices, None, path)
 
 
-if __name__ == '__main__':
+def create_argparser():
     parser = ArgumentParser()
     parser.add_argument('checkpoint_path', type=str)
     parser.add_argument('--batch_size', type=int, default=8)
@@ -426,7 +440,33 @@ if __name__ == '__main__':
     parser.add_argument('--device',
                         default='cuda' if torch.cuda.is_available() else 'cpu')
     # Inference arguments
+    parser.add_argument(
+        '--stage_steps',
+        type=str,
+        default='',
+        help=
+        'Number of denoising steps of each inference stage, as "level:S1,S2,..." (by level of hierarchical strategies) or "distance:S1,S2,..." (by distance from the latent frames to the observed ones). See inference_util.StageStepSchedule. Defaults to all the steps in every stage.',
+    )
     parser.add_argument('--use_gradient_method', action='store_true')
+    parser.add_argument(
+        '--batched_guidance',
+        action='store_true',
+        help=
+        'With --use_gradient_method, guides sampling by extrapolating from the joint to the conditional prediction, computed in one batched forward pass, instead of backpropagating through the model.',
+    )
+    parser.add_argument(
+        '--guidance_weight',
+        type=float,
+        default=None,
+        help=
+        'Weight of the guidance with --use_gradient_method. Defaults to 10, or 1 with --batched_guidance.',
+    )
+    parser.add_argument(
+        '--guidance_checkpoint',
+        action='store_true',
+        help=
+        'With --use_gradient_method, uses gradient checkpointing in the backward pass through the model to save memory.',
+    )
     parser.add_argument(
         '--inference_mode',
         required=True,
@@ -462,7 +502,29 @@ if __name__ == '__main__':
         'If not None, only generate videos for the specified indices. Used for handling parallelization.',
     )
     parser.add_argument('--use_ddim', type=str2bool, default=False)
-    parser.add_argument('--timestep_respacing', type=str, default='')
+    parser.add_argument(
+        '--timestep_respacing',
+        type=str,
+        default='',
+        help=
+        'Timesteps to sample with, e.g. "50", "ddim50" or "quad20" (see respace.space_timesteps). Defaults to all the steps. Quadratic spacing suits --sampler dpm_solver++.',
+    )
+    parser.add_argument(
+        '--sampler',
+        type=str,
+        default=None,
+        choices=dpm_solver.SAMPLERS,
+        help=
+        'ddpm for ancestral sampling, or dpm_solver++ for the multistep DPM-Solver++ ODE solver, which needs far fewer steps (10-25, see --timestep_respacing and --stage_steps). Defaults to ddpm, or to DDIM (dpm_solver++ of order 1) for models trained with progressive distillation, which ddpm cannot sample.',
+    )
+    parser.add_argument(
+        '--solver_order',
+        type=int,
+        default=2,
+        choices=[1, 2, 3],
+        help=
+        'Order of DPM-Solver++ (order 1 is DDIM). Defaults to 2, which is the most stable with guidance.',
+    )
     parser.add_argument(
         '--T',
         type=int,
@@ -525,8 +587,39 @@ if __name__ == '__main__':
         help='The ground truth observed frames to use. Default is to use x_0.',
     )
     parser.add_argument('--save_all_timesteps', action='store_true')
+    parser.add_argument(
+        '--max_canvas_gb',
+        type=float,
+        default=None,
+        help=
+        'Videos larger than this (in GB) are kept in host memory while sampling, instead of on the device. Defaults to half of the free GPU memory.',
+    )
+    parser.add_argument(
+        '--compile_mode',
+        type=str,
+        default='none',
+        choices=compile_util.COMPILE_MODES,
+        help=
+        'How to compile the model calls for sampling (once per input shape): a TorchScript trace, the trace captured in a CUDA graph, or torch.compile. Falls back to the eager model where compilation fails.',
+    )
+    parser.add_argument(
+        '--work_queue',
+        action='store_true',
+        help=
+        'If given, claims (video, sample) pairs from a work queue in eval_dir shared by all workers, instead of processing a fixed set of indices.',
+    )
+    parser.add_argument(
+        '--lease_seconds',
+        type=int,
+        default=600,
+        help=
+        'With --work_queue, how long a claim on a sample lasts if its worker stops renewing it.',
+    )
+    return parser
 
-    args = parser.parse_args()
+
+if __name__ == '__main__':
+    args = create_argparser().parse_args()
 
     args.eval_dir = test_util.get_model_results_path(
         args) / test_util.get_eval_run_identifier(args)
@@ -565,6 +658,9 @@ if __name__ == '__main__':
     model.load_state_dict(state_dict)
     model = model.to(args.device)
     model.eval()
+    model = compile_util.compile_for_inference(model, args.compile_mode)
+    test_util.configure_guidance(diffusion, args)
+    test_util.configure_sampler(args, getattr(model_args, 'distill_rounds', 0))
     # Update max_frames if not set
     if args.max_frames is None:
         args.max_frames = model_args.max_frames
@@ -574,7 +670,8 @@ if __name__ == '__main__':
         dataset_name=model_args.dataset, T=args.T)
     logger.info(f'Dataset size = {len(dataset)}')
     # Prepare the indices
-    if args.indices is None and args.task_id is not None:
+    if (args.indices is None and args.task_id is not None
+            and not args.work_queue):
         assert args.subset_size is None
         task_id = args.task_id
         args.indices = list(
@@ -590,6 +687,7 @@ if __name__ == '__main__':
         args.indices = list(range(len(dataset)))
         logger.info('Generating predictions for the whole dataset.')
     # Take a subset of the dataset according to the indices
+    full_dataset = dataset
     dataset = torch.utils.data.Subset(dataset, args.indices)
     logger.info(
         f'Dataset size (after subsampling according to indices) = {len(dataset)}'
@@ -629,11 +727,20 @@ if __name__ == '__main__':
         logger.info(f'Saved model config at {json_path}')
 
     # Generate the samples
-    main(
-        args,
-        model,
-        diffusion,
-        dataloader,
-        dataset_indices=args.indices,
-        use_gradient_method=args.use_gradient_method,
-    )
+    if args.work_queue:
+        main_work_queue(
+            args,
+            model,
+            diffusion,
+            full_dataset,
+            use_gradient_method=args.use_gradient_method,
+        )
+    else:
+        main(
+            args,
+            model,
+            diffusion,
+            dataloader,
+            dataset_indices=args.indices,
+            use_gradient_method=args.use_gradient_method,
+        )
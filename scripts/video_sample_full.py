@@ -1,3 +1,4 @@
+import itertools
 import json
 import logging
 import os
@@ -12,7 +13,8 @@ from PIL import Image
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
-from improved_diffusion import dist_util, inference_util, test_util
+from improved_diffusion import (compile_util, dist_util, dpm_solver,
+                                inference_util, test_util)
 from improved_diffusion.image_datasets import (get_test_dataset,
                                                get_train_dataset,
                                                get_variable_length_dataset)
@@ -50,6 +52,172 @@ def get_masks(x0, num_obs):
     return obs_mask, latent_mask, kinda_marg_mask
 
 
+def stack_stages(stages, B, adaptive):
+    """Pads the frames of several inference stages to a common length, so
+    that they can go through the model together.
+
+    Args:
+        stages (list): (observed, latent) frame indices of each stage. The
+            indices are shared by all videos, or given per video (as lists of
+            B lists) if adaptive is True.
+        B (int): Batch size.
+        adaptive (bool): Whether the indices are given per video.
+
+    Returns:
+        The frame indices (BxSxK, padded with 0), and the observation and
+        latent masks (SxK) of the S stages.
+    """
+    S = len(stages)
+    n_obs = np.zeros(S, dtype=np.int64)
+    n_latent = np.zeros(S, dtype=np.int64)
+    rows = []
+    for s, (obs_frame_indices, latent_frame_indices) in enumerate(stages):
+        if not adaptive:
+            obs_frame_indices = [obs_frame_indices] * B
+            latent_frame_indices = [latent_frame_indices] * B
+        n_obs[s] = len(obs_frame_indices[0])
+        n_latent[s] = len(latent_frame_indices[0])
+        rows.append([
+            list(obs) + list(latent)
+            for obs, latent in zip(obs_frame_indices, latent_frame_indices)
+        ])
+    K = int((n_obs + n_latent).max())
+    frame_indices = np.zeros((B, S, K), dtype=np.int64)
+    for s, row in enumerate(rows):
+        for b, indices in enumerate(row):
+            frame_indices[b, s, :len(indices)] = indices
+    k = np.arange(K)[None]
+    obs_mask = k < n_obs[:, None]
+    latent_mask = (k >= n_obs[:, None]) & (k < (n_obs + n_latent)[:, None])
+    return frame_indices, obs_mask, latent_mask
+
+
+class PredictionHistory:
+    """The predictions of x_0 of the frames at the previous timesteps, which
+    the multistep DPM-Solver++ steps of horizontal diffusion are taken with
+    (see inference_util.sample_step). Kept in VideoCanvases like the videos.
+
+    Args:
+        shape (tuple): Shape of the videos (BxTxCxHxW).
+        order (int): The order of the solver, which uses order - 1 previous
+            predictions.
+        **kwargs: The arguments of the VideoCanvases.
+    """
+    def __init__(self, shape, order, **kwargs):
+        # The previous predictions (the most recent last), followed by the
+        # ones of the current timestep.
+        self.canvases = [
+            inference_util.VideoCanvas(shape, **kwargs) for _ in range(order)
+        ]
+        self.n_timesteps = 0
+
+    def read(self, frame_indices):
+        """Returns the previous predictions of the given frames."""
+        n = min(self.n_timesteps, len(self.canvases) - 1)
+        return [
+            canvas.read(frame_indices)
+            for canvas in self.canvases[len(self.canvases) - 1 - n:-1]
+        ]
+
+    def write(self, frame_indices, pred):
+        """Writes the predictions of the given frames at the current
+        timestep."""
+        self.canvases[-1].write(frame_indices, pred)
+
+    def write_previous(self, frame_indices, preds):
+        """Writes predictions of the given frames at the previous timesteps
+        (the most recent last), e.g. from vertical diffusion."""
+        for canvas, pred in zip(self.canvases[-1 - len(preds):-1], preds):
+            canvas.write(frame_indices, pred)
+
+    def next_timestep(self):
+        """Moves on to the next timestep."""
+        self.canvases = self.canvases[1:] + self.canvases[:1]
+        self.n_timesteps += 1
+
+
+@torch.no_grad()
+def fused_horizontal_step(model,
+                          diffusion,
+                          samples,
+                          timestep,
+                          frame_indices,
+                          obs_mask,
+                          latent_mask,
+                          *,
+                          history=None,
+                          use_gradient_method):
+    """Takes one horizontal diffusion step for all the inference stages at
+    once.
+
+    Every stage reads the videos as they were before this step; the latent
+    frames of all the stages are written back together at the end. Stages
+    are padded to the same number of frames (see stack_stages). Padding
+    frames are neither observed nor latent, so the model ignores them.
+
+    Args:
+        samples (VideoCanvas): The videos being sampled.
+        timestep (int): The diffusion timestep.
+        frame_indices (torch.LongTensor): BxSxK frame indices.
+        obs_mask, latent_mask (torch.BoolTensor): SxK masks.
+        history (PredictionHistory): The predictions of x_0 of the previous
+            timesteps, with --sampler dpm_solver++.
+    """
+    B, S, K = frame_indices.shape
+    frame_shape = samples.videos.shape[2:]
+    x0 = samples.read(frame_indices.flatten(1)).view(B, S, K, *frame_shape)
+    previous_preds = [] if history is None else [
+        pred.view(B, S, K, *frame_shape)
+        for pred in history.read(frame_indices.flatten(1))
+    ]
+    local_samples = []
+    local_preds = []
+    chunk_size = args.horizontal_batch_size or S
+    for s0 in range(0, S, chunk_size):
+        stage_slice = slice(s0, s0 + chunk_size)
+        n_stages = len(range(S)[stage_slice])
+
+        def rows(mask):
+            return mask[stage_slice].float().view(1, n_stages, K, 1, 1,
+                                                  1).expand(
+                                                      B, -1, -1, -1, -1,
+                                                      -1).flatten(0, 1)
+
+        stage_obs_mask, stage_latent_mask = rows(obs_mask), rows(latent_mask)
+        x = x0[:, stage_slice].flatten(
+            0, 1) * (stage_obs_mask + stage_latent_mask)
+        out = inference_util.sample_step(
+            model,
+            diffusion,
+            x,
+            timestep,
+            dict(
+                frame_indices=frame_indices[:, stage_slice].flatten(0, 1),
+                x0=x,
+                obs_mask=stage_obs_mask,
+                latent_mask=stage_latent_mask,
+                kinda_marg_mask=torch.zeros_like(stage_obs_mask),
+                x_t_minus_1=x,
+                observed_frames=args.observed_frames,
+            ),
+            sampler=args.sampler,
+            preds=[
+                pred[:, stage_slice].flatten(0, 1) for pred in previous_preds
+            ],
+            solver_order=args.solver_order,
+            use_gradient_method=use_gradient_method,
+        )
+        local_samples.append(out['sample'].view(B, n_stages, K, *frame_shape))
+        local_preds.append(out['pred_xstart'].view(B, n_stages, K,
+                                                   *frame_shape))
+    local_samples = torch.cat(local_samples, dim=1)
+    # Fill in the generated frames
+    samples.write(frame_indices[:, latent_mask], local_samples[:, latent_mask])
+    if history is not None:
+        history.write(frame_indices[:, latent_mask],
+                      torch.cat(local_preds, dim=1)[:, latent_mask])
+
+
 @torch.no_grad()
 def infer_video(
     mode,
@@ -70,38 +238,58 @@ def infer_video(
     CxWxH: image size
     """
     B, T, C, H, W = batch.shape
-    samples = torch.zeros_like(batch).cpu()
-    samples[:, :obs_length] = batch[:, :
-                                    obs_length]  # Observed frames ground truth
+    samples = inference_util.VideoCanvas(batch.shape,
+                                         device=batch.device,
+                                         dtype=batch.dtype,
+                                         max_device_gb=args.max_canvas_gb)
+    # Observed frames ground truth
+    samples.write(list(range(obs_length)), batch[:, :obs_length])
     if 'goal-directed' in mode:
-        samples[:, -5] = batch[:, -5]
+        samples.write([T - 5], batch[:, -5:-4])
     adaptive_kwargs = dict(distance='lpips') if 'adaptive' in mode else {}
     if args.save_all_timesteps:
         all_timestep_samples = torch.zeros(
             [B, diffusion.num_timesteps, T, C, H, W]).cpu()
         all_timestep_samples[:, :, :obs_length] = (
-            samples[:, :obs_length].unsqueeze(1).expand(
+            batch[:, :obs_length].cpu().unsqueeze(1).expand(
                 -1, diffusion.num_timesteps, -1, -1, -1, -1))
     else:
         all_timestep_samples = torch.zeros([1])
+    # DPM-Solver++ takes the predictions of the previous timesteps into
+    # account in horizontal diffusion, and starts from Gaussian noise.
+    if args.sampler == 'dpm_solver++' and args.solver_order > 1:
+        history = PredictionHistory(batch.shape,
+                                    args.solver_order,
+                                    device=batch.device,
+                                    dtype=batch.dtype,
+                                    max_device_gb=args.max_canvas_gb)
+    else:
+        history = None
+    if args.sampler == 'dpm_solver++' and args.vertical_steps == 0:
+        observed = list(range(obs_length))
+        if 'goal-directed' in mode:
+            observed.append(T - 5)
+        latent = [i for i in range(T) if i not in observed]
+        samples.write(latent, torch.randn_like(batch[:, latent]))
 
     if args.vertical_steps > 0:
         # vertical diffusion
-        frame_indices_iterator = iter(
-            inference_util.inference_strategies[mode](
-                video_length=T,
-                num_obs=obs_length,
-                max_frames=max_frames,
-                step_size=step_size,
-                optimal_schedule_path=optimal_schedule_path,
-                **adaptive_kwargs,
-            ))
+        frame_indices_iterator = inference_util.get_inference_strategy(
+            mode,
+            video_length=T,
+            num_obs=obs_length,
+            max_frames=max_frames,
+            step_size=step_size,
+            optimal_schedule_path=optimal_schedule_path,
+            **adaptive_kwargs,
+        )
         vertical_diff_timesteps = list(range(
             diffusion.num_timesteps))[::-1][:args.vertical_steps]
 
         while True:
             if 'adaptive' in mode:
-                frame_indices_iterator.set_videos(samples.to(batch.device))
+                frame_indices_iterator.set_videos(samples.videos,
+                                                  device=batch.device)
             try:
                 obs_frame_indices, latent_frame_indices = next(
                     frame_indices_iterator)
@@ -110,36 +298,11 @@ def infer_video(
             logger.info(f'Conditioning on {sorted(obs_frame_indices)} frames, '
                         f'predicting {sorted(latent_frame_indices)}.\n')
             # Prepare network's input
-            if 'adaptive' in mode:
-                frame_indices = torch.cat(
-                    [
-                        torch.tensor(obs_frame_indices),
-                        torch.tensor(latent_frame_indices)
-                    ],
-                    dim=1,
-                )
-                x0 = torch.stack(
-                    [samples[i, fi] for i, fi in enumerate(frame_indices)],
-                    dim=0).clone()
-                obs_mask, latent_mask, kinda_marg_mask = get_masks(
-                    x0, len(obs_frame_indices[0]))
-                n_latent = len(latent_frame_indices[0])
-            else:
-                x0 = torch.cat([
-                    samples[:, obs_frame_indices],
-                    samples[:, latent_frame_indices]
-                ],
-                               dim=1).clone()
-                frame_indices = torch.cat(
-                    [
-                        torch.tensor(obs_frame_indices),
-                        torch.tensor(latent_frame_indices)
-                    ],
-                    dim=0,
-                ).repeat((B, 1))
-                obs_mask, latent_mask, kinda_marg_mask = get_masks(
-                    x0, len(obs_frame_indices))
-                n_latent = len(latent_frame_indices)
+            x0, frame_indices = samples.read_stage(obs_frame_indices,
+                                                   latent_frame_indices)
+            n_obs = (len(obs_frame_indices[0])
+                     if 'adaptive' in mode else len(obs_frame_indices))
+            obs_mask, latent_mask, kinda_marg_mask = get_masks(x0, n_obs)
             # Prepare masks
             logger.info(
                 f"{'Frame indices':20}: {frame_indices[0].cpu().numpy()}.")
@@ -150,33 +313,33 @@ def infer_video(
                 f"{'Latent mask':20}: {latent_mask[0].cpu().int().numpy().squeeze()}"
             )
             logger.info('-' * 40)
-            # Move tensors to the correct device
-            [x0, obs_mask, latent_mask, kinda_marg_mask, frame_indices] = [
-                xyz.to(batch.device) for xyz in
-                [x0, obs_mask, latent_mask, kinda_marg_mask, frame_indices]
-            ]
 
             all_timestep_local_samples = []
-            local_samples = x0.clone()
-            for timestep in vertical_diff_timesteps:
-                local_samples = diffusion.p_sample(
-                    model,
-                    local_samples,
-                    t=torch.tensor([timestep] * x0.shape[0],
-                                   device=next(model.parameters()).device),
-                    clip_denoised=True,
-                    model_kwargs=dict(
-                        frame_indices=frame_indices,
-                        x0=x0,
-                        obs_mask=obs_mask,
-                        latent_mask=latent_mask,
-                        kinda_marg_mask=kinda_marg_mask,
-                        x_t_minus_1=x0,  # placeholder, x_t_minus_1 not allowed
-                        observed_frames='x_0',
-                    ),
-                    return_attn_weights=False,
-                    use_gradient_method=use_gradient_method,
-                )['sample']
+            model_kwargs = dict(
+                frame_indices=frame_indices,
+                x0=x0,
+                obs_mask=obs_mask,
+                latent_mask=latent_mask,
+                kinda_marg_mask=kinda_marg_mask,
+                x_t_minus_1=x0,  # placeholder, x_t_minus_1 not allowed
+                observed_frames='x_0',
+            )
+            preds = []
+            for out in itertools.islice(
+                    inference_util.sample_stage(
+                        model,
+                        diffusion,
+                        x0,
+                        model_kwargs,
+                        sampler=args.sampler,
+                        solver_order=args.solver_order,
+                        use_gradient_method=use_gradient_method,
+                    ), len(vertical_diff_timesteps)):
+                local_samples = out['sample']
+                if history is not None:
+                    # The predictions horizontal diffusion starts with
+                    preds.append(out['pred_xstart'])
+                    preds = preds[1 - args.solver_order:]
                 if args.save_all_timesteps:
                     all_timestep_local_samples.append(local_samples.clone())
             if args.save_all_timesteps:
@@ -184,136 +347,148 @@ def infer_video(
                     all_timestep_local_samples, dim=1)  # BxTimestepxTxCxHxW
 
             # Fill in the generated frames
-            if 'adaptive' in mode:
-                n_obs = len(obs_frame_indices[0])
-                for i, li in enumerate(latent_frame_indices):
-                    samples[i, li] = local_samples[i, n_obs:].cpu()
-                    if args.save_all_timesteps:
+            samples.write(latent_frame_indices, local_samples[:, n_obs:])
+            if history is not None:
+                history.write_previous(latent_frame_indices,
+                                       [pred[:, n_obs:] for pred in preds])
+            if args.save_all_timesteps:
+                if 'adaptive' in mode:
+                    for i, li in enumerate(latent_frame_indices):
                         all_timestep_samples[
                             i, :len(vertical_diff_timesteps),
                             li] = all_timestep_local_samples[
                                 i, :len(vertical_diff_timesteps),
                                 n_obs:].cpu()
-            else:
-                samples[:,
-                        latent_frame_indices] = local_samples[:,
-                                                              -n_latent:].cpu(
-                                                              )
-                if args.save_all_timesteps:
+                else:
                     all_timestep_samples[:, :len(vertical_diff_timesteps), latent_frame_indices] = \
-                        all_timestep_local_samples[:, :len(vertical_diff_timesteps), -n_latent:].cpu()
+                        all_timestep_local_samples[:, :len(vertical_diff_timesteps), n_obs:].cpu()
+
+        if history is not None:
+            history.n_timesteps = len(vertical_diff_timesteps)
 
     # horizontal diffusion
     horizontal_diff_timesteps = list(range(
         diffusion.num_timesteps))[::-1][args.vertical_steps:]
     all_horizontal_timestep_samples = []
-    for timestep in horizontal_diff_timesteps:
+    if args.fused_horizontal and not inference_util.is_adaptive(mode):
+        # The stages are the same at every timestep.
+        stages = stack_stages(
+            inference_util.get_inference_plan(
+                mode,
+                video_length=T,
+                num_obs=obs_length,
+                max_frames=max_frames,
+                step_size=step_size,
+                optimal_schedule_path=optimal_schedule_path), B, False)
+        stages = [torch.as_tensor(a, device=batch.device) for a in stages]
+    if args.fused_horizontal:
+        for timestep in horizontal_diff_timesteps:
+            logger.info(f'T={timestep}' + '-' * 40)
+            if inference_util.is_adaptive(mode):
+                # Adaptive strategies choose the stages from the videos at the
+                # previous timestep.
+                frame_indices_iterator = inference_util.get_inference_strategy(
+                    mode,
+                    video_length=T,
+                    num_obs=obs_length,
+                    max_frames=max_frames,
+                    step_size=step_size,
+                    optimal_schedule_path=optimal_schedule_path,
+                    **adaptive_kwargs,
+                )
+                frame_indices_iterator.set_videos(samples.videos,
+                                                  device=batch.device)
+                stages = stack_stages(list(frame_indices_iterator), B, True)
+                stages = [
+                    torch.as_tensor(a, device=batch.device) for a in stages
+                ]
+            fused_horizontal_step(model,
+                                  diffusion,
+                                  samples,
+                                  timestep,
+                                  *stages,
+                                  history=history,
+                                  use_gradient_method=use_gradient_method)
+            if history is not None:
+                history.next_timestep()
+            if args.save_all_timesteps:
+                all_horizontal_timestep_samples.append(samples.videos.cpu())
+    else:
+        for timestep in horizontal_diff_timesteps:
 
-        frame_indices_iterator = iter(
-            inference_util.inference_strategies[mode](
+            frame_indices_iterator = inference_util.get_inference_strategy(
+                mode,
                 video_length=T,
                 num_obs=obs_length,
                 max_frames=max_frames,
                 step_size=step_size,
                 optimal_schedule_path=optimal_schedule_path,
                 **adaptive_kwargs,
-            ))
-
-        while True:
-            if 'adaptive' in mode:
-                frame_indices_iterator.set_videos(samples.to(batch.device))
-            try:
-                obs_frame_indices, latent_frame_indices = next(
-                    frame_indices_iterator)
-            except StopIteration:
-                break
-            logger.info(
-                f'Conditioning on {sorted(obs_frame_indices)} frames, predicting {sorted(latent_frame_indices)}.\n'
             )
-            # Prepare network's input
-            if 'adaptive' in mode:
-                frame_indices = torch.cat(
-                    [
-                        torch.tensor(obs_frame_indices),
-                        torch.tensor(latent_frame_indices),
-                    ],
-                    dim=1,
+
+            while True:
+                if 'adaptive' in mode:
+                    frame_indices_iterator.set_videos(samples.videos,
+                                                      device=batch.device)
+                try:
+                    obs_frame_indices, latent_frame_indices = next(
+                        frame_indices_iterator)
+                except StopIteration:
+                    break
+                logger.info(
+                    f'Conditioning on {sorted(obs_frame_indices)} frames, predicting {sorted(latent_frame_indices)}.\n'
+                )
+                # Prepare network's input (ground truth from samples)
+                x0, frame_indices = samples.read_stage(obs_frame_indices,
+                                                       latent_frame_indices)
+                n_obs = (len(obs_frame_indices[0])
+                         if 'adaptive' in mode else len(obs_frame_indices))
+                obs_mask, latent_mask, kinda_marg_mask = get_masks(x0, n_obs)
+                # Prepare masks
+                logger.info(
+                    f"{'Frame indices':20}: {frame_indices[0].cpu().numpy()}.")
+                logger.info(
+                    f"{'Observation mask':20}: {obs_mask[0].cpu().int().numpy().squeeze()}"
+                )
+                logger.info(
+                    f"{'Latent mask':20}: {latent_mask[0].cpu().int().numpy().squeeze()}"
                 )
-                x0 = torch.stack(
-                    [samples[i, fi] for i, fi in enumerate(frame_indices)],
-                    dim=0).clone()
-                obs_mask, latent_mask, kinda_marg_mask = get_masks(
-                    x0, len(obs_frame_indices[0]))
-                n_latent = len(latent_frame_indices[0])
-            else:
-                x0 = torch.cat(
-                    [
-                        samples[:, obs_frame_indices],
-                        samples[:, latent_frame_indices]
-                    ],
-                    dim=1,
-                ).clone()  # retrieve ground truth from samples
-                frame_indices = torch.cat(
-                    [
-                        torch.tensor(obs_frame_indices),
-                        torch.tensor(latent_frame_indices),
-                    ],
-                    dim=0,
-                ).repeat((B, 1))
-                obs_mask, latent_mask, kinda_marg_mask = get_masks(
-                    x0, len(obs_frame_indices))
-                n_latent = len(latent_frame_indices)
-            # Prepare masks
-            logger.info(
-                f"{'Frame indices':20}: {frame_indices[0].cpu().numpy()}.")
-            logger.info(
-                f"{'Observation mask':20}: {obs_mask[0].cpu().int().numpy().squeeze()}"
-            )
-            logger.info(
-                f"{'Latent mask':20}: {latent_mask[0].cpu().int().numpy().squeeze()}"
-            )
 
-            logger.info('T=' + str(timestep) + '-' * 40)
+                logger.info('T=' + str(timestep) + '-' * 40)
 
-            # logger.info("-" * 40)
-            # Move tensors to the correct device
-            [x0, obs_mask, latent_mask, kinda_marg_mask, frame_indices] = [
-                xyz.to(batch.device) for xyz in
-                [x0, obs_mask, latent_mask, kinda_marg_mask, frame_indices]
-            ]
+                # logger.info("-" * 40)
 
-            # Run the network
-            local_samples = diffusion.p_sample(
-                model,
-                x0,
-                t=torch.tensor([timestep] * x0.shape[0],
-                               device=next(model.parameters()).device),
-                clip_denoised=True,
-                model_kwargs=dict(
-                    frame_indices=frame_indices,
-                    x0=x0,
-                    obs_mask=obs_mask,
-                    latent_mask=latent_mask,
-                    kinda_marg_mask=kinda_marg_mask,
-                    x_t_minus_1=x0,  # actually x_t_minus_1
-                    observed_frames=args.observed_frames,
-                ),
-                return_attn_weights=False,
-                use_gradient_method=use_gradient_method,
-            )['sample']
+                # Run the network
+                out = inference_util.sample_step(
+                    model,
+                    diffusion,
+                    x0,
+                    timestep,
+                    dict(
+                        frame_indices=frame_indices,
+                        x0=x0,
+                        obs_mask=obs_mask,
+                        latent_mask=latent_mask,
+                        kinda_marg_mask=kinda_marg_mask,
+                        x_t_minus_1=x0,  # actually x_t_minus_1
+                        observed_frames=args.observed_frames,
+                    ),
+                    sampler=args.sampler,
+                    preds=([] if history is None else
+                           history.read(frame_indices)),
+                    solver_order=args.solver_order,
+                    use_gradient_method=use_gradient_method,
+                )
 
-            # Fill in the generated frames
-            if 'adaptive' in mode:
-                n_obs = len(obs_frame_indices[0])
-                for i, li in enumerate(latent_frame_indices):
-                    samples[i, li] = local_samples[i, n_obs:].cpu()
-            else:
-                samples[:,
-                        latent_frame_indices] = local_samples[:,
-                                                              -n_latent:].cpu(
-                                                              )
-        if args.save_all_timesteps:
-            all_horizontal_timestep_samples.append(samples.clone())
+                # Fill in the generated frames
+                samples.write(latent_frame_indices, out['sample'][:, n_obs:])
+                if history is not None:
+                    history.write(latent_frame_indices,
+                                  out['pred_xstart'][:, n_obs:])
+            if history is not None:
+                history.next_timestep()
+            if args.save_all_timesteps:
+                all_horizontal_timestep_samples.append(samples.videos.cpu())
     if args.save_all_timesteps:
         all_horizontal_timestep_samples = torch.stack(
             all_horizontal_timestep_samples,
@@ -461,15 +636,15 @@ def visualise(args):
         adaptive_kwargs = dict(distance='lpips')
     else:
         adaptive_kwargs = {}
-    frame_indices_iterator = inference_util.inference_strategies[
-        args.inference_mode](
-            video_length=args.T,
-            num_obs=args.obs_length,
-            max_frames=args.max_frames,
-            step_size=args.step_size,
-            optimal_schedule_path=optimal_schedule_path,
-            **adaptive_kwargs,
-        )
+    frame_indices_iterator = inference_util.get_inference_strategy(
+        args.inference_mode,
+        video_length=args.T,
+        num_obs=args.obs_length,
+        max_frames=args.max_frames,
+        step_size=args.step_size,
+        optimal_schedule_path=optimal_schedule_path,
+        **adaptive_kwargs,
+    )
 
     def visualise_obs_lat_sequence(sequence, index, path):
         """if index is None, expects sequence to be a list of tuples of form
@@ -563,6 +738,25 @@ if __name__ == '__main__':
                         default='cuda' if torch.cuda.is_available() else 'cpu')
     # Inference arguments
     parser.add_argument('--use_gradient_method', action='store_true')
+    parser.add_argument(
+        '--batched_guidance',
+        action='store_true',
+        help=
+        'With --use_gradient_method, guides sampling by extrapolating from the joint to the conditional prediction, computed in one batched forward pass, instead of backpropagating through the model.',
+    )
+    parser.add_argument(
+        '--guidance_weight',
+        type=float,
+        default=None,
+        help=
+        'Weight of the guidance with --use_gradient_method. Defaults to 10, or 1 with --batched_guidance.',
+    )
+    parser.add_argument(
+        '--guidance_checkpoint',
+        action='store_true',
+        help=
+        'With --use_gradient_method, uses gradient checkpointing in the backward pass through the model to save memory.',
+    )
     parser.add_argument(
         '--inference_mode',
         required=True,
@@ -599,6 +793,22 @@ if __name__ == '__main__':
     )
     parser.add_argument('--use_ddim', type=str2bool, default=False)
     parser.add_argument('--timestep_respacing', type=str, default='')
+    parser.add_argument(
+        '--sampler',
+        type=str,
+        default=None,
+        choices=dpm_solver.SAMPLERS,
+        help=
+        'ddpm for ancestral sampling, or dpm_solver++ for the multistep DPM-Solver++ ODE solver, which needs far fewer steps (10-25, see --timestep_respacing). Defaults to ddpm, or to DDIM (dpm_solver++ of order 1) for models trained with progressive distillation, which ddpm cannot sample.',
+    )
+    parser.add_argument(
+        '--solver_order',
+        type=int,
+        default=2,
+        choices=[1, 2, 3],
+        help=
+        'Order of DPM-Solver++ (order 1 is DDIM). Defaults to 2, which is the most stable with guidance.',
+    )
     parser.add_argument(
         '--T',
         type=int,
@@ -669,14 +879,43 @@ if __name__ == '__main__':
         'Number of vertical diffusion steps to take in the latent space. Default is 0.',
     )
     parser.add_argument('--save_all_timesteps', action='store_true')
+    parser.add_argument(
+        '--fused_horizontal',
+        action='store_true',
+        help=
+        'Take each horizontal diffusion step for all the inference stages at once, in a single (padded) model call, instead of one stage after another. Every stage then sees the other frames as they were at the previous timestep, so --observed_frames x_t labels them correctly.',
+    )
+    parser.add_argument(
+        '--horizontal_batch_size',
+        type=int,
+        default=None,
+        help=
+        'With --fused_horizontal, the maximum number of inference stages per model call (each stage contributes batch_size rows). Defaults to all of them.',
+    )
+    parser.add_argument(
+        '--max_canvas_gb',
+        type=float,
+        default=None,
+        help=
+        'Videos larger than this (in GB) are kept in host memory while sampling, instead of on the device. Defaults to half of the free GPU memory.',
+    )
+    parser.add_argument(
+        '--compile_mode',
+        type=str,
+        default='none',
+        choices=compile_util.COMPILE_MODES,
+        help=
+        'How to compile the model calls for sampling (once per input shape): a TorchScript trace, the trace captured in a CUDA graph, or torch.compile. Falls back to the eager model where compilation fails.',
+    )
 
     args = parser.parse_args()
 
     args.eval_dir = test_util.get_model_results_path(
         args) / test_util.get_eval_run_identifier(
             args,
-            postfix='_full' if args.vertical_steps == 0 else
-            '_hybrid_{}'.format(args.vertical_steps))
+            postfix=('_full' if args.vertical_steps == 0 else
+                     '_hybrid_{}'.format(args.vertical_steps)) +
+            ('_fused' if args.fused_horizontal else ''))
     args.eval_dir.mkdir(parents=True, exist_ok=True)
     logging.basicConfig(filename=args.eval_dir / 'video_sample_full.log',
                         filemode='w',
@@ -712,6 +951,9 @@ if __name__ == '__main__':
     model.load_state_dict(state_dict)
     model = model.to(args.device)
     model.eval()
+    model = compile_util.compile_for_inference(model, args.compile_mode)
+    test_util.configure_guidance(diffusion, args)
+    test_util.configure_sampler(args, getattr(model_args, 'distill_rounds', 0))
     # Update max_frames if not set
     if args.max_frames is None:
         args.max_frames = model_args.max_frames
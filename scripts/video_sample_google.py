@@ -13,7 +13,8 @@ from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 from video_sample import visualise
 
-from improved_diffusion import dist_util, inference_util, test_util
+from improved_diffusion import (compile_util, dist_util, dpm_solver,
+                                inference_util, test_util)
 from improved_diffusion.image_datasets import (get_test_dataset,
                                                get_train_dataset)
 from improved_diffusion.script_util import (args_to_dict,
@@ -52,8 +53,15 @@ def get_masks(x0, num_obs):
 
 
 @torch.no_grad()
-def infer_video(mode, models, diffusions, batch, obs_length,
-                use_gradient_method):
+def infer_video(mode,
+                models,
+                diffusions,
+                batch,
+                obs_length,
+                use_gradient_method,
+                max_canvas_gb=None,
+                sampler='ddpm',
+                solver_order=2):
     """
     batch has a shape of BxTxCxHxW where
     B: batch size
@@ -61,34 +69,32 @@ def infer_video(mode, models, diffusions, batch, obs_length,
     CxWxH: image size
     """
     B, T, C, H, W = batch.shape
-    samples = torch.zeros_like(batch).cpu()
-    samples[:, :obs_length] = batch[:, :obs_length]
+    samples = inference_util.VideoCanvas(batch.shape,
+                                         device=batch.device,
+                                         dtype=batch.dtype,
+                                         max_device_gb=max_canvas_gb)
+    samples.write(list(range(obs_length)), batch[:, :obs_length])
 
     assert (
         obs_length == 36
     ), 'Inference for observation lengths other than 36 is not implemented.'
     assert mode == 'google'
-    inference_strategy = inference_util.inference_strategies[mode](
-        video_length=T, num_obs=obs_length)
+    plan = inference_util.get_inference_plan(mode,
+                                             video_length=T,
+                                             num_obs=obs_length)
 
-    for obs_frame_indices, latent_frame_indices in inference_strategy:
+    for stage, (obs_frame_indices, latent_frame_indices) in enumerate(plan):
         print(
             f'Conditioning on {sorted(obs_frame_indices)} frames, predicting {sorted(latent_frame_indices)}.\n'
         )
-        model = models[inference_strategy._active_iterator]
-        diffusion = diffusions[inference_strategy._active_iterator]
+        # The tag of each stage is the model it uses ('fs4' or 'fs1').
+        model = models[plan.tags[stage]]
+        diffusion = diffusions[plan.tags[stage]]
         # Prepare network's input
-        x0 = torch.cat(
-            [samples[:, obs_frame_indices], samples[:, latent_frame_indices]],
-            dim=1).clone()
-        frame_indices = torch.cat([
-            torch.tensor(obs_frame_indices),
-            torch.tensor(latent_frame_indices)
-        ],
-                                  dim=0).repeat((B, 1))
+        x0, frame_indices = samples.read_stage(obs_frame_indices,
+                                               latent_frame_indices)
         obs_mask, latent_mask, kinda_marg_mask = get_masks(
             x0, len(obs_frame_indices))
-        n_latent = len(latent_frame_indices)
         # Prepare masks
         print(f"{'Frame indices':20}: {frame_indices[0].cpu().numpy()}.")
         print(
@@ -98,35 +104,27 @@ def infer_video(mode, models, diffusions, batch, obs_length,
             f"{'Latent mask':20}: {latent_mask[0].cpu().int().numpy().squeeze()}"
         )
         print('-' * 40)
-        # Move tensors to the correct device
-        [x0, obs_mask, latent_mask, kinda_marg_mask, frame_indices] = [
-            xyz.to(batch.device) for xyz in
-            [x0, obs_mask, latent_mask, kinda_marg_mask, frame_indices]
-        ]
         # Run the network
-        local_samples, attention_map = diffusion.p_sample_loop(
-            model,
-            x0.shape,
-            clip_denoised=True,
-            model_kwargs=dict(
-                frame_indices=frame_indices,
-                x0=x0,
-                obs_mask=obs_mask,
-                latent_mask=latent_mask,
-                kinda_marg_mask=kinda_marg_mask,
-            ),
-            latent_mask=latent_mask,
-            return_attn_weights=False,
-            use_gradient_method=use_gradient_method,
-        )
+        for out in inference_util.sample_stage(
+                model,
+                diffusion,
+                x0,
+                dict(
+                    frame_indices=frame_indices,
+                    x0=x0,
+                    obs_mask=obs_mask,
+                    latent_mask=latent_mask,
+                    kinda_marg_mask=kinda_marg_mask,
+                ),
+                sampler=sampler,
+                solver_order=solver_order,
+                noise=torch.randn_like(x0),
+                use_gradient_method=use_gradient_method,
+        ):
+            local_samples = out['sample']
         # Fill in the generated frames
-        if 'adaptive' in mode:
-            n_obs = len(obs_frame_indices[0])
-            for i, li in enumerate(latent_frame_indices):
-                samples[i, li] = local_samples[i, n_obs:].cpu()
-        else:
-            samples[:, latent_frame_indices] = local_samples[:,
-                                                             -n_latent:].cpu()
+        samples.write(latent_frame_indices,
+                      local_samples[:, len(obs_frame_indices):])
     return samples.numpy()
 
 
@@ -167,6 +165,9 @@ def main(args,
                     batch=batch,
                     obs_length=args.obs_length,
                     use_gradient_method=use_gradient_method,
+                    max_canvas_gb=args.max_canvas_gb,
+                    sampler=args.sampler,
+                    solver_order=args.solver_order,
                 )
                 recon = ((recon - drange[0]) / (drange[1] - drange[0]) * 255
                          )  # recon with pixel values in [0, 255]
@@ -228,8 +229,58 @@ if __name__ == '__main__':
         'If not None, only generate videos for the specified indices. Used for handling parallelization.',
     )
     parser.add_argument('--use_gradient_method', action='store_true')
+    parser.add_argument(
+        '--batched_guidance',
+        action='store_true',
+        help=
+        'With --use_gradient_method, guides sampling by extrapolating from the joint to the conditional prediction, computed in one batched forward pass, instead of backpropagating through the model.',
+    )
+    parser.add_argument(
+        '--guidance_weight',
+        type=float,
+        default=None,
+        help=
+        'Weight of the guidance with --use_gradient_method. Defaults to 10, or 1 with --batched_guidance.',
+    )
+    parser.add_argument(
+        '--guidance_checkpoint',
+        action='store_true',
+        help=
+        'With --use_gradient_method, uses gradient checkpointing in the backward pass through the model to save memory.',
+    )
+    parser.add_argument(
+        '--max_canvas_gb',
+        type=float,
+        default=None,
+        help=
+        'Videos larger than this (in GB) are kept in host memory while sampling, instead of on the device. Defaults to half of the free GPU memory.',
+    )
+    parser.add_argument(
+        '--compile_mode',
+        type=str,
+        default='none',
+        choices=compile_util.COMPILE_MODES,
+        help=
+        'How to compile the model calls for sampling (once per input shape): a TorchScript trace, the trace captured in a CUDA graph, or torch.compile. Falls back to the eager model where compilation fails.',
+    )
     parser.add_argument('--use_ddim', type=str2bool, default=False)
     parser.add_argument('--timestep_respacing', type=str, default='')
+    parser.add_argument(
+        '--sampler',
+        type=str,
+        default=None,
+        choices=dpm_solver.SAMPLERS,
+        help=
+        'ddpm for ancestral sampling, or dpm_solver++ for the multistep DPM-Solver++ ODE solver, which needs far fewer steps (10-25, see --timestep_respacing). Defaults to ddpm, or to DDIM (dpm_solver++ of order 1) for models trained with progressive distillation, which ddpm cannot sample.',
+    )
+    parser.add_argument(
+        '--solver_order',
+        type=int,
+        default=2,
+        choices=[1, 2, 3],
+        help=
+        'Order of DPM-Solver++ (order 1 is DDIM). Defaults to 2, which is the most stable with guidance.',
+    )
     parser.add_argument(
         '--T',
         type=int,
@@ -300,6 +351,8 @@ if __name__ == '__main__':
         model.load_state_dict(state_dict)
         model = model.to(args.device)
         model.eval()
+        model = compile_util.compile_for_inference(model, args.compile_mode)
+        test_util.configure_guidance(diffusion, args)
         models[model_name], diffusions[model_name] = model, diffusion
     # Assertions on model arguments
     assert (
@@ -348,6 +401,12 @@ if __name__ == '__main__':
     args.eval_dir = args.eval_dir
     (args.eval_dir / 'samples').mkdir(parents=True, exist_ok=True)
     print(f"Saving samples to {args.eval_dir / 'samples'}")
+    # After the identifier, in which no sampler is the model's default one
+    test_util.configure_sampler(
+        args,
+        max(
+            getattr(model_args, 'distill_rounds', 0)
+            for model_args in model_args_dict.values()))
 
     # Store model configs in a JSON file (only save the config of one of the models)
     for model_name in ['fs1', 'fs4']:
@@ -1,3 +1,4 @@
+import itertools
 import json
 import os
 import shutil
@@ -11,7 +12,8 @@ from PIL import Image
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
-from improved_diffusion import dist_util, inference_util, test_util
+from improved_diffusion import (compile_util, dist_util, dpm_solver,
+                                inference_util, test_util)
 from improved_diffusion.image_datasets import (get_test_dataset,
                                                get_train_dataset,
                                                get_variable_length_dataset)
@@ -47,93 +49,122 @@ def get_masks(x0, num_obs):
 
 
 @torch.no_grad()
-def infer_step(model, diffusion, video, args):
-    drange = [-1, 1]  # Range of the generated samples' pixel values
-    video = (video / 255.0) * (drange[1] -
-                               drange[0]) - 1  # Normalize to [-1, 1]
-    video = video[:args.obs_length]
-    video = torch.tensor(video)
-    assert (len(video) == args.obs_length
-            ), f'Expected {args.obs_length} frames, but got {len(video)}'
-    T, C, H, W = video.shape
-    samples = torch.zeros(1, args.obs_length + args.file_length, C, H, W)
-    samples[:, :args.obs_length] = video[:args.obs_length]
+def generate_frames(model, diffusion, video, args):
+    """Continues a video indefinitely, yielding the generated frames one at a
+    time, in order, as soon as they are finished.
+
+    The frames are generated in windows of args.obs_length + args.file_length
+    frames. Each window is conditioned on the last args.obs_length frames of
+    the previous one, so memory use does not grow with the length of the
+    video: only the current window is kept, on the device.
+
+    Args:
+        model: The DDPM model.
+        diffusion: The Gaussian diffusion process.
+        video (np.ndarray): The video to continue (TxCxHxW, pixel values in
+            [0, 255]). Its last args.obs_length frames are observed. If it is
+            empty, the first window is sampled unconditionally.
+        args: The sampling arguments.
 
-    adaptive_kwargs = (dict(
-        distance='lpips') if 'adaptive' in args.inference_mode else {})
-    frame_indices_iterator = inference_util.inference_strategies[
-        args.inference_mode](
-            video_length=samples.shape[1],
-            num_obs=T,
+    Yields:
+        np.ndarray: The generated frames (CxHxW, uint8).
+    """
+    drange = [-1, 1]  # Range of the generated samples' pixel values
+    n_context = min(len(video), args.obs_length)
+    assert n_context in (
+        0, args.obs_length
+    ), f'Expected at least {args.obs_length} frames, but got {len(video)}'
+    context = torch.tensor(video[len(video) - n_context:],
+                           dtype=torch.float32,
+                           device=args.device)
+    context = (context / 255.0) * (drange[1] -
+                                   drange[0]) - 1  # Normalize to [-1, 1]
+    C, H, W = video.shape[1:]
+    stage_steps = inference_util.StageStepSchedule(args.stage_steps)
+    while True:
+        window_length = n_context + args.file_length
+        samples = inference_util.VideoCanvas((1, window_length, C, H, W),
+                                             device=args.device,
+                                             max_device_gb=args.max_canvas_gb)
+        samples.write(list(range(n_context)), context[None])
+        adaptive_kwargs = (dict(
+            distance='lpips') if 'adaptive' in args.inference_mode else {})
+        frame_indices_iterator = inference_util.get_inference_strategy(
+            args.inference_mode,
+            video_length=window_length,
+            num_obs=n_context,
             max_frames=args.max_frames,
             step_size=args.step_size,
             **adaptive_kwargs,
         )
+        # Frames of the window that are generated (or observed). Frames are
+        # yielded once all the frames before them are done too.
+        done = np.zeros(window_length + 1, dtype=bool)
+        done[:n_context] = True
+        n_yielded = n_context
 
-    while True:
-        if 'adaptive' in args.inference_mode:
-            frame_indices_iterator.set_videos(samples.to(args.device))
-        try:
-            obs_indices, lat_indices = next(frame_indices_iterator)
-        except StopIteration:
-            break
-        if 'adaptive' in args.inference_mode:
-            frame_indices = torch.cat(
-                [torch.tensor(obs_indices),
-                 torch.tensor(lat_indices)], dim=1).long()
-            x0 = torch.stack(
-                [samples[i, fi] for i, fi in enumerate(frame_indices)],
-                dim=0).clone()
-            obs_mask, latent_mask, kinda_marg_mask = get_masks(
-                x0, len(obs_indices[0]))
-            n_latent = len(lat_indices[0])
-        else:
-            x0 = torch.cat([samples[:, obs_indices], samples[:, lat_indices]],
-                           dim=1).clone()
-            frame_indices = torch.cat(
-                [torch.tensor(obs_indices),
-                 torch.tensor(lat_indices)], dim=0).repeat((1, 1))
+        while True:
+            if 'adaptive' in args.inference_mode:
+                frame_indices_iterator.set_videos(samples.videos,
+                                                  device=args.device)
+            try:
+                obs_indices, lat_indices = next(frame_indices_iterator)
+            except StopIteration:
+                break
+            x0, frame_indices = samples.read_stage(obs_indices, lat_indices)
+            n_obs = (len(obs_indices[0]) if 'adaptive' in args.inference_mode
+                     else len(obs_indices))
             # Prepare masks
-            obs_mask, latent_mask, kinda_marg_mask = get_masks(
-                x0, len(obs_indices))
-            n_latent = len(lat_indices)
-        # Move tensors to the correct device
-        [x0, obs_mask, latent_mask, kinda_marg_mask, frame_indices] = [
-            xyz.to(args.device) for xyz in
-            [x0, obs_mask, latent_mask, kinda_marg_mask, frame_indices]
-        ]
-        print(f"{'Frame indices':20}: {frame_indices[0].cpu().numpy()}.")
-        print(
-            f"{'Observation mask':20}: {obs_mask[0].cpu().int().numpy().squeeze()}"
-        )
-        print(
-            f"{'Latent mask':20}: {latent_mask[0].cpu().int().numpy().squeeze()}"
-        )
-        print('-' * 40)
-        # Run the network
-        local_samples, attention_map = diffusion.p_sample_loop(
-            model,
-            x0.shape,
-            clip_denoised=True,
-            model_kwargs=dict(
-                frame_indices=frame_indices,
-                x0=x0,
-                obs_mask=obs_mask,
-                latent_mask=latent_mask,
-                kinda_marg_mask=kinda_marg_mask,
-            ),
-            latent_mask=latent_mask,
-            return_attn_weights=False,
-            use_gradient_method=args.use_gradient_method,
-        )
-        # Fill in the generated frames
-        samples[:, lat_indices] = local_samples[:, -n_latent:].cpu()
-    # Drop the batch dimension and the first few observed frames
-    samples = samples[0][args.obs_length:]
-    # Tranform pixel values to [0,255]
-    samples = ((samples - drange[0]) / (drange[1] - drange[0]) * 255
-               )  # samples with pixel values in [0, 255]
-    return samples.numpy()
+            obs_mask, latent_mask, kinda_marg_mask = get_masks(x0, n_obs)
+            print(f"{'Frame indices':20}: {frame_indices[0].cpu().numpy()}.")
+            print(
+                f"{'Observation mask':20}: {obs_mask[0].cpu().int().numpy().squeeze()}"
+            )
+            print(
+                f"{'Latent mask':20}: {latent_mask[0].cpu().int().numpy().squeeze()}"
+            )
+            # Respace the diffusion to the step budget of the stage (spaced
+            # quadratically for the ODE solver)
+            n_steps = stage_steps(obs_indices, lat_indices,
+                                  frame_indices_iterator.stage_level)
+            stage_diffusion = inference_util.respace_stage(
+                diffusion, n_steps, args.sampler)
+            print(f"{'Denoising steps':20}: {stage_diffusion.num_timesteps}")
+            print('-' * 40)
+            # Run the network
+            for out in inference_util.sample_stage(
+                    model,
+                    stage_diffusion,
+                    x0,
+                    dict(
+                        frame_indices=frame_indices,
+                        x0=x0,
+                        obs_mask=obs_mask,
+                        latent_mask=latent_mask,
+                        kinda_marg_mask=kinda_marg_mask,
+                    ),
+                    sampler=args.sampler,
+                    solver_order=args.solver_order,
+                    noise=torch.randn_like(x0),
+                    use_gradient_method=args.use_gradient_method,
+            ):
+                local_samples = out['sample']
+            # Fill in the generated frames
+            samples.write(lat_indices, local_samples[:, n_obs:])
+            done[np.array(lat_indices).ravel()] = True
+            n_done = n_yielded + int(np.argmin(done[n_yielded:]))
+            if n_done > n_yielded:
+                frames = samples.read(list(range(n_yielded, n_done)))[0]
+                # Tranform pixel values to [0,255]
+                frames = ((frames - drange[0]) / (drange[1] - drange[0]) *
+                          255).clamp(0, 255).to(torch.uint8)
+                yield from frames.cpu().numpy()
+                n_yielded = n_done
+        assert n_yielded == window_length, 'Some frames were not generated.'
+        # Condition the next window on the last frames of this one.
+        context = samples.read(
+            list(range(window_length - args.obs_length, window_length)))[0]
+        n_context = args.obs_length
 
 
 if __name__ == '__main__':
@@ -146,7 +177,20 @@ if __name__ == '__main__':
         help=
         'Path to the video file to start generation with. It should be a .npy file. If None, starts from the latest sampled video stored at the output direcotyr',
     )
-    parser.add_argument('--length', type=int, required=True)
+    parser.add_argument(
+        '--length',
+        type=int,
+        required=True,
+        help=
+        'Number of frames to generate. If negative, generates until interrupted.',
+    )
+    parser.add_argument(
+        '--output_format',
+        default='npy',
+        choices=['npy', 'memmap'],
+        help=
+        'Whether to store the video as video_<i>.npy files of file_length frames each, or as a single uint8 frames.u8 file (with frames.json) that is appended to as frames are generated.',
+    )
     parser.add_argument(
         '--inference_mode',
         type=str,
@@ -169,9 +213,66 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--out', default=None)
     parser.add_argument('--unconditional', action='store_true')
     # Inference arguments
+    parser.add_argument(
+        '--stage_steps',
+        type=str,
+        default='',
+        help=
+        'Number of denoising steps of each inference stage, as "level:S1,S2,..." (by level of hierarchical strategies) or "distance:S1,S2,..." (by distance from the latent frames to the observed ones). See inference_util.StageStepSchedule. Defaults to all the steps in every stage.',
+    )
     parser.add_argument('--use_gradient_method', action='store_true')
+    parser.add_argument(
+        '--batched_guidance',
+        action='store_true',
+        help=
+        'With --use_gradient_method, guides sampling by extrapolating from the joint to the conditional prediction, computed in one batched forward pass, instead of backpropagating through the model.',
+    )
+    parser.add_argument(
+        '--guidance_weight',
+        type=float,
+        default=None,
+        help=
+        'Weight of the guidance with --use_gradient_method. Defaults to 10, or 1 with --batched_guidance.',
+    )
+    parser.add_argument(
+        '--guidance_checkpoint',
+        action='store_true',
+        help=
+        'With --use_gradient_method, uses gradient checkpointing in the backward pass through the model to save memory.',
+    )
+    parser.add_argument(
+        '--max_canvas_gb',
+        type=float,
+        default=None,
+        help=
+        'Videos larger than this (in GB) are kept in host memory while sampling, instead of on the device. Defaults to half of the free GPU memory.',
+    )
+    parser.add_argument(
+        '--compile_mode',
+        type=str,
+        default='none',
+        choices=compile_util.COMPILE_MODES,
+        help=
+        'How to compile the model calls for sampling (once per input shape): a TorchScript trace, the trace captured in a CUDA graph, or torch.compile. Falls back to the eager model where compilation fails.',
+    )
     parser.add_argument('--use_ddim', type=str2bool, default=False)
     parser.add_argument('--timestep_respacing', type=str, default='')
+    parser.add_argument(
+        '--sampler',
+        type=str,
+        default=None,
+        choices=dpm_solver.SAMPLERS,
+        help=
+        'ddpm for ancestral sampling, or dpm_solver++ for the multistep DPM-Solver++ ODE solver, which needs far fewer steps (10-25, see --timestep_respacing and --stage_steps). Defaults to ddpm, or to DDIM (dpm_solver++ of order 1) for models trained with progressive distillation, which ddpm cannot sample.',
+    )
+    parser.add_argument(
+        '--solver_order',
+        type=int,
+        default=2,
+        choices=[1, 2, 3],
+        help=
+        'Order of DPM-Solver++ (order 1 is DDIM). Defaults to 2, which is the most stable with guidance.',
+    )
     args = parser.parse_args()
 
     if args.out is None:
@@ -186,6 +287,9 @@ if __name__ == '__main__':
         use_ddim=args.use_ddim,
         timestep_respacing=args.timestep_respacing,
     )
+    model = compile_util.compile_for_inference(model, args.compile_mode)
+    test_util.configure_guidance(diffusion, args)
+    test_util.configure_sampler(args, getattr(model_args, 'distill_rounds', 0))
     args.max_frames = model_args.max_frames
     args.step_size = args.max_frames // 2
     args.obs_length = model_args.T // 2
@@ -214,13 +318,18 @@ if __name__ == '__main__':
             args.starting_video = Path(args.starting_video)
             assert (args.starting_video.is_file()
                     ), f'Starting video {args.starting_video} does not exist.'
-            shutil.copyfile(args.starting_video, args.out / 'video_0.npy')
+            if args.output_format == 'memmap':
+                starting_video = np.load(args.starting_video)
+                test_util.FrameFile(
+                    args.out / 'frames',
+                    frame_shape=starting_video.shape[1:]).append(
+                        starting_video.astype(np.uint8))
+            else:
+                shutil.copyfile(args.starting_video, args.out / 'video_0.npy')
         else:
             assert (
                 args.starting_video is None
             ), f'--starting_video argument should be None for unconditional sampling (got {args.starting_video}).'
-            cond_obs_length = args.obs_length
-            args.obs_length = 0
         with open(config_path, 'w') as f:
             json.dump(vars(model_args), f, indent=4)
         print(f'Saved model config at {config_path}')
@@ -231,11 +340,15 @@ if __name__ == '__main__':
         assert (
             args.starting_video is None
         ), '--starting_video argument is not allowed when the output directory is not empty.'
-        args.starting_video = sorted(
-            list(args.out.glob('video_*.npy')),
-            key=lambda x: int(x.stem.split('_')[1]))[-1]
-        args.starting_video = Path(args.starting_video)
-        video_index_offset = int(args.starting_video.stem.split('_')[1]) + 1
+        if args.output_format == 'memmap':
+            args.starting_video = args.out / 'frames.u8'
+        else:
+            args.starting_video = sorted(
+                list(args.out.glob('video_*.npy')),
+                key=lambda x: int(x.stem.split('_')[1]))[-1]
+            args.starting_video = Path(args.starting_video)
+            video_index_offset = int(
+                args.starting_video.stem.split('_')[1]) + 1
         assert config_path.exists(
         ), f'Model config file {config_path} does not exist.'
         with open(config_path, 'r') as f:
@@ -253,7 +366,10 @@ if __name__ == '__main__':
     )
     print(f'max_frames = {args.max_frames} and step_size = {args.step_size}')
 
-    if not args.unconditional:
+    if args.output_format == 'memmap' and (args.out / 'frames.json').exists():
+        frame_file = test_util.FrameFile(args.out / 'frames')
+        video = frame_file.read()[-args.obs_length:]
+    elif not args.unconditional:
         # Load the video to start generation with.
         video = np.load(args.starting_video)
         assert (
@@ -264,17 +380,31 @@ if __name__ == '__main__':
         video = np.zeros((0, 3, res, res), dtype=np.uint8)
 
     # Generate the video
-    for cnt, frame_idx in enumerate(range(0, args.length, args.file_length)):
-        path = args.out / f'video_{video_index_offset + cnt}.npy'
-        assert (
-            not path.exists()
-        ), f'About to generate video #{video_index_offset + cnt} at {path} but this file already exists.'
-        new_video = infer_step(model, diffusion, video, args)
-        np.save(path, new_video)
-        print(f'Saved a video part (with {len(new_video)} frames) at {path}')
-        video = np.concatenate(
-            [video, new_video], axis=0
-        )[-args.
-          obs_length:]  # Drop anything farther than obs_length frames since we are not conditioning on them.
-        if args.unconditional and args.obs_length == 0:
-            args.obs_length = cond_obs_length
+    frames = generate_frames(model, diffusion, video, args)
+    if args.output_format == 'memmap':
+        if args.length >= 0:
+            frames = itertools.islice(frames, args.length)
+        frame_file = test_util.FrameFile(args.out / 'frames',
+                                         frame_shape=video.shape[1:])
+        for frame in tqdm(frames, desc='Frame'):
+            frame_file.append(frame[None])
+        print(f'Saved {len(frame_file)} frames at {frame_file.data_path}')
+    else:
+        if args.length >= 0:
+            # Generate whole files
+            n_files = -(-args.length // args.file_length)
+            frames = itertools.islice(frames, n_files * args.file_length)
+        new_video = []
+        for frame in tqdm(frames, desc='Frame'):
+            new_video.append(frame)
+            if len(new_video) < args.file_length:
+                continue
+            path = args.out / f'video_{video_index_offset}.npy'
+            assert (
+                not path.exists()
+            ), f'About to generate video #{video_index_offset} at {path} but this file already exists.'
+            np.save(path, np.stack(new_video))
+            print(
+                f'Saved a video part (with {len(new_video)} frames) at {path}')
+            new_video = []
+            video_index_offset += 1
@@ -0,0 +1,140 @@
+"""Evaluates per-stage step budgets (video_sample.py --stage_steps): samples
+videos with each of the given schedules, computes their LPIPS and FVD with
+video_eval.py, and reports them against the number of model evaluations
+needed to sample a video.
+
+Example:
+    python scripts/video_stage_steps_eval.py <checkpoint> --inference_mode hierarchy-2 \
+        --T 300 --max_frames 10 --step_size 7 \
+        --schedules "" "level:1000,250" "level:500,100" "distance:100,250,500" \
+        --timestep_respacing 1000 -- --subset_size 100
+Arguments after "--" are passed on to video_sample.py.
+"""
+import pickle
+import shlex
+import subprocess
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+from improved_diffusion import dist_util, inference_util
+from improved_diffusion.respace import space_timesteps
+
+
+def schedule_label(schedule):
+    if schedule == '':
+        return 'uniform'
+    return schedule.replace(':', '-').replace(',', '-')
+
+
+def default_steps(checkpoint_path, timestep_respacing):
+    """Number of steps of the diffusion used by video_sample.py."""
+    config = dist_util.load_state_dict(checkpoint_path,
+                                       map_location='cpu')['config']
+    if timestep_respacing == '':
+        return config['diffusion_steps']
+    return len(space_timesteps(config['diffusion_steps'], timestep_respacing))
+
+
+def find_eval_dir(root):
+    eval_dirs = [p.parent for p in Path(root).glob('*/samples')]
+    assert len(eval_dirs) == 1, f'Expected one eval dir in {root}.'
+    return eval_dirs[0]
+
+
+def load_metrics(eval_dir):
+    paths = sorted(Path(eval_dir).glob('metrics_*.pkl'),
+                   key=lambda p: p.stat().st_mtime)
+    if not paths:
+        return {}
+    with open(paths[-1], 'rb') as f:
+        return pickle.load(f)
+
+
+def main(args, sample_args):
+    scripts_dir = Path(__file__).parent
+    n_default = default_steps(args.checkpoint_path, args.timestep_respacing)
+    plan = inference_util.get_inference_plan(args.inference_mode,
+                                             video_length=args.T,
+                                             num_obs=args.obs_length,
+                                             max_frames=args.max_frames,
+                                             step_size=args.step_size)
+    rows = []
+    for schedule in args.schedules:
+        root = Path(args.out_dir) / schedule_label(schedule)
+        cmd = [
+            sys.executable,
+            str(scripts_dir / 'video_sample.py'),
+            args.checkpoint_path,
+            f'--inference_mode={args.inference_mode}',
+            f'--T={args.T}',
+            f'--max_frames={args.max_frames}',
+            f'--step_size={args.step_size}',
+            f'--obs_length={args.obs_length}',
+            f'--timestep_respacing={args.timestep_respacing}',
+            f'--stage_steps={schedule}',
+            f'--eval_dir={root}',
+        ] + sample_args
+        print(f'[{schedule_label(schedule)}] {shlex.join(cmd)}')
+        subprocess.run(cmd, check=True)
+        eval_dir = find_eval_dir(root)
+        if not args.skip_metrics:
+            subprocess.run([
+                sys.executable,
+                str(scripts_dir / 'video_eval.py'),
+                f'--eval_dir={eval_dir}',
+                f'--obs_length={args.obs_length}',
+                f'--T={args.T}',
+                '--modes',
+                'lpips',
+                'fvd',
+            ],
+                           check=True)
+        metrics = load_metrics(eval_dir)
+        n_evals = inference_util.StageStepSchedule(schedule).total_steps(
+            plan, n_default)
+        rows.append((schedule_label(schedule), n_evals,
+                     metrics['lpips'].mean() if 'lpips' in metrics else None,
+                     metrics['fvd'].mean() if 'fvd' in metrics else None))
+
+    print(f"\n{'schedule':30s} {'model evals':>12s} {'LPIPS':>8s} {'FVD':>8s}")
+    for label, n_evals, lpips, fvd in sorted(rows, key=lambda r: r[1]):
+        lpips = 'n/a' if lpips is None else f'{lpips:.4f}'
+        fvd = 'n/a' if fvd is None else f'{fvd:.1f}'
+        print(f'{label:30s} {n_evals:12d} {lpips:>8s} {fvd:>8s}')
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    sample_args = []
+    if '--' in argv:
+        sample_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    parser = ArgumentParser()
+    parser.add_argument('checkpoint_path', type=str)
+    parser.add_argument(
+        '--inference_mode',
+        required=True,
+        choices=[
+            mode for mode in inference_util.inference_strategies
+            if not inference_util.is_adaptive(mode)
+        ],
+    )
+    parser.add_argument('--schedules',
+                        type=str,
+                        nargs='+',
+                        required=True,
+                        help='Values of --stage_steps to compare.')
+    parser.add_argument('--T', type=int, required=True)
+    parser.add_argument('--max_frames', type=int, required=True)
+    parser.add_argument('--step_size', type=int, default=1)
+    parser.add_argument('--obs_length', type=int, default=36)
+    parser.add_argument('--timestep_respacing', type=str, default='')
+    parser.add_argument('--out_dir',
+                        type=str,
+                        default='results/stage_steps_eval')
+    parser.add_argument(
+        '--skip_metrics',
+        action='store_true',
+        help='Only sample, and report the metrics already computed.')
+    main(parser.parse_args(argv), sample_args)
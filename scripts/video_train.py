@@ -59,6 +59,21 @@ def main():
 
     set_random_seed(args.fake_seed, deterministic=True)
 
+    if args.distill_from:
+        assert not (args.resume_id or args.resume_checkpoint), \
+            'Continue a distillation with --distill_from its last checkpoint.'
+        # The student has the architecture, diffusion and conditioning of the
+        # teacher, and starts from its weights.
+        teacher_checkpoint = dist_util.load_state_dict(args.distill_from,
+                                                       map_location='cpu')
+        for k in [
+                *video_model_and_diffusion_defaults().keys(),
+                'observed_frames', 'max_frames'
+        ]:
+            if k in teacher_checkpoint['config']:
+                setattr(args, k, teacher_checkpoint['config'][k])
+        args.timestep_respacing = ''
+
     video_length = default_T_dict[args.dataset]
     default_T = video_length
     default_image_size = default_image_size_dict[args.dataset]
@@ -87,6 +102,8 @@ def main():
     model, diffusion = create_video_model_and_diffusion(
         **args_to_dict(args,
                        video_model_and_diffusion_defaults().keys()))
+    if args.distill_from:
+        model.load_state_dict(teacher_checkpoint['state_dict'])
     model.to(dist_util.dev())
     schedule_sampler = create_named_schedule_sampler(args.schedule_sampler,
                                                      diffusion)
@@ -129,6 +146,15 @@ def main():
         pad_with_random_frames=args.pad_with_random_frames,
         observed_frames=args.observed_frames,
         use_gradient_method=args.use_gradient_method,
+        sample_use_ddim=args.sample_use_ddim,
+        sample_timestep_respacing=args.sample_timestep_respacing,
+        async_sampling=args.async_sampling,
+        microbatch_memory_gb=args.microbatch_memory_gb or None,
+        ddp_comm_hook=args.ddp_comm_hook,
+        batch_mean_loss=args.batch_mean_loss,
+        bucket_by_length=args.bucket_by_length,
+        valid_interval=args.valid_interval,
+        n_valid_timesteps=args.n_valid_timesteps,
         args=args,
     )
     if args.just_visualise:
@@ -137,7 +163,11 @@ def main():
     if args.just_save_masks > 0:
         train_loop.save_masks(args.just_save_masks)
         exit()
-    train_loop.run_loop()
+    if args.distill_from:
+        train_loop.run_distillation(args.distill_halvings,
+                                    args.distill_round_steps)
+    else:
+        train_loop.run_loop()
 
 
 def create_argparser():
@@ -149,6 +179,16 @@ def create_argparser():
         lr_anneal_steps=0,
         batch_size=1,
         microbatch=-1,  # -1 disables microbatches
+        # If > 0, the microbatch size is chosen so that a microbatch takes
+        # about this much GPU memory, measured on the first one (which has
+        # the size given by microbatch).
+        microbatch_memory_gb=0.0,
+        ddp_comm_hook='none',  # or fp16/bf16 to compress the all-reduces
+        # If True, the gradient is the mean of the losses over the batch. By
+        # default, it is the sum of the microbatch means, which scales the
+        # gradient (and the effective learning rate) with the number of
+        # microbatches.
+        batch_mean_loss=False,
         ema_rate='0.9999',  # comma-separated list of EMA values
         log_interval=10,
         sample_interval=50000,
@@ -172,6 +212,12 @@ def create_argparser():
         num_workers=
         -1,  # Number of workers to use for training dataloader. If not specified, uses the number of available cores on the machine.
         pad_with_random_frames=True,
+        # With pad_with_random_frames=False, make the microbatches of
+        # examples with the same number of frames where there are enough of
+        # them, so that few frames are padding (the share is logged as
+        # padding_fraction). The microbatches have the same sizes as without
+        # it.
+        bucket_by_length=False,
         fake_seed=
         1,  # the random seed is never set, but this lets us run sweeps with is as if it controls the seed
         # the input of observed frames, case 1: 'x_0', case 2: 'x_t', case 3: 'x_t_minus_1'
@@ -179,6 +225,22 @@ def create_argparser():
         data_path=None,  # assign data path,
         use_gradient_method=True,
         image_size=-1,
+        # Validation sampling (at sample_interval). A respacing such as "50"
+        # or "ddim50" makes it much cheaper than the full chain.
+        sample_use_ddim=False,
+        sample_timestep_respacing='',
+        async_sampling=True,  # sample on a background CUDA stream
+        # Validation losses (at valid_interval; 0 disables them), on the
+        # validation batches at n_valid_timesteps fixed timesteps. Much
+        # cheaper than sampling, so they can be logged more often.
+        valid_interval=5000,
+        n_valid_timesteps=16,
+        # Progressive distillation of the model checkpoint at distill_from
+        # into a model that samples in 2**distill_halvings times fewer DDIM
+        # steps, with distill_round_steps training steps per halving.
+        distill_from='',
+        distill_halvings=3,
+        distill_round_steps=50000,
     )
     defaults.update(video_model_and_diffusion_defaults())
     parser = argparse.ArgumentParser()